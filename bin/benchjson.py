@@ -0,0 +1,73 @@
+#!/usr/bin/env python2.5
+# $Id$
+#
+# Copyright (c) 2007-2008 ReThought Limited and Peloton Contributors
+# All Rights Reserved
+# See LICENSE for details
+""" Compare the JSON output path of the HTTP adapter, as it was with
+simplejson.dumps and a JSONP wrapper made by string formatting, with the
+jsonTransform formatting whole and streaming.
+
+Results of roughly 1MB and 50MB (a list of records) are encoded; for
+each path the time taken and the largest single string held are shown.
+Run with peloton on the python path, e.g.::
+
+  PYTHONPATH=src python bin/benchjson.py [sizes in MB...]
+"""
+import sys
+import time
+import simplejson
+from peloton.utils import transforms
+
+def makeResult(mb):
+    """ Return a list of records that encodes to about mb megabytes. """
+    record = {'id' : 0, 'name' : 'record', 'score' : 0.5,
+              'tags' : ['a', 'b'], 'active' : True, 'note' : None}
+    size = len(simplejson.dumps(record)) + 2
+    return [dict(record, id=i) for i in xrange(int(mb * 1024 * 1024 / size))]
+
+def currentPath(result):
+    """ As before: dumps, str and a JSONP wrapper by formatting. """
+    resp = str(simplejson.dumps(result))
+    resp = "%s(%s)" % ('callback', resp)
+    return [resp]
+
+def formatPath(result):
+    resp = str(transforms.jsonTransform()(result, {}))
+    return ['callback(', resp, ')']
+
+def streamPath(result):
+    serialization = transforms.jsonTransform({}, stream=True)(result, {})
+    yield 'callback('
+    for chunk in serialization.chunks():
+        yield chunk
+    yield ')'
+
+def bench(name, path, result):
+    start = time.time()
+    total = 0
+    largest = 0
+    first = None
+    for s in path(result):
+        if first is None:
+            first = time.time() - start
+        total += len(s)
+        largest = max(largest, len(s))
+    elapsed = time.time() - start
+    print "  %-8s %8.3fs  first write %8.4fs  %10d bytes, largest string %10d" % \
+        (name, elapsed, first, total, largest)
+
+def main(sizes):
+    print "C accelerated encoder: %s (%s)" % (transforms.JSON_ACCELERATED,
+                                              transforms.json.__name__)
+    for mb in sizes:
+        result = makeResult(mb)
+        print "%sMB result, %d records" % (mb, len(result))
+        for name, path in [('current', currentPath),
+                           ('format', formatPath),
+                           ('stream', streamPath)]:
+            bench(name, path, result)
+
+if __name__ == '__main__':
+    sizes = [float(i) for i in sys.argv[1:]] or [1, 50]
+    main(sizes)
@@ -4,6 +4,8 @@
 # See LICENSE for details
 from peloton.service import PelotonService
 from peloton.svcdeco import *
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred
 import time
 import os
 
@@ -62,6 +64,14 @@ class TestService(PelotonService):
         time.sleep(x)
         return "Done a slow call"
     
+    @asynchronous
+    def public_asyncSlowCall(self, x):
+        """ As slowCall but waits in the event loop rather than tying up
+a thread. """
+        d = Deferred()
+        reactor.callLater(int(x), d.callback, "Done an async slow call")
+        return d
+    
 # The following transforms are implicitly applied; if 
 # template(...) receives non-dictionary data it applies
 # valueToDict automatically.
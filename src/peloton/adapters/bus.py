@@ -0,0 +1,68 @@
+# $Id$
+#
+# Copyright (c) 2007-2008 ReThought Limited and Peloton Contributors
+# All Rights Reserved
+# See LICENSE for details
+
+import cPickle as pickle
+from peloton.adapters import AbstractPelotonAdapter
+from peloton.coreio import PelotonInternodeInterface
+from peloton.events import AbstractEventHandler
+from peloton.exceptions import PelotonError
+
+class PelotonBusAdapter(AbstractPelotonAdapter, AbstractEventHandler):
+    """ Accepts method calls relayed from other PSCs over the message bus;
+the server side of the MessageBusPSCProxy. Requests arrive on the
+domain_control exchange with key psc.<guid>.rpc. Each is executed
+as if relayed over PB and the result, or error, fired back on the
+key given in the request's replyTo together with its correlation ID.
+
+The kernel starts this adapter if 'bus' is one of the RPC mechanisms 
+listed in its profile.
+"""
+    def __init__(self, kernel):
+        AbstractPelotonAdapter.__init__(self, kernel, 'MessageBusRPC')
+        AbstractEventHandler.__init__(self)
+        self.logger = kernel.logger
+        self.dispatcher = kernel.dispatcher
+        self.requestInterface = PelotonInternodeInterface(kernel)
+        
+    def start(self):
+        self.dispatcher.register('psc.%s.rpc' % self.kernel.guid, 
+                                 self, 'domain_control')
+        
+    def stop(self):
+        self.dispatcher.deregister(self)
+        
+    def eventReceived(self, msg, exchange='', key='', ctag=''):
+        d = self.requestInterface.public_relayCall(msg['sender_guid'], 
+                    msg['service'], msg['method'], *msg['args'], **msg['kwargs'])
+        d.addCallbacks(self._reply, self._replyError, 
+                       callbackArgs=(msg,), errbackArgs=(msg,))
+        d.addErrback(self._replyFailed, msg)
+
+    def _reply(self, rv, msg):
+        self.dispatcher.fireEvent(msg['replyTo'], 'domain_control',
+                                  corrId=msg['corrId'],
+                                  ok=True,
+                                  result=rv)
+    
+    def _replyError(self, err, msg):
+        error = err.value
+        try:
+            pickle.dumps(error)
+        except Exception:
+            error = PelotonError(err.getErrorMessage())
+        self.dispatcher.fireEvent(msg['replyTo'], 'domain_control',
+                                  corrId=msg['corrId'],
+                                  ok=False,
+                                  error=error)
+
+    def _replyFailed(self, err, msg):
+        """ The reply itself could not be sent, most likely because the
+result could not be pickled. Tell the caller as much. """
+        self.logger.error("Cannot reply to bus RPC %s: %s" % (msg['corrId'], err.getErrorMessage()))
+        self.dispatcher.fireEvent(msg['replyTo'], 'domain_control',
+                                  corrId=msg['corrId'],
+                                  ok=False,
+                                  error=PelotonError("Cannot return result: %s" % err.getErrorMessage()))
@@ -11,11 +11,16 @@ from twisted.web import resource
 from twisted.web.static import FileTransfer
 from peloton.adapters import AbstractPelotonAdapter
 from peloton.adapters.xmlrpc import PelotonXMLRPCHandler
+from peloton.adapters.producers import ChunkProducer
 from peloton.coreio import PelotonRequestInterface
 from peloton.utils.config import locateService
 from peloton.exceptions import ServiceError
+from peloton.utils.simplexml import Serialization
 
 import os
+import re
+import types
+import itertools
 
 binaryFileMimeTypes = {'.png':'image/PNG','.jpg':'image/JPEG',
        '.jpeg':'image/JPEG','.gif':'image/GIF','.bmp':'image/BMP',
@@ -27,6 +32,10 @@ plainFileMimeTypes = {'.css':'text/css',
       '.html' : 'text/html; charset=UTF-8',
       '.js':'text/javascript'}
 
+# JSONP callback names are restricted to (dotted) javascript identifiers
+# so that a request cannot inject script into the response
+JSONP_CALLBACK = re.compile(r'^[A-Za-z_$][\w$]*(\.[A-Za-z_$][\w$]*)*$')
+
 class PelotonHTTPAdapter(AbstractPelotonAdapter, resource.Resource):
     """ The HTTP adapter provides for accessing methods over
 HTTP and receiving the results in a desired format. The main interface
@@ -120,6 +129,12 @@ HTTP based adapters)."""
                     kwargs[k] = v
 
             self.kernel.logger.info("Callback name %s" % callbackName)
+            if callbackName and not JSONP_CALLBACK.match(callbackName):
+                request.setResponseCode(400)
+                request.setHeader('Content-Type', 'text/plain')
+                request.write("Invalid JSONP callback name")
+                request.finish()
+                return server.NOT_DONE_YET
 
             try:
                 profile, _ = self.kernel.serviceLibrary.getProfile(service)
@@ -166,14 +181,26 @@ args[1] is the exchange
         FileTransfer(res, fsize, request)        
         
     def deferredResponse(self, resp, target, callbackName, mimeType, request):
+        # a JSONP response is wrapped in a call to callbackName, written
+        # around the JSON rather than copying it into a new string
+        if target == 'json' and callbackName:
+            wrapper = ("%s(" % callbackName, ")")
+        else:
+            wrapper = ("", "")
+        request.setHeader('Content-Type', mimeType)
+        if isinstance(resp, Serialization):
+            # streamed, with chunked transfer encoding
+            chunks = itertools.chain([wrapper[0]], resp.chunks(), [wrapper[1]])
+            ChunkProducer(chunks, request, self.logger).start()
+            return
         # str ensures not unicode which is not liked by 
         # twisted.web
         resp = str(resp)
-        if target == 'json' and callbackName:
-            resp = "%s(%s)" % (callbackName, resp)
-        request.setHeader('Content-Type', mimeType)
-        request.setHeader('Content-Length', len(resp))
-        request.write(resp)
+        request.setHeader('Content-Length', 
+                          len(wrapper[0]) + len(resp) + len(wrapper[1]))
+        for s in (wrapper[0], resp, wrapper[1]):
+            if s:
+                request.write(s)
         request.finish()
         
     def deferredError(self, err, format, request):
@@ -12,6 +12,7 @@ from peloton.coreio import PelotonRequestInterface
 from peloton.coreio import PelotonInternodeInterface
 from peloton.events import RemoteEventHandler
 from peloton.exceptions import PelotonError
+from peloton.utils.transforms import templateCache
 
 class PelotonPBAdapter(AbstractPelotonAdapter, pb.Root):
     """ The primary client adapter for Peloton is the Python Twisted PB
@@ -80,7 +81,8 @@ referenceable and a token. The token was passed to the worker
 generator and is used simply to verify that this is indeed a valid
 and wanted contact."""
         self.logger.info("Starting worker, token=%s NOT VALIDATED" % token)        
-        serviceName, publishedName, runtimeConfig = self.kernel.addWorker(worker, token)
+        serviceName, publishedName, runtimeConfig, spare = \
+            self.kernel.addWorker(worker, token)
         pwa = PelotonWorkerAdapter(self, serviceName, self.kernel)
         worker.checkBeat = pwa.checkBeat
         
@@ -91,6 +93,9 @@ and wanted contact."""
                       'loglevel' : self.kernel.settings.loglevel,
                       'logdir' : self.kernel.settings.logdir,
                       'servicePath' : self.kernel.settings.servicepath,
+                      'spare' : spare,
+                      'templateCacheSize' : templateCache.maxSize,
+                      'templateSweepInterval' : templateCache.sweepInterval,
                       }
         
         return workerInfo
@@ -111,6 +116,22 @@ class PelotonInternodeAdapter(pb.Referenceable):
     def remote_relayCall(self, service, method, *args, **kwargs):
         """ Relay a method call between PSCs. """
         return self.requestInterface.public_relayCall(self.peerGUID, service, method, *args, **kwargs)
+
+    def remote_relayCalls(self, calls):
+        """ Relay a batch of method calls between PSCs. Calls is a list of
+(service, method, args, kwargs); the result is a list of (success, value)
+in the same order, failures being returned as copyable failures. """
+        d = self.requestInterface.public_relayCalls(self.peerGUID, calls)
+        d.addCallback(self._copyFailures)
+        return d
+    
+    def _copyFailures(self, results):
+        copied = []
+        for ok, v in results:
+            if not ok:
+                v = pb.failure2Copyable(v, 0)
+            copied.append((ok, v))
+        return copied
    
     def remote_getInterface(self, name):
         """ Return the named interface to a plugin. """
@@ -149,10 +170,19 @@ client does subsequently. """
         """ Fire an event onto the bus. """
         self.dispatcher.fireEvent(key, exchange, **kwargs)
     
-    def remote_register(self, key, handler, exchange='events'):
+    def remote_register(self, key, handler, exchange='events', 
+                        batchWindow=0, batchSize=100, 
+                        maxQueued=1000, overflow='dropoldest'):
         """ Register to receive events with the given handler. Handler
-must be a Referenceable providing remote_eventReceived."""
-        handler = RemoteEventHandler(handler)
+must be a Referenceable providing remote_eventReceived. If batchWindow
+is set, events are delivered in batches to remote_eventsReceived 
+(see peloton.events.EventReceiver) at intervals of up to batchWindow 
+seconds or when batchSize are waiting. At most maxQueued events are held
+for the handler; overflow is the policy applied beyond that (dropoldest,
+dropnewest or disconnect)."""
+        handler = RemoteEventHandler(handler, batchWindow, batchSize,
+                                     maxQueued, overflow, 
+                                     "%s:%s" % (exchange, key))
         self.eventHandlers.append(handler)
         self.dispatcher.register(key, handler, exchange)
     
@@ -206,10 +236,19 @@ class PelotonWorkerAdapter(pb.Referenceable):
         """ Fire an event onto the bus. """
         self.kernel.dispatcher.fireEvent(key, exchange, **kwargs)
     
-    def remote_register(self, key, handler, exchange='events'):
+    def remote_register(self, key, handler, exchange='events', 
+                        batchWindow=0, batchSize=100, 
+                        maxQueued=1000, overflow='dropoldest'):
         """ Register to receive events with the given handler. Handler
-must be a Referenceable providing remote_eventReceived."""
-        handler = RemoteEventHandler(handler)
+must be a Referenceable providing remote_eventReceived. If batchWindow
+is set, events are delivered in batches to remote_eventsReceived 
+(see peloton.events.EventReceiver) at intervals of up to batchWindow 
+seconds or when batchSize are waiting. At most maxQueued events are held
+for the handler; overflow is the policy applied beyond that (dropoldest,
+dropnewest or disconnect)."""
+        handler = RemoteEventHandler(handler, batchWindow, batchSize,
+                                     maxQueued, overflow, 
+                                     "%s:%s" % (exchange, key))
         self.eventHandlers.append(handler)
         self.kernel.dispatcher.register(key, handler, exchange)
     
@@ -0,0 +1,64 @@
+# $Id$
+#
+# Copyright (c) 2007-2008 ReThought Limited and Peloton Contributors
+# All Rights Reserved
+# See LICENSE for details
+""" Producers for writing responses to adapter clients. """
+
+import types
+
+class ChunkProducer(object):
+    """ Pull producer that writes strings taken from the iterator chunks
+to request, one each time the transport is ready for more, then finishes
+the request. No Content-Length is set, so HTTP/1.1 clients are sent the 
+response with chunked transfer encoding and only one chunk need be held
+in memory at a time. Unicode chunks are encoded as UTF-8. 
+
+Should the iterator raise, the connection is closed without the request
+being finished: the terminating chunk is never sent and the client sees
+the response as incomplete. """
+    def __init__(self, chunks, request, logger):
+        self.chunks = chunks
+        self.request = request
+        self.logger = logger
+        self.stopped = False
+
+    def start(self):
+        self.request.registerProducer(self, False)
+
+    def resumeProducing(self):
+        if self.stopped:
+            return
+        try:
+            # an empty write would end a chunked response
+            chunk = self.chunks.next()
+            while not chunk:
+                chunk = self.chunks.next()
+        except StopIteration:
+            self._finish()
+            return
+        except Exception, ex:
+            # too late to send an error response; the connection is 
+            # dropped without finishing so that the client cannot take
+            # a truncated body for a complete one.
+            self.logger.error("Error streaming response: %s" % str(ex))
+            self._abort()
+            return
+        if type(chunk) == types.UnicodeType:
+            chunk = chunk.encode('utf-8')
+        self.request.write(chunk)
+
+    def stopProducing(self):
+        """ The connection has been lost. """
+        self.stopped = True
+        self.request.unregisterProducer()
+
+    def _finish(self):
+        self.stopped = True
+        self.request.unregisterProducer()
+        self.request.finish()
+
+    def _abort(self):
+        self.stopped = True
+        self.request.unregisterProducer()
+        self.request.transport.loseConnection()
@@ -0,0 +1,87 @@
+# $Id$
+#
+# Copyright (c) 2007-2008 ReThought Limited and Peloton Contributors
+# All Rights Reserved
+# See LICENSE for details
+""" Test the streaming of responses to adapter clients. """
+
+from unittest import TestCase
+from peloton.adapters.producers import ChunkProducer
+
+class FakeTransport(object):
+    def __init__(self):
+        self.lost = False
+
+    def loseConnection(self):
+        self.lost = True
+
+class FakeRequest(object):
+    def __init__(self):
+        self.transport = FakeTransport()
+        self.producer = None
+        self.written = []
+        self.finished = False
+
+    def registerProducer(self, producer, streaming):
+        self.producer = producer
+
+    def unregisterProducer(self):
+        self.producer = None
+
+    def write(self, data):
+        self.written.append(data)
+
+    def finish(self):
+        self.finished = True
+
+    def pump(self):
+        """ Ask for chunks as a transport would until the producer
+unregisters. """
+        n = 0
+        while self.producer and n < 100:
+            self.producer.resumeProducing()
+            n += 1
+
+class FakeLogger(object):
+    def __init__(self):
+        self.errors = []
+
+    def error(self, msg):
+        self.errors.append(msg)
+
+def failingChunks():
+    yield 'one'
+    yield 'two'
+    raise ValueError("cannot serialize")
+
+class Test_ChunkProducer(TestCase):
+    def setUp(self):
+        self.request = FakeRequest()
+        self.logger = FakeLogger()
+
+    def test_stream(self):
+        chunks = iter(['', 'one', '', u'tw\xf6', ''])
+        ChunkProducer(chunks, self.request, self.logger).start()
+        self.request.pump()
+        self.assertEquals(self.request.written, ['one', 'tw\xc3\xb6'])
+        self.assert_(self.request.finished)
+        self.assertFalse(self.request.transport.lost)
+
+    def test_errorAborts(self):
+        ChunkProducer(failingChunks(), self.request, self.logger).start()
+        self.request.pump()
+        self.assertEquals(self.request.written, ['one', 'two'])
+        self.assertFalse(self.request.finished)
+        self.assert_(self.request.transport.lost)
+        self.assertEquals(self.request.producer, None)
+        self.assertEquals(len(self.logger.errors), 1)
+
+    def test_stopProducing(self):
+        producer = ChunkProducer(iter(['one', 'two']), self.request, 
+                                 self.logger)
+        producer.start()
+        producer.resumeProducing()
+        producer.stopProducing()
+        producer.resumeProducing()
+        self.assertEquals(self.request.written, ['one'])
+        self.assertFalse(self.request.finished)
@@ -10,8 +10,14 @@ to methods in these classes."""
 import peloton.utils.logging as logging
 from peloton.exceptions import NoWorkersError
 from peloton.exceptions import DeadProxyError
+from peloton.exceptions import PelotonConnectionError
 from peloton.exceptions import ServiceError
+from peloton.exceptions import ServiceConfigurationError
+from peloton.events import getSubscriberStats
+from peloton.utils.transforms import templateCache
 from twisted.internet.defer import Deferred
+from twisted.internet.defer import DeferredList
+from twisted.internet.threads import deferToThread
 
 from cStringIO import StringIO
 
@@ -24,20 +30,41 @@ through this class. """
         self.profile = kernel.profile
         self.__kernel__ = kernel
 
+#: keyword argument with which the PSC asks a worker to transform the result
+#: of a method for the target named
+TRANSFORM_TARGET_KEY = '_peloton_target'
+
 class PelotonRequestInterface(PelotonInterface):
     """ Methods of this class perform the core actions of Peloton nodes
 such as executing a method or posting a request on the execution stack. 
 These methods are exposed via adapters. For clarity, although for no other
 technical reason, methods intended for use via adapters are named
 public_<name> by convention."""
+    def __init__(self, kernel):
+        PelotonInterface.__init__(self, kernel)
+        # runs expensive output transforms
+        self.inThread = deferToThread
 
     def public_call(self, sessionId, target, service, method, args, kwargs):
         """ Call a Peloton method in the specified service and return 
 a deferred for the result. Target refers to the output channel, e.g. html
 or xml. """
         d =  Deferred()
+        if target != 'raw' and \
+                self.__methodProperties(service, method).has_key('transformInWorker'):
+            kwargs = dict(kwargs)
+            kwargs[TRANSFORM_TARGET_KEY] = target
         self._publicCall(d, sessionId, target, service, method, args, kwargs)
         return d
+
+    def __methodProperties(self, service, method):
+        """ Return the properties of the method, or an empty dictionary
+if it is not known. """
+        try:
+            profile, _ = self.__kernel__.serviceLibrary.getProfile(service)
+            return profile['methods'][method]['properties']
+        except KeyError:
+            return {}
     
     def _publicCall(self, d, sessionId, target, service, method, args, kwargs):
         while True:
@@ -58,19 +85,26 @@ or xml. """
                 self.__kernel__.routingTable.removeHandlerForService(service, proxy=p, removeAll=True)
 
     def __callResponse(self, rv, target, service, method, d):
-        if not target == 'raw':
-            profile, transforms = self.__kernel__.serviceLibrary.getProfile(service)
-            try:
-                txform = transforms[method]
-            except KeyError:
-                instanceInfo = {"resourceRoot" : profile["resourceRoot"],
-                                "publishedName" : profile["publishedName"]}
-                txform = OutputTransform(instanceInfo, profile['methods'][method]['properties'])
-                transforms[method] = txform
-
-            systemInfo = {'publishedName' : profile['publishedName']}
-            rv = txform.transform(target, rv, systemInfo)
-        d.callback(rv)
+        """ Transform the result for the target. Expensive transform 
+chains are run in a thread, limited by the transform limiter, so as not to
+hold up the event loop; the limiter is shared by all request interfaces
+of the kernel. Results transformed by the worker are passed 
+straight on. """
+        if target == 'raw' or \
+                self.__methodProperties(service, method).has_key('transformInWorker'):
+            d.callback(rv)
+            return
+        # transforms are compiled when the profile is registered
+        profile, transforms = self.__kernel__.serviceLibrary.getProfile(service)
+        txform = transforms[method]
+
+        systemInfo = {'publishedName' : profile['publishedName']}
+        if txform.isExpensive(target):
+            limiter = self.__kernel__.transformLimiter
+            limiter.run(self.inThread, txform.transform, 
+                        target, rv, systemInfo).chainDeferred(d)
+        else:
+            d.callback(txform.transform(target, rv, systemInfo))
                 
     def __callError(self, err, proxy, d, sessionId, target, service, method, args, kwargs):
         if err.parents[-1] == 'peloton.exceptions.NoWorkersError' or \
@@ -80,6 +114,10 @@ or xml. """
             # the service handlers and trying another.
             self.__kernel__.routingTable.removeHandlerForService(service, proxy=proxy, removeAll=True)
             self._publicCall(d, sessionId, target, service, method, args, kwargs)
+        elif err.check(PelotonConnectionError):
+            # the connection to a peer dropped mid-call; the peer is still
+            # a valid handler and its proxy will reconnect, so just re-issue.
+            self._publicCall(d, sessionId, target, service, method, args, kwargs)
         else:
             d.errback(err)
     
@@ -141,6 +179,16 @@ The method is now executed on this node."""
         d.addErrback(self.__callError,rd, p, service)
         return rd
 
+    def public_relayCalls(self, sessionId, calls):
+        """ Relay a batch of method requests from a remote node. Calls is a 
+list of (service, method, args, kwargs) tuples. Returns a deferred that 
+fires with a list of (success, result) tuples, one per call and in the same
+order; for a failed call result is the Failure. """
+        dl = []
+        for service, method, args, kwargs in calls:
+            dl.append(self.public_relayCall(sessionId, service, method, *args, **kwargs))
+        return DeferredList(dl, consumeErrors=True)
+
     def __callError(self, err, d, proxy, service):
         if err.parents[-1] == 'peloton.exceptions.NoWorkersError':
             # so we got back from our PSC that it had no workers left. This is
@@ -190,7 +238,7 @@ for use in such tools."""
         pscs = self.__kernel__.routingTable.pscByService
         services = {}
         for svc, handlers in pscs.items():
-            services[svc] = len(handlers)
+            services[svc] = handlers.totalWeight()
         if pprint:
             s = StringIO()
             for k,v in services.items():
@@ -207,13 +255,47 @@ for use in such tools."""
     def public_stop(self, serviceName):
         self.__kernel__.stopService(serviceName)
         
+    def public_listSubscribers(self, pprint=False):
+        """ Return statistics for each remote event subscriber: events
+queued, in flight, sent and dropped. """
+        stats = getSubscriberStats()
+        if pprint:
+            s = StringIO()
+            for st in stats:
+                s.write("%(name)s: %(queued)d queued, %(inFlight)d in flight, %(sent)d sent, %(dropped)d dropped (%(overflow)s)\n" % st)
+            return s.getvalue()
+        return stats
+
+    def public_templateStats(self, pprint=False):
+        """ Return statistics for the compiled template cache of this 
+node. """
+        stats = templateCache.getStats()
+        if pprint:
+            return "%(size)d templates, %(uses)d uses, hit rate %(hitRate).2f, %(compiles)d compiles averaging %(meanCompileTime).4fs, %(evictions)d evicted, %(invalidations)d invalidated\n" % stats
+        return stats
+
     def public_noop(self):
         self.__kernel__.domainManager.sendCommand('NOOP')
     
 from peloton.utils.transforms import *
+
+#: transforms whose result depends on the service instance, e.g. through
+#: paths relative to its resource root; other transforms built with the
+#: same expression are shared by all services
+INSTANCE_TRANSFORMS = ['template']
+
+# compiled transform functions keyed on element key, and chains (lists
+# of functions) keyed on the tuple of their element keys
+_transformFunctions = {}
+_transformChains = {}
+
 class OutputTransform(object):
     """ Initialises, manages and processes the transformation
-of results from source to target. """
+of results from source to target. 
+
+Chains are compiled through a cache shared by all services: services
+declaring the same chain share one list of transform functions. A chain
+that cannot be compiled raises ServiceConfigurationError. """
     def __init__(self, overrideOpts, methodProperties):
         self.transformChains = {}
         # pull out all transforms, get instances 
@@ -221,8 +303,42 @@ of results from source to target. """
             if not k.startswith('transform.'):
                 continue
             target = k[10:]
-            transformChain = [eval(self.__clean(i)) for i in v]
-            self.transformChains[target] = transformChain
+            self.transformChains[target] = self.__chain(overrideOpts, v)
+        self.threaded = methodProperties.has_key('threadedTransform')
+
+    def __chain(self, overrideOpts, elements):
+        """ Return the compiled chain for the list of element 
+expressions, from the cache if it has been compiled already. """
+        keys = []
+        for element in elements:
+            expr = self.__clean(element)
+            if element.split('(')[0].strip() in INSTANCE_TRANSFORMS:
+                keys.append((expr, overrideOpts.get('resourceRoot'),
+                             overrideOpts.get('publishedName')))
+            else:
+                keys.append((expr,))
+        keys = tuple(keys)
+        try:
+            return _transformChains[keys]
+        except KeyError:
+            pass
+        chain = []
+        for key in keys:
+            try:
+                fn = _transformFunctions[key]
+            except KeyError:
+                try:
+                    fn = eval(key[0])
+                except Exception, ex:
+                    raise ServiceConfigurationError( \
+                        "Cannot compile output transform %s" % key[0], ex)
+                if not callable(fn):
+                    raise ServiceConfigurationError( \
+                        "Output transform %s is not callable" % key[0])
+                _transformFunctions[key] = fn
+            chain.append(fn)
+        _transformChains[keys] = chain
+        return chain
             
     def __clean(self, method):
         """ Takes an element of the transform chain as written in a
@@ -239,6 +355,17 @@ This adds the parantheses effectively.
             ix+=1
             return "%soverrideOpts, %s" % (method[:ix], method[ix:])
 
+    def isExpensive(self, target):
+        """ Return True if the chain for target should not be run in the
+event loop: the method is so marked or the chain includes an expensive
+transform. """
+        if self.threaded:
+            return True
+        for fn in self.transformChains.get(target, []):
+            if getattr(fn, 'expensive', False):
+                return True
+        return False
+
     def transform(self, target, value, opts):
         """ Transform value through the transform chain for the specified
 target. """
@@ -29,6 +29,15 @@ This module defines three ready-made event handlers of use:
     logger with which it was initialised.
 """
 from peloton.exceptions import MessagingError
+from peloton.exceptions import ConfigurationError
+from twisted.spread.pb import Referenceable
+from twisted.spread.pb import PBConnectionLost
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred
+from twisted.internet.defer import succeed
+from twisted.python.failure import Failure
+from weakref import WeakValueDictionary
+from collections import deque
 
 class AbstractEventHandler(object):
     """ Base class for all event handlers. """
@@ -68,7 +77,8 @@ completely isolated from the external bus.
         externalBus = self.kernel.plugins['eventbus']
         setattr(self, 'register', externalBus.register)
         setattr(self, 'deregister', externalBus.deregister)
-        setattr(self, 'fireEvent', externalBus.fireEvent)
+        setattr(self, 'fireConfirmedEvent', externalBus.fireEvent)
+        setattr(self, 'fireEvent', self._fireEvent)
         setattr(self, 'getRegisteredExchanges', externalBus.getRegisteredExchanges)
         
         # push through any pre-init registrations
@@ -142,10 +152,36 @@ the external event bus 'register' being hooked in. """
 as the external event bus is initialised. """
         self.preInitEvents.append((args, kwargs))
 
+    def fireConfirmedEvent(self, *args, **kwargs):
+        """ Temporary method that collects events to be fired as soon
+as the external event bus is initialised. Once it is, events are fired 
+on the bus and its deferred, if any, returned: it fails should the event 
+not be published. """
+        self.preInitEvents.append((args, kwargs))
+
+    def _fireEvent(self, key, exchange='events', **kwargs):
+        """ Fire an event on the external bus for a caller that does
+not wait on the outcome; a failure to publish it is logged. """
+        d = self.fireConfirmedEvent(key, exchange, **kwargs)
+        if isinstance(d, Deferred):
+            logFireFailure(d, self.kernel.logger, key, exchange)
+        return d
+
     def getRegisteredExchanges(self):
         """ Temporary method that returns an empty list. """
         return []
 
+def logFireFailure(d, logger, key, exchange):
+    """ Add to d, the deferred for an event fired on the bus, an errback
+that logs a failure to publish the event and returns None. Most callers of
+fireEvent ignore the deferred; a failure left in it would be reported as
+an unhandled error when it is garbage collected. The dispatcher does this
+for all but fireConfirmedEvent. Returns d. """
+    def _failed(err):
+        logger.error("Could not fire event %s on %s: %s" % \
+                     (key, exchange, err.getErrorMessage()))
+    return d.addErrback(_failed)
+
 class AbstractEventBusPlugin(object):
     """ Define all methods that the plugins must provide
 to be a valid profider for the dispatcher. 
@@ -167,7 +203,11 @@ was bound. """
     def fireEvent(self, key, exchange='events', **kargs):
         """ Fire an event on the specified exchange with the 
 specified routing key. All other keyword arguments are made
-into the event message. """
+into the event message. A plugin that can confirm receipt of the
+event by the bus returns a deferred that fires once it has, or fails if
+the event could not be published; the dispatcher logs such failures for
+callers that do not wait (see logFireFailure). MessagingError may be 
+raised if the event cannot be accepted at all. """
         raise NotImplementedError
 
 class DebugEventHandler(AbstractEventHandler):
@@ -194,14 +234,185 @@ will simply pass the call through. """
 class RemoteEventHandler(AbstractEventHandler):
     """Server side handler that takes a Referenceable that
 provides remote_eventReceived and reflects the call through.
-This is the proxy for a remote handler. """
-    def __init__(self, remoteHandler):
+This is the proxy for a remote handler. 
+
+Events are passed through a SubscriberQueue which bounds the number held 
+for, and in flight to, the remote handler; see SubscriberQueue for the 
+meaning of the remaining arguments. If batchWindow is greater than zero 
+events are delivered in batches through remote_eventsReceived."""
+    def __init__(self, remoteHandler, batchWindow=0, batchSize=100, 
+                 maxQueued=1000, overflow='dropoldest', name=''):
         AbstractEventHandler.__init__(self)
         self.remoteHandler = remoteHandler
+        self.queue = SubscriberQueue(remoteHandler, batchWindow, batchSize,
+                                     maxQueued, overflow, name)
         
     def eventReceived(self, msg, exchange='', key='', ctag=''):
-        self.remoteHandler.callRemote('eventReceived', msg, exchange, \
-                                      key, ctag)
+        self.queue.add(msg, exchange, key, ctag)
+
+# all live SubscriberQueues, for reporting
+_subscriberQueues = WeakValueDictionary()
+
+def getSubscriberStats():
+    """ Return a list of the statistics dictionaries of all live 
+SubscriberQueues. """
+    return [q.getStats() for q in _subscriberQueues.values()]
+
+class SubscriberQueue(object):
+    """ Bounded send buffer for events destined for a remote subscriber.
+
+At most maxInFlight messages are sent to the subscriber without being
+acknowledged; further events wait in the queue. If maxQueued events are 
+already waiting when another arrives the overflow policy applies:
+
+    - dropoldest: discard the longest waiting event
+    - dropnewest: discard the new event
+    - disconnect: drop the subscriber's connection and discard it
+
+If window is zero each event is sent by itself to remote_eventReceived.
+Otherwise events are sent as lists of (msg, exchange, key, ctag) tuples to 
+remote_eventsReceived, a batch going window seconds after its first event 
+was queued or when size events are waiting, whichever is sooner.
+
+Once the subscriber is found to be dead, add raises DeadReferenceError 
+just as callRemote would so that the event bus discards it. Counts of
+events sent and dropped are kept and reported by getStats."""
+    #: default limit on messages sent but not acknowledged
+    MAX_IN_FLIGHT = 10
+    OVERFLOW_POLICIES = ['dropoldest', 'dropnewest', 'disconnect']
+
+    def __init__(self, remoteRef, window=0, size=100, maxQueued=1000, 
+                 overflow='dropoldest', name=''):
+        if overflow not in SubscriberQueue.OVERFLOW_POLICIES:
+            raise ConfigurationError("Invalid overflow policy %s: must be one of %s" \
+                                     % (overflow, str(SubscriberQueue.OVERFLOW_POLICIES)))
+        self.remoteRef = remoteRef
+        self.window = window
+        self.size = size
+        self.maxQueued = maxQueued
+        self.maxInFlight = SubscriberQueue.MAX_IN_FLIGHT
+        self.overflow = overflow
+        self.name = name
+        self.events = deque()
+        self.flushCall = None
+        # set when the window for the events waiting has closed
+        self.due = False
+        self.inFlight = 0
+        self.sent = 0
+        self.dropped = 0
+        self.dead = False
+        # deferreds waiting for the queue to empty
+        self.drainWaiters = []
+        _subscriberQueues[id(self)] = self
+        
+    def add(self, msg, exchange='', key='', ctag=''):
+        if self.dead:
+            raise DeadReferenceError("Event subscriber has gone")
+        if len(self.events) >= self.maxQueued:
+            self.dropped += 1
+            if self.overflow == 'dropnewest':
+                return
+            elif self.overflow == 'dropoldest':
+                self.events.popleft()
+            else:
+                self.disconnect()
+                raise DeadReferenceError("Slow event subscriber disconnected")
+        self.events.append((msg, exchange, key, ctag))
+        self._send()
+            
+    def flush(self):
+        """ Send buffered events as soon as the in-flight limit allows. """
+        if self.flushCall and self.flushCall.active():
+            self.flushCall.cancel()
+        self.flushCall = None
+        self.due = True
+        self._send()
+
+    def _send(self):
+        while self.events and not self.dead and \
+              self.inFlight < self.maxInFlight:
+            if self.window <= 0:
+                event = self.events.popleft()
+                method, args, count = 'eventReceived', event, 1
+            elif len(self.events) >= self.size or self.due:
+                popleft = self.events.popleft
+                batch = [popleft() for i in 
+                         xrange(min(self.size, len(self.events)))]
+                method, args, count = 'eventsReceived', (batch,), len(batch)
+            else:
+                if not self.flushCall:
+                    self.flushCall = reactor.callLater(self.window, self.flush)
+                return
+            try:
+                d = self.remoteRef.callRemote(method, *args)
+            except DeadReferenceError:
+                self._died()
+                return
+            self.inFlight += 1
+            self.sent += count
+            d.addBoth(self._delivered)
+        if not self.events:
+            self.due = False
+            self._drained()
+
+    def whenDrained(self):
+        """ Return a deferred that fires once all the events now waiting
+have been passed to the connection to the subscriber or discarded. """
+        if not self.events:
+            return succeed(None)
+        d = Deferred()
+        self.drainWaiters.append(d)
+        return d
+
+    def _drained(self):
+        waiters, self.drainWaiters = self.drainWaiters, []
+        for d in waiters:
+            d.callback(None)
+
+    def _delivered(self, rv):
+        self.inFlight -= 1
+        if isinstance(rv, Failure) and \
+           rv.check(PBConnectionLost, DeadReferenceError):
+            self._died()
+        else:
+            self._send()
+        
+    def _died(self):
+        self.dead = True
+        self.dropped += len(self.events)
+        self.events.clear()
+        self._drained()
+        if self.flushCall and self.flushCall.active():
+            self.flushCall.cancel()
+        self.flushCall = None
+
+    def disconnect(self):
+        """ Drop the connection to the subscriber. """
+        self._died()
+        try:
+            self.remoteRef.broker.transport.loseConnection()
+        except AttributeError:
+            pass
+
+    def getStats(self):
+        return {'name' : self.name,
+                'queued' : len(self.events),
+                'inFlight' : self.inFlight,
+                'sent' : self.sent,
+                'dropped' : self.dropped,
+                'overflow' : self.overflow,
+                'dead' : self.dead}
+
+class EventReceiver(Referenceable):
+    """ Base class for Referenceables that receive events from a PSC. 
+Sub-classes implement remote_eventReceived; batches of events sent
+to remote_eventsReceived are unpacked and passed to it one by one. """
+    def remote_eventReceived(self, msg, exchange, key, ctag):
+        raise NotImplementedError
+
+    def remote_eventsReceived(self, events):
+        for msg, exchange, key, ctag in events:
+            self.remote_eventReceived(msg, exchange, key, ctag)
                 
 from Queue import Queue        
 class QueueEventHandler(AbstractEventHandler, Queue):
@@ -5,6 +5,8 @@
 # See LICENSE for details
 """ All Peloton exceptions """
 
+from twisted.spread import pb
+
 class PelotonError(Exception):
     """ Base for all Peloton exceptions; can be used on its own
 if no other exception is suitable. """
@@ -60,6 +62,15 @@ class NoWorkersError(PelotonError):
 class NoWorkersError(PelotonError):
     pass
 
+class WorkerBusyError(PelotonError, pb.Error):
+    """ Raised by a worker that is already running its maximum number
+of concurrent calls and has a full queue of calls waiting. The call was
+not started so may safely be retried elsewhere. 
+
+As a pb.Error it is passed to the PSC as an expected error rather than
+logged by the worker with a traceback. """
+    pass
+
 class DeadPeerError(PelotonError):
     pass
 
@@ -10,6 +10,7 @@ import os
 import random
 import socket
 import subprocess
+import threading
 import time
 import uuid
 
@@ -18,8 +19,11 @@ import peloton.utils.logging as logging
 from twisted import __version__ as twistedVersion
 from twisted.internet import reactor
 from twisted.internet.task import LoopingCall
+from twisted.internet.defer import Deferred
+from twisted.internet.defer import DeferredSemaphore
 from twisted.internet.threads import deferToThread
 from twisted.spread import pb
+from twisted.python.failure import Failure
 
 from peloton.base import HandlerBase
 from peloton.utils.config import PelotonSettings
@@ -28,14 +32,16 @@ from peloton.events import MethodEventHandler
 from peloton.utils import crypto
 from peloton.utils import getClassFromString
 from peloton.utils import getExternalIPAddress
-from peloton.utils.structs import RoundRobinList
+from peloton.utils.structs import LeastLoadedList
 from peloton.mapping import ServiceLoader
 from peloton.mapping import RoutingTable
 from peloton.mapping import ServiceLibrary
+from peloton.utils.transforms import templateCache
 from peloton.exceptions import ConfigurationError
 from peloton.exceptions import PluginError
 from peloton.exceptions import WorkerError
 from peloton.exceptions import NoWorkersError
+from peloton.exceptions import WorkerBusyError
 
 from sets import Set
 
@@ -49,6 +55,8 @@ coreIO interfaces.
 
     #: List of classes that provide IO adapters for the Peloton node.
     __PRIMARY_ADAPTERS__ = ["peloton.adapters.pb.PelotonPBAdapter",]
+    #: Adapter started if the profile accepts RPC over the message bus.
+    __BUS_ADAPTERS__ = ["peloton.adapters.bus.PelotonBusAdapter",]
     
     def __init__(self, settings):
         """ Prepare the kernel."""
@@ -71,6 +79,26 @@ coreIO interfaces.
         self.pwp = os.path.split(__file__)[0] + os.sep + 'pwp.py'
         if not os.path.isfile(self.pwp):
             raise Exception("Cannot find worker process launcher %s!" % self.pwp)
+
+        # the zygote forks pre-initialised workers; see peloton.zygote.
+        # Started in start() once we know our address. Writes to its
+        # command pipe come from launcher threads so are serialised.
+        self.zygotePath = os.path.split(__file__)[0] + os.sep + 'zygote.py'
+        self.zygote = None
+        self.zygoteLock = threading.Lock()
+
+        # the request interfaces of all adapters run expensive output
+        # transforms in threads through this limiter, at most 
+        # transformThreads (default 4) at once.
+        threads = 4
+        if settings.has_key('transformThreads'):
+            threads = int(settings.transformThreads)
+        self.transformLimiter = DeferredSemaphore(threads)
+
+        # channel on which replies to bus RPC requests arrive; made on 
+        # demand by peloton.pscproxies.getBusReplyChannel
+        self.busReplyChannel = None
+        templateCache.configure(settings)
         
     def start(self):
         """ Start the Twisted event loop. This method returns only when
@@ -119,6 +147,9 @@ The method returns only when the reactor stops.
         self.profile['port'] = self.profile['bind_port']        
         self.profile['hostname'] = socket.getfqdn()
         self._startAdapters(self.settings.adapters)
+        if self.profile.has_key('rpc') and 'bus' in self.profile['rpc']:
+            self._startAdapters(PelotonKernel.__BUS_ADAPTERS__)
+        self._startZygote()
 
         # (4) Start any kernel plugins, e.g. message bus, shell and
         #     then instruct the dispatcher to get the external bus
@@ -172,14 +203,18 @@ key. Keyfile is relative to the config file or an absolute path"""
                     pass
 
             self.logger.info("Notifying domain")
-            self.routingTable.notifyDisconnect()
-            # this  is a really cheap and nasty hack - 
-            # not putting in this delay meant that sometimes
-            # the notification above would not get out before
-            # the application quit. need to look to using ACK
-            # in the message bus.
-            reactor.callLater(1, self.closedown, 1)
+            d = self.routingTable.notifyDisconnect()
+            if isinstance(d, Deferred):
+                # wait for the bus to acknowledge the notification,
+                # but not for ever.
+                timeout = reactor.callLater(5, self.closedown, 1)
+                d.addBoth(self._disconnectAcknowledged, timeout)
+            else:
+                # the bus gives no acknowledgement; allow a moment
+                # for the notification to get out.
+                reactor.callLater(1, self.closedown, 1)
         elif x == 1:
+            self._stopZygote()
             self.logger.info("Stopping adapters")
             self._stopAdapters()
             self.logger.info("Stopping plugins")
@@ -187,6 +222,14 @@ key. Keyfile is relative to the config file or an absolute path"""
             # stop the reactor
             reactor.stop()
 
+    def _disconnectAcknowledged(self, rv, timeout):
+        if isinstance(rv, Failure):
+            self.logger.error("Could not notify domain of disconnect: %s" \
+                              % rv.getErrorMessage())
+        if timeout.active():
+            timeout.cancel()
+            self.closedown(1)
+
     def _startPlugins(self):
         """ Start plugins as in configuration adhering to the sort order
 implied by any plugin configurations specifying the 'order' attribute. """
@@ -313,32 +356,62 @@ hooks into the reactor. It is passed the entire config stack
 The number of workers is determined from the profile but can be overridden with 
 numWorkers if set. The previous service group for this service, if one was running,  is
 stopped by the process started here.
+
+In addition to the active workers, profile.launch.sparesperpsc (default 0)
+idle workers are started. These are fully initialised but take no requests
+until promoted to replace a dead worker.
 """
         profile, _ = self.serviceLibrary.getProfile(publishedName)
         if numWorkers == None:
             numWorkers = profile.launch.workersperpsc
+        if profile.launch.has_key('sparesperpsc'):
+            numSpares = int(profile.launch.sparesperpsc)
+        else:
+            numSpares = 0
+        if profile.launch.has_key('workerselection'):
+            policy = profile.launch.workerselection
+        else:
+            policy = 'leastoutstanding'
             
         self.workerStore[publishedName] = \
-            ServiceWorkerGroup(self, serviceName, publishedName)
+            ServiceWorkerGroup(self, serviceName, publishedName, policy)
             
         for i in xrange(numWorkers):
             self.startService(serviceName, publishedName, profile)
+        for i in xrange(numSpares):
+            self.startService(serviceName, publishedName, profile, spare=True)
         
-    def startService(self, serviceName, publishedName, profile=None):
+    def startService(self, serviceName, publishedName, profile=None, spare=False):
         """ Instruct start of a single worker process running service 
-named serviceName. """
+named serviceName. If spare is True the worker is held idle in the
+service worker group once started. """
         tok = crypto.makeCookie(20)
         if not profile:
             profile, _ = self.serviceLibrary.getProfile(publishedName)
         self.serviceLaunchTokens[tok] = [serviceName, 
-                                         profile]
+                                         profile,
+                                         spare]
         
         d = deferToThread(self._startWorkerProcess, tok)
         d.addCallback(self._workerStarted, serviceName)
 
     def _startWorkerProcess(self, token):
         """ Run in a thread by startService to spawn the 
-worker process and initialise. """
+worker process and initialise. Workers are forked from the zygote
+if it is running, otherwise started cold via pwp.py. """
+        self.zygoteLock.acquire()
+        try:
+            if self.zygote and self.zygote.poll() == None:
+                try:
+                    self.zygote.stdin.write("SPAWN %s\n" % token)
+                    self.zygote.stdin.flush()
+                    return
+                except IOError:
+                    self.logger.error("Zygote has gone: starting workers cold")
+                    self.zygote = None
+        finally:
+            self.zygoteLock.release()
+
         pipe= subprocess.Popen(['python', self.pwp, 
                           self.profile['ipaddress'], 
                           str(self.profile['port'])],
@@ -348,20 +421,57 @@ worker process and initialise. """
     def _workerStarted(self, _, service):
         self.logger.info("Workers spawned for %s" % service)
 
+    def _startZygote(self):
+        """ Start the zygote process from which workers are forked. Disabled
+by setting zygote=False in the PSC configuration; not available on platforms 
+without fork. """
+        if self.settings.has_key('zygote') and not self.settings.zygote:
+            self.logger.info("Zygote disabled: workers will be started cold")
+            return
+        if not hasattr(os, 'fork'):
+            self.logger.info("No fork on this platform: workers will be started cold")
+            return
+        try:
+            self.zygote = subprocess.Popen(['python', self.zygotePath,
+                                     self.profile['ipaddress'],
+                                     str(self.profile['port'])],
+                                     stdin=subprocess.PIPE)
+            self.logger.info("Zygote started; pid = %d" % self.zygote.pid)
+        except OSError, ex:
+            self.logger.error("Could not start zygote (%s): workers will be started cold" % str(ex))
+            self.zygote = None
+
+    def _stopZygote(self):
+        """ Closing the command pipe causes the zygote to exit. """
+        self.zygoteLock.acquire()
+        try:
+            if self.zygote:
+                try:
+                    self.zygote.stdin.close()
+                except IOError:
+                    pass
+                self.zygote = None
+        finally:
+            self.zygoteLock.release()
+
     def addWorker(self, ref, token):
         """ Store a reference to a worker keyed on name.
-Returns the name of the service referenced by this token"""
+Returns the name of the service referenced by this token and whether
+the worker is to be held as a spare."""
         try:
             launchRecord = self.serviceLaunchTokens[token]
         except KeyError:
             raise WorkerError("Invalid start request.")
 
-        serviceName, profile = launchRecord
+        serviceName, profile, spare = launchRecord
         publishedName = profile['publishedName']
         runtimeConfig = profile['_sysRunConfig']
-        self.workerStore[publishedName].addWorker(ref)
+        if spare:
+            self.workerStore[publishedName].addSpare(ref)
+        else:
+            self.workerStore[publishedName].addWorker(ref)
         del self.serviceLaunchTokens[token]
-        return serviceName, publishedName, runtimeConfig
+        return serviceName, publishedName, runtimeConfig, spare
     
     def getCallable(self, name):
         """ Return the callable as named"""
@@ -525,14 +635,32 @@ cookie jar of cookies > 30 seconds old. """
         
 class ServiceWorkerGroup(object):
     """ Manages workers for a service - keeps records of 
-all the PWP workers running a given service. """
+all the PWP workers running a given service. 
+
+The number of calls in flight on each worker is tracked (see callStarted
+and callFinished) so that getNextWorker may pick the worker with the fewest
+outstanding requests. The selection policy is one of:
+
+    - leastoutstanding: (default) the worker with fewest calls in flight;
+      ties are broken round robin.
+    - roundrobin: cycle through the workers regardless of load.
+"""
     
-    def __init__(self, kernel, serviceName, publishedName):
+    #: valid values for the policy argument to __init__
+    POLICIES = ['leastoutstanding', 'roundrobin']
+
+    def __init__(self, kernel, serviceName, publishedName, policy='leastoutstanding'):
         """ Initialise a workers store with the name of the service."""
         self.kernel = kernel
         self.serviceName = serviceName
         self.publishedName = publishedName
-        self.workers = RoundRobinList()
+        if policy not in ServiceWorkerGroup.POLICIES:
+            raise ConfigurationError("Invalid worker selection policy %s for %s" \
+                                     % (policy, publishedName))
+        self.policy = policy
+        self.workers = LeastLoadedList()
+        # idle, fully started workers ready to replace dead ones
+        self.spares = []
         self.started = time.time()
         self.__CLOSING = False
         self.__eventHandlerInstance = MethodEventHandler(self._workerLaunchedHandler)
@@ -558,6 +686,15 @@ start time, indicates a re-start and this group should closedown. """
     def addWorker(self, worker):
         """ Add a worker to the list."""
         self.workers.append(worker)
+        self._notifyWorkerLaunch()
+        
+    def addSpare(self, worker):
+        """ Hold a started worker in reserve. It takes no requests
+until promoted by notifyDeadWorker. """
+        self.spares.append(worker)
+        self._notifyWorkerLaunch()
+
+    def _notifyWorkerLaunch(self):
         self.kernel.dispatcher.fireInternalEvent("kernel.workerlaunch", 
                                                  serviceName = self.serviceName, 
                                                  publishedName = self.publishedName,
@@ -578,15 +715,36 @@ version """
         ix = random.randrange( len(workers) )
         return workers[ix]
     
-    def getNextWorker(self):
+    def getNextWorker(self, exclude=[]):
         """ Return a single worker from the pool for the latest
-version (picks in round-robin fashion from pool)."""
+version (picks according to the selection policy of this group). Workers
+in exclude, e.g. those that have just reported themselves busy, are
+passed over; WorkerBusyError is raised if that leaves none."""
         workers = self.getWorkers()
-        v = workers.rrnext()
+        if self.policy == 'roundrobin':
+            for i in xrange(len(workers)):
+                v = workers.rrnext()
+                if v not in exclude:
+                    break
+            else:
+                v = None
+        else:
+            v = workers.leastloaded(exclude)
         if v==None:
+            if exclude:
+                raise WorkerBusyError("All workers for %s busy" % self.publishedName)
             raise NoWorkersError("No workers for service!")
         return v
 
+    def callStarted(self, worker):
+        """ Record that a call has been dispatched to worker. """
+        self.workers.incr(worker)
+
+    def callFinished(self, worker):
+        """ Record that a call on worker has returned, with a result
+or error. """
+        self.workers.decr(worker)
+
     def removeWorker(self, worker):
         """ Remove the worker from this mapping, calling stop() on it
 as we go. Return True if worker was found and removed; False if not"""
@@ -601,25 +759,46 @@ as we go. Return True if worker was found and removed; False if not"""
             except:
                 pass
             return True
+        elif worker in self.spares:
+            self.spares.remove(worker)
+            return True
         else:
             return False
     
     def notifyDeadWorker(self, worker):
-        """ Remove this dead worker and trigger its replacement. """
+        """ Remove this dead worker and trigger its replacement. If a spare
+is available it is promoted immediately and a new spare started in its
+place. """
         try:
+            wasSpare = worker in self.spares
             if self.removeWorker(worker):
                 # replaces only if worker was still in the pool
-                self.kernel.startService(self.serviceName, self.publishedName)
+                if not wasSpare and self.spares:
+                    self._promoteSpare()
+                    wasSpare = True
+                self.kernel.startService(self.serviceName, self.publishedName,
+                                         spare=wasSpare)
             # else there were no occurences removed so this is likely already 
             # being re-stated.
         except NoWorkersError:
             # again; nothing to worry about as the re-start will be underway.
             pass
+    
+    def _promoteSpare(self):
+        """ Move a spare into the active pool and tell it to announce
+itself to the domain. """
+        spare = self.spares.pop(0)
+        self.workers.append(spare)
+        try:
+            spare.callRemote('activate').addErrback(lambda _: None)
+        except pb.DeadReferenceError:
+            self.notifyDeadWorker(spare)
                 
     def _checkHeartBeat(self):
         """ Iterate over all workers, calling check heart beat. """
         try:
-            deadWorkers = [p for p in self.workers if not p.checkBeat(threshold=2)]
+            deadWorkers = [p for p in self.workers+self.spares 
+                           if not p.checkBeat(threshold=2)]
             for p in deadWorkers:
                 self.notifyDeadWorker(p)
         except AttributeError:
@@ -634,5 +813,5 @@ as we go. Return True if worker was found and removed; False if not"""
         except:
             self.kernel.logger.debug("loopTimer.stop() called twice!")
         self.kernel.dispatcher.deregisterInternal(self.__eventHandlerInstance)
-        for worker in self.workers:
+        for worker in self.workers+self.spares:
             worker.callRemote('stop').addErrback(lambda _: None)        
@@ -15,16 +15,17 @@ a class in this module:
 The RoutingTable is required by all.
 """
 
-import random
 import time
 from peloton.events import MethodEventHandler
 from peloton.events import AbstractEventHandler
 from peloton.utils import crypto
-from peloton.utils.structs import RoundRobinList
+from peloton.utils.structs import WeightedSet
 from peloton.utils import getClassFromString
 from peloton.utils.config import PelotonSettings # needed for eval
 from peloton.profile import ServicePSCComparator
 from peloton.exceptions import NoWorkersError
+from peloton.exceptions import ServiceConfigurationError
+from peloton.coreio import OutputTransform
 from peloton.pscproxies import LocalPSCProxy
 from peloton.pscproxies import PSC_PROXIES
 
@@ -72,7 +73,15 @@ by another node. """
         if msg['action'] == 'requestForLaunch':
             msg['serviceProfile'] = eval(msg['serviceProfile'])
             # store service profile in the library
-            self.kernel.serviceLibrary.setProfile(msg['serviceProfile'])
+            try:
+                self.kernel.serviceLibrary.setProfile(msg['serviceProfile'])
+            except ServiceConfigurationError, ex:
+                self.logger.error("Cannot register service %s: %s" % \
+                                  (msg['serviceProfile']['publishedName'], str(ex)))
+                self.dispatcher.fireEvent(msg['callback'],
+                                          'domain_control',
+                                          action='SERVICE_PSC_NOMATCH')
+                return
             
             self.logger.debug("Request to consider ability to launch service: %s (%s) as %s" % (msg['serviceProfile']['name'], msg['serviceProfile']['version'], msg['serviceProfile']['publishedName']))
             if self.spComparator.eq(msg['serviceProfile']['psclimits'], self.kernel.profile, optimistic=True):
@@ -210,18 +219,28 @@ handy utility methods. """
         PelotonSettings.__init__(self, *args, **kwargs)
         self.__profiles = {}
         
-        # holds transform chains as evaluated on the fly in coreio
+        # holds the OutputTransform of each method, keyed on published name
         self.__outputTransforms = {}
         
     def setProfile(self, profile):
-        """ Sets the profile into the tree."""
-        self.__profiles[profile['publishedName']] = profile
-        self.__outputTransforms[profile['publishedName']] = {}
-        
+        """ Sets the profile into the tree and compiles the output 
+transform chains of its methods. If a chain cannot be compiled 
+ServiceConfigurationError is raised and the profile is not set."""
+        instanceInfo = {"resourceRoot" : profile["resourceRoot"],
+                        "publishedName" : profile["publishedName"]}
+        transforms = {}
         # evaluate some of the stringified entries
         for method in profile['methods'].keys():
-            profile['methods'][method]['properties'] = \
-                eval(profile['methods'][method]['properties'])
+            properties = eval(profile['methods'][method]['properties'])
+            profile['methods'][method]['properties'] = properties
+            try:
+                transforms[method] = OutputTransform(instanceInfo, properties)
+            except ServiceConfigurationError, ex:
+                raise ServiceConfigurationError( \
+                    "Method %s of service %s: %s" % \
+                    (method, profile['publishedName'], str(ex)))
+        self.__profiles[profile['publishedName']] = profile
+        self.__outputTransforms[profile['publishedName']] = transforms
 
     def getProfile(self, publishedName):
         """ Return the specified profile and transform cache."""
@@ -232,6 +251,86 @@ handy utility methods. """
     def __repr__(self):
         return("ServiceLibrary(%s)" % str(self) )
 
+class RandomRoutingPolicy(object):
+    """ Routing policy that picks a handler for a service at random,
+weighted by the number of workers each PSC runs for the service. """
+    def __init__(self, routingTable, settings):
+        self.routingTable = routingTable
+
+    def choose(self, handlers):
+        """ Return the proxy to use given the WeightedSet of handler
+GUIDs for a service. """
+        return self.routingTable.pscByGUID[handlers.choice()]
+
+class LatencyRoutingPolicy(RandomRoutingPolicy):
+    """ Power-of-two-choices routing: two handlers are drawn as for the 
+RandomRoutingPolicy and the one with the lower expected cost is used. The 
+cost of a proxy is the moving average of its call latency multiplied by 
+one more than the number of calls outstanding on it and by one more than 
+the number of calls since its last success that failed for want of a 
+connection or a worker. Errors raised by services do not count against 
+the PSC.
+
+A proxy yet to complete a call is costed at the mean latency of the 
+proxies that have, or at DEFAULT_LATENCY if none have; a new peer is 
+therefore tried while it is no busier than the rest, but a peer that 
+hangs on its first calls accumulates outstanding calls and is avoided.
+
+The cost of the local proxy is multiplied by the routingLocalBias setting
+(default 0.5) so that, with local workers available, calls stay on this
+node unless a peer is doing significantly better.
+"""
+    #: latency (seconds) assumed when no proxy has completed a call
+    DEFAULT_LATENCY = 0.1
+
+    def __init__(self, routingTable, settings):
+        RandomRoutingPolicy.__init__(self, routingTable, settings)
+        if settings.has_key('routingLocalBias'):
+            self.localBias = float(settings.routingLocalBias)
+        else:
+            self.localBias = 0.5
+
+    def priorLatency(self):
+        """ Return the latency to assume for a proxy that has not yet 
+completed a call: the mean over the proxies that have. """
+        known = [p.latency for p in self.routingTable.pscByGUID.values()
+                 if p.latency != None]
+        if not known:
+            return LatencyRoutingPolicy.DEFAULT_LATENCY
+        return sum(known) / len(known)
+
+    def cost(self, proxy):
+        latency = proxy.latency
+        if latency == None:
+            latency = self.priorLatency()
+        cost = latency * (proxy.outstanding + 1) * (proxy.callFailures + 1)
+        if isinstance(proxy, LocalPSCProxy):
+            cost *= self.localBias
+        return cost
+
+    def choose(self, handlers):
+        first = handlers.choice()
+        second = first
+        if len(handlers) > 1:
+            # make a few attempts at a distinct second candidate; a 
+            # heavily weighted handler may be drawn twice otherwise.
+            for i in xrange(3):
+                second = handlers.choice()
+                if second != first:
+                    break
+        pa = self.routingTable.pscByGUID[first]
+        if second == first:
+            return pa
+        pb = self.routingTable.pscByGUID[second]
+        if self.cost(pb) < self.cost(pa):
+            return pb
+        return pa
+
+#: routing policies by name as may be set with routingPolicy in
+#: the PSC configuration. A full class path may be given instead.
+ROUTING_POLICIES = {'random'  : RandomRoutingPolicy,
+                    'latency' : LatencyRoutingPolicy}
+
 class RoutingTable(object):
     """ Maintain a live database of all PSCs in the domain complete with their
 profiles, the list of all services that they run and a library of all service profiles. 
@@ -255,6 +354,15 @@ to broadcasts from other new PSCs. The protocol runs as follows:
        case the PSC exits.
        
 Profiles received are logged into the routing table.
+
+Handlers for each service are held in pscByService as a WeightedSet of PSC
+GUIDs, the weight of each being the number of workers that PSC runs for the
+service. servicesByGUID indexes the other way so that removing a PSC 
+touches only the services it provides.
+
+Which handler serves a request is decided by the routing policy named by
+routingPolicy in the PSC configuration (see ROUTING_POLICIES); the default 
+is 'latency'.
 """
 
     def __init__(self, kernel):
@@ -263,7 +371,9 @@ Profiles received are logged into the routing table.
         self.dispatcher = kernel.dispatcher
         self.pscs=[]
         self.pscByService={}
+        self.servicesByGUID={}
         self.pscByGUID={}
+        self.policy = self._getRoutingPolicy(kernel.settings)
 
         self.addPSC(kernel.profile)
         self._setHandlers()
@@ -278,8 +388,10 @@ Profiles received are logged into the routing table.
                                 serviceList=self.kernel.routingTable.shortServiceList)
 
     def notifyDisconnect(self):
-        """ Call to unhook ourselves from the mesh """
-        self.dispatcher.fireEvent(key="psc.presence",
+        """ Call to unhook ourselves from the mesh. Returns whatever the
+event bus returns from fireEvent, which may be a deferred acknowledging 
+the event or failing if it could not be published. """
+        return self.dispatcher.fireConfirmedEvent(key="psc.presence",
                                   exchange="domain_control",
                                   action='disconnect')
 
@@ -358,6 +470,19 @@ We need to update the routing table. """
             self.logger.info("Service %s stopped on %s" % (msg['publishedName'], msg['sender_guid']))
             
     
+    def _getRoutingPolicy(self, settings):
+        """ Return an instance of the configured routing policy. """
+        if settings.has_key('routingPolicy'):
+            policy = settings.routingPolicy
+        else:
+            policy = 'latency'
+        if ROUTING_POLICIES.has_key(policy):
+            clazz = ROUTING_POLICIES[policy]
+        else:
+            clazz = getClassFromString(policy)
+        self.logger.info("Routing policy: %s" % policy)
+        return clazz(self, settings)
+
     def _getProxyForProfile(self, profile):
         """ Return a proxy appropriate for the PSC described by this profile."""
 
@@ -376,8 +501,7 @@ We need to update the routing table. """
         else:
             for r in rpcAllowed:
                 if PSC_PROXIES.has_key(r):
-                    return PSC_PROXIES.has_key(r)
-                    break
+                    return PSC_PROXIES[r]
             else:
                 raise Exception("No suitable proxy for profile.")
     
@@ -409,13 +533,11 @@ We need to update the routing table. """
         self.logger.info("Removing PSC: %s" % guid)
         proxy.stop()
         
-        # iter over services and remove from proxy by service
-        # with removeHandlerForService
-        for service, handlers in self.pscByService.items():
-            while proxy in handlers:
+        # remove from only those services this PSC provides
+        if self.servicesByGUID.has_key(guid):
+            for service in list(self.servicesByGUID[guid]):
                 self.logger.info("Removing PSC %s for service %s" % (guid, service))
-                n=len(handlers)
-                handlers.remove(proxy)
+                self.removeHandlerForService(service, guid=guid, removeAll=True)
                         
         del(self.pscByGUID[guid])
         self.pscs.remove(proxy)
@@ -450,68 +572,63 @@ We need to update the routing table. """
             self.addHandlerForService(svc, proxy=pscProxy)
      
     def getPscProxyForService(self, service):
-        """ Return a PSC Proxy for the named service at random from the
-list of available proxies. """
+        """ Return a PSC Proxy for the named service, chosen from the 
+available proxies by the routing policy. """
         try:
-            proxies = self.pscByService[service]
-            np = len(proxies)
-            if np == 0:
+            handlers = self.pscByService[service]
+            if not handlers:
                 del(self.pscByService[service])
                 raise KeyError
-            ix = random.randrange(np)
-            return proxies[ix]
+            return self.policy.choose(handlers)
         except KeyError:
             raise NoWorkersError("No Proxy for service %s" % service)
 
     def removeHandlerForService(self, service, guid=None, proxy=None, removeAll=False):
-        """ Remove proxy from the list of proxies available for this 
-service. Note that the list of proxies will include multiple references to
-the same proxy if more than worker is associated with the PSC referenced.
-
-Remove will remove only one of these which is the correct behaviour as
-remove is called once per signal received from a dying worker. 
-
-If you really do want all proxies removed, specify removeAll=True"""
-        if guid and not proxy:
-            try:
-                proxy = self.pscByGUID[guid]
-            except KeyError:
-                # guess it's already gone!
-                return
+        """ Remove one unit of weight from the PSC referenced by guid or proxy
+as a handler for this service. The weight is the number of workers the PSC
+runs for the service so one unit is removed per signal received from a
+dying worker.
+
+If you really do want the PSC removed as a handler, specify removeAll=True"""
+        if proxy and not guid:
+            guid = proxy.profile['guid']
     
         try:
-            proxies = self.pscByService[service]
-            if removeAll:
-                while proxy in proxies:
-                    proxies.remove(proxy)
-            else:
-                proxies.remove(proxy)
-        except ValueError:
-            pass
+            handlers = self.pscByService[service]
         except KeyError:
-            pass
+            return
+
+        if removeAll:
+            handlers.remove(guid, None)
+        else:
+            handlers.remove(guid)
+
+        if guid not in handlers and self.servicesByGUID.has_key(guid):
+            self.servicesByGUID[guid].discard(service)
+            if not self.servicesByGUID[guid]:
+                del(self.servicesByGUID[guid])
+        if not handlers:
+            del(self.pscByService[service])
 
     def addHandlerForService(self, serviceName, guid=None, proxy=None):
         """ Add the handler for the PSC referenced by guid as a handler
 for the named service. 
 
-Because one event is fired for every *worker* that is launched by a PSC, the
-lists of handlers for each service will contain multiple references to the
-same proxy on account of it having n workers to reference at the other end.
-
-This isn't so bad as it naturally introduces an element of weighting. To
-ensure that one host doesn't get unduly hit in the event of round robin
-routing we insert the new entries into a random point in the list.
+One event is fired for every *worker* that is launched by a PSC so each
+call adds one unit to the weight of the PSC for this service.
 """
-        if guid and not proxy:
-            proxy = self.pscByGUID[guid]
+        if proxy and not guid:
+            guid = proxy.profile['guid']
+        elif not self.pscByGUID.has_key(guid):
+            raise KeyError("Unknown PSC %s" % guid)
 
         if not self.pscByService.has_key(serviceName):
-            self.pscByService[serviceName] = []
-        handlers = self.pscByService[serviceName]
-        
-        insertPoint = random.randint(0, len(handlers))
-        handlers.insert(insertPoint, proxy)
+            self.pscByService[serviceName] = WeightedSet()
+        self.pscByService[serviceName].add(guid)
+
+        if not self.servicesByGUID.has_key(guid):
+            self.servicesByGUID[guid] = set()
+        self.servicesByGUID[guid].add(serviceName)
         
     def _getShortServiceList(self):
         """ Return a list only of service names. """
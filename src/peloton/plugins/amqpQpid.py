@@ -10,34 +10,49 @@ from peloton.events import AbstractEventBusPlugin
 from peloton.events import AbstractEventHandler
 from peloton.exceptions import MessagingError
 from peloton.exceptions import ConfigurationError
-from twisted.internet import reactor
-from twisted.internet.defer import DeferredQueue
+from peloton.plugins.support.amqpio import MultiplexedConsumer
+from peloton.plugins.support.amqpio import BatchPublisher
 
 import qpid
-from qpid.queue import Closed
 from qpid.client import Client
 from qpid.content import Content
 
 import cPickle as pickle
-import threading
 import sys
 import os
 import time
 
+class ConsumerClient(Client):
+    """ A QPID Client that delivers the messages for all its consumers
+into the one inbox, rather than a queue per consumer tag. """
+    def __init__(self, inbox, *args, **kwargs):
+        Client.__init__(self, *args, **kwargs)
+        self.inbox = inbox
+
+    def queue(self, key):
+        return self.inbox
+
 class AMQPEventBus(PelotonPlugin,AbstractEventBusPlugin):
     """Uses Python-QPID to hook into the AMQP event bus, most probably
 provided by RabbitMQ but potentially any provider. 
 
 The QPID is not Twisted based and provides a blocking handler 
-for receiving messages off the bus. 
-
-This plugin needs to be superceded by one based on a Twisted AMQP 
-protocol handler for greater efficiency in this environment. As it
-stands one thread is used per routing_key being listened for and in
-the event that subscribers do not de-register, threads will be consumed
-at an un-wholesome rate.
-
-@todo - purging of threads with no real listeners behind them?
+for receiving messages off the bus. All subscriptions are consumed 
+over the one connection, which puts every message into a single inbox; 
+one MultiplexedConsumer thread reads that and passes messages in batches
+of up to consumerbatch (default 100) to the reactor thread, where 
+_processQueue dispatches them by consumer tag.
+
+Events are published from a BatchPublisher thread on a channel of their 
+own, in batches of up to publishbatch (default 100), so that fireEvent 
+does not block the reactor. At most maxpending (default 10000) events may
+wait to be published; beyond that fireEvent raises MessagingError. If 
+confirm is set the publishing channel is transactional and each batch is 
+committed, so the deferred returned by fireEvent fires once the broker has
+accepted the event. Should it not be published the deferred fails. getPublisherStats reports publish latency for each exchange.
+
+This plugin may yet be superceded by one based on a Twisted AMQP 
+protocol handler for greater efficiency in this environment.
 """
     def initialise(self):
         self.vhost = self.kernel.settings.messagingVHost
@@ -60,14 +75,32 @@ at an un-wholesome rate.
         
         # key is ctag; value is handler object
         self.handlersByCtag = {}
-        # key is <exchange>.<routing_key>; value is ctag
+        # key is <exchange>.<routing_key>; value is (ctag, queue name)
         self.ctagByQueue = {} 
         # key is handler, value is (exchange, routing_key, ctag)
         self.registeredHandlers = {}
         
+        if self.config.has_key('consumerbatch'):
+            self.consumerBatch = int(self.config.consumerbatch)
+        else:
+            self.consumerBatch = 100
+        self.ctagCounter = 0
+        if self.config.has_key('publishbatch'):
+            self.publishBatch = int(self.config.publishbatch)
+        else:
+            self.publishBatch = 100
+        if self.config.has_key('maxpending'):
+            self.maxPending = int(self.config.maxpending)
+        else:
+            self.maxPending = 10000
+        self.confirm = self.config.has_key('confirm') and self.config.confirm
+
     def start(self):
         specDir = os.sep.join(qpid.__file__.split('/')[:-2])+"/amqp_specs"
-        self.connection = Client(self.host, self.port, 
+        self.consumer = MultiplexedConsumer(self._processQueue, 
+                                            self.consumerBatch)
+        self.connection = ConsumerClient(self.consumer.inbox, 
+                        self.host, self.port, 
                         spec=qpid.spec.load('file://%s/amqp0-8.xml' % specDir), 
                         vhost=self.vhost)
 
@@ -81,21 +114,27 @@ at an un-wholesome rate.
 
         self.registeredExchanges = []
 
-        self.mqueue = DeferredQueue()        
-        self.mqueue.get().addCallback(self._processQueue)    
-        
         self.channel = self.connection.channel(1)
         self.channel.channel_open()
         for x,t in exchanges:
             self.channel.exchange_declare(exchange=x, type=t, auto_delete=False)
             self.registeredExchanges.append(x)
+        self.consumer.start()
+
+        # publishing is from another thread so needs a channel of its own
+        self.publishChannel = self.connection.channel(2)
+        self.publishChannel.channel_open()
+        commit = None
+        if self.confirm:
+            self.publishChannel.tx_select()
+            commit = self.publishChannel.tx_commit
+        self.publisher = BatchPublisher(self._publish, commit, 
+                                        self.publishBatch, self.maxPending)
+        self.publisher.start()
             
     def stop(self):
-        for _, _, q in self.ctagByQueue.values():
-            try:
-                q.close()
-            except:
-                pass
+        self.consumer.stop()
+        self.publisher.stop()
 
     def register(self, key, handler, exchange='events'):
         """ Register to receive events from the specified exchange (default 'events')
@@ -110,15 +149,16 @@ with all messages to be handled by a peloton.events.AbstractEventHandler instanc
             try:
                 qname, _, _ = self.channel.queue_declare(exclusive=True).fields
                 self.channel.queue_bind(queue=qname, exchange=exchange, routing_key=key)
-                ctag = self.channel.basic_consume(queue=qname, no_ack=True).consumer_tag
-                q = self.connection.queue(ctag)
-                self.ctagByQueue[queue] = (ctag, qname, q)
-                self._startListener(ctag, q)
+                self.ctagCounter += 1
+                ctag = "%s.%d" % (self.node_guid, self.ctagCounter)
+                self.channel.basic_consume(queue=qname, consumer_tag=ctag,
+                                           no_ack=True)
+                self.ctagByQueue[queue] = (ctag, qname)
             except Exception:
                 self.logger.error("Message published to closed exchange: %s/%s " % (exchange, key))
                 raise MessagingError("Message published to closed exchange: %s/%s " % (exchange, key))
         else:
-            ctag, qname, _ = self.ctagByQueue[queue]
+            ctag, qname = self.ctagByQueue[queue]
 
         record = (exchange, key, ctag, qname)
         try:
@@ -144,56 +184,56 @@ with all messages to be handled by a peloton.events.AbstractEventHandler instanc
             if not self.handlersByCtag[ctag]:
 #                self.channel.queue_delete(queue=qname)
                 del(self.handlersByCtag[ctag])
-                _, _, q = self.ctagByQueue[queue]
-                q.close()
+                try:
+                    self.channel.basic_cancel(consumer_tag=ctag)
+                except Exception:
+                    self.logger.error("Could not cancel consumer %s" % ctag)
                 del(self.ctagByQueue[queue])
 
         del(self.registeredHandlers[handler])
 
     def fireEvent(self, key, exchange='events', **kwargs):
         """ Fire an event with routing key 'key' on the specified
-exchange using kwargs to build the event message. """
+exchange using kwargs to build the event message. The event is queued
+to be published; the deferred returned fires once it has been (or 
+confirmed, if so configured) or fails if it could not be. 
+MessagingError is raised if too many events are waiting. """
         if exchange not in self.registeredExchanges:
             raise MessagingError("Exchange %s not valid" % exchange)
         kwargs.update({'sender_guid' : self.node_guid})
-        msg = Content(pickle.dumps(kwargs))
-        try:
-            self.channel.basic_publish(content=msg, exchange=exchange, 
-                         routing_key='%s.%s' % (self.domain, key))
-        except Exception:
-            self.logger.error("Message published to closed exchange: %s/%s " % (exchange, key))
-            raise MessagingError("Message published to closed exchange: %s/%s " % (exchange, key))
+        return self.publisher.publish(exchange, '%s.%s' % (self.domain, key),
+                                      pickle.dumps(kwargs))
+
+    def _publish(self, exchange, routing_key, body):
+        """ Called in the publisher thread. """
+        self.publishChannel.basic_publish(content=Content(body), 
+                                          exchange=exchange, 
+                                          routing_key=routing_key)
+
+    def getPublisherStats(self):
+        """ Return the statistics of the publisher; see 
+BatchPublisher.getStats. """
+        return self.publisher.getStats()
         
-    def _startListener(self, ctag, q):
-        """ Start a thread that listens for messages on a given 
-channel. On receipt of a message it is pushed onto self.mqueue for
-processing in the main Twisted event loop. """
-        def _qListener(mq):
-            while True:
-                try:
-                    v = q.get()
-                except Closed:
-                    # listener has been stopped
-                    break
-                except:
-                    self.logger.error("Qlistener forced close on %s" % ctag)
-                    break
-                reactor.callFromThread(mq.put, v)
-
-        mt = threading.Thread(target=_qListener, args=(self.mqueue,))
-        mt.setDaemon(True)
-        mt.start()
-
-    def _processQueue(self, msg):
-        """ Find all handlers for this message based on the consumer tag and
-pass the message to them. """
-        self.mqueue.get().addCallback(self._processQueue)
-        ctag, _, _, exchange, routing_key = msg.fields
-        # remove the domain name from the key
-        routing_key = '.'.join(routing_key.split('.')[1:])
-        content = pickle.loads(msg.content.body)
-        if self.handlersByCtag.has_key(ctag):
-            # may have been deleted already.
+    def _processQueue(self, msgs):
+        """ Passed a batch of messages by the consumer; find all handlers 
+for each message based on the consumer tag and pass the message to 
+them. Messages for consumers since cancelled are dropped, as are 
+messages that cannot be unpacked; the error is logged and the rest of the
+batch delivered. """
+        for msg in msgs:
+            try:
+                ctag, _, _, exchange, routing_key = msg.fields
+                if not self.handlersByCtag.has_key(ctag):
+                    # may have been deleted already.
+                    continue
+                # remove the domain name from the key
+                routing_key = '.'.join(routing_key.split('.')[1:])
+                content = pickle.loads(msg.content.body)
+            except Exception, ex:
+                self.logger.error("Dropping message that cannot be unpacked: %s" \
+                                  % str(ex))
+                continue
             handlersToGo = []
             for handler in self.handlersByCtag[ctag]:
                 try:
@@ -13,12 +13,24 @@ testing.
 from peloton.plugins import PelotonPlugin
 from peloton.events import AbstractEventBusPlugin
 from peloton.events import AbstractEventHandler
+from peloton.events import SubscriberQueue
+from peloton.events import EventReceiver
 from peloton.exceptions import ConfigurationError
 from peloton.exceptions import PluginError
 from twisted.internet import reactor
+from twisted.internet.defer import Deferred
+from twisted.internet.defer import succeed
+from twisted.internet.defer import DeferredList
 from twisted.internet.error import CannotListenError
+from twisted.internet.threads import deferToThread
+from twisted.python.failure import Failure
 from twisted.spread import pb
 import cPickle as pickle
+import struct
+import zlib
+import binascii
+import types
+import os
 
 class PseudoMQ(PelotonPlugin, AbstractEventBusPlugin):
     """ This plugin provides a fake AMQP provider with almost
@@ -28,12 +40,26 @@ no guarantee of anything. It's for testing.
 
 Read again: It's for testing.
 
-One node must be started as a server (flag 'mqserver' is set) and 
-all others must be clients (flag 'mqserver' is not set).
+One or more nodes must be started as servers (flag 'mqserver' is set) 
+and all others must be clients (flag 'mqserver' is not set). Each client 
+connects to the server given as host in its configuration.
 
 The system is run entirely over PB and cannot be used to simulate
 messaging between domains. This can only run a single domain.
 
+With more than one server, all list every server's host:port in their 
+'servers' configuration and the exchanges are shared out between them by 
+a hash of the exchange name. Each server links to each of the others as if
+it were a client: it registers with the owner of an exchange the keys
+for which its own clients have registered on that exchange, and sends 
+to the owner events fired on it by its clients, having delivered them 
+to its other clients itself. The owner then sends them to every other 
+server with matching registrations. Losing a server only loses its clients
+and the exchanges it owns; links to it reconnect when it returns. 
+Replay of a durable exchange is only possible from its owner, so a 
+client of another server re-registering on it only sees events that its
+server missed.
+
 If it is a server it creates the PseudoMQServer pb.Root object and
 publishes on the port specified in config.
 
@@ -50,61 +76,143 @@ the local handler as a recipient. In addition registration is made
 on the server with the PseudoMQClient provided as a handler. When an
 event is fired on the server it is sent to all its local listeners
 and all the remote handlers. The remote clients then pass that to 
-the plugin eventReceived which fires it on to all its local handlers.
+the link eventReceived which fires it on to all its local handlers.
+
+If a client, a fire event delivers the event straight to any matching 
+local handlers and also fires it on the server through a PseudoMQLink, 
+telling the server that it came from this client. The server then sends 
+it to every handler but that client, which has already had it. Events from one client therefore 
+reach its own handlers in the order fired, without a round trip to the 
+server. Events on exchanges listed in 'durable' are the exception: they 
+must carry the offset given by the server so are not short-circuited but 
+echoed back to the client that fired them.
 
-If a client, a fire event fires the event on the server directly then
-the above process takes place.
+On connecting, a PseudoMQLink registers all its subscriptions with the 
+server in a single call and then sends, in order and without waiting for
+each to be acknowledged, any events fired while it was not connected. 
+Should the connection be lost it reconnects with exponential backoff, 
+re-registering and re-sending un-acknowledged events in the same way.
 
 The PseudoExchange and PseudoQueue classes model exchanges and queues
 and just simplify the event firing procedure. PseudoExchange
 has to determine which queues to pass the event to based on the 
 event key and the queue keys. It has to match based on AMQP pattern
-matching rules; this is done with the matchKey method.
+matching rules; this is done by looking the key up in a TopicTrie 
+of the queue keys.
+
+The server sends events to each client through a bounded 
+SubscriberQueue (see peloton.events). The client chooses in its plugin 
+configuration how the server should treat it: batchwindow is the number of
+seconds over which events may be collected and sent together (default 0:
+no batching); maxqueued the most events held for it (default 1000) and 
+overflow what to do when that is exceeded (default dropoldest).
+
+Exchanges named in the 'durable' configuration list are backed by
+a DurableLog on the disk of the server that owns them, in directory logdir (default 
+<pscFolder>/pseudomq). Events fired on them are given an offset, (log id, 
+offset in the log), which is passed to handlers as the ctag, and are only
+delivered once on disk. Clients note the last offset they have received 
+for each subscription, discard any event they have already seen and, when
+re-registering, ask the server to replay from that offset any events they
+missed. Should the log be lost its id changes, and clients then drop 
+the offsets they hold and are sent all of the new log. fireEvent returns a 
+deferred that fires when the server has accepted the event - for a 
+durable exchange, once it is on disk. Client events not so acknowledged when the connection to the server
+is lost are fired again once it is restored.
 """
     def initialise(self):
         self.isServer = self.kernel.hasFlag('mqserver')
-        self.host, port = self.config.host.split(':')
-        try:
-            self.port = int(port)
-        except ValueError:
-            raise ConfigurationError("Cannot connect pseudomq to port: %s" % port)
-        
+        if self.config.has_key('batchwindow'):
+            self.batchWindow = float(self.config.batchwindow)
+        else:
+            self.batchWindow = 0
+        if self.config.has_key('maxqueued'):
+            self.maxQueued = int(self.config.maxqueued)
+        else:
+            self.maxQueued = 1000
+        if self.config.has_key('overflow'):
+            self.overflow = self.config.overflow
+        else:
+            self.overflow = 'dropoldest'
+        self.address = self.config.host
+        self.host, self.port = self._splitAddress(self.address)
+
+        # the servers sharing the exchanges, in the same order on each
+        if self.config.has_key('servers'):
+            self.servers = list(self.config.servers)
+            self.servers.sort()
+        else:
+            self.servers = [self.address]
+        if self.isServer and self.address not in self.servers:
+            raise ConfigurationError("PseudoMQ server %s not in servers list" \
+                                     % self.address)
+
+        # events fired on these exchanges are not delivered locally until
+        # echoed back by the server that owns the exchange, carrying 
+        # their offsets. Only that server logs them.
+        self.echoed = []
+        if self.config.has_key('durable'):
+            self.echoed = self.config.durable
+        self.durable = []
+        if self.isServer:
+            self.durable = [x for x in self.echoed 
+                            if self._owner(x) == self.address]
+        if self.config.has_key('logdir'):
+            self.logdir = self.config.logdir
+        elif self.durable:
+            self.logdir = os.path.join(self.kernel.settings.pscFolder, 'pseudomq')
+        self.logOptions = {}
+        for opt, key, cast in [('segmentSize', 'segmentsize', int),
+                               ('maxSegments', 'segments', int),
+                               ('syncInterval', 'syncinterval', float)]:
+            if self.config.has_key(key):
+                self.logOptions[opt] = cast(self.config[key])
+
+        # a client has a link to its server; a server has a link to each
+        # other server, keyed on its address
+        self.links = {}
+        if self.isServer:
+            for address in self.servers:
+                if address != self.address:
+                    self.links[address] = PseudoMQLink(self, address)
+        else:
+            self.links[self.address] = PseudoMQLink(self, self.address)
+
+        # the PseudoMQServer of a server and its listening port, once started
+        self.rootObj = None
+        self.connection = None
         self.exchanges={}
         # initialise with the three key exchanges
         for x in ['domain_control', 'events', 'logging']:
-            self.exchanges[x] = PseudoExchange(x)
+            self._addExchange(x)
         
     def start(self):
         if self.isServer:
-            self.connection = None
             self._startServer()
-        else:
-            self.connected = False
-            self.server=None
-            self._startClient()
-            self.registrationQueue = []
-            self.eventFiringQueue = []
+        for link in self.links.values():
+            link.start()
             
     def stop(self):
+        if self.isServer:
+            for exchange in self.exchanges.values():
+                if exchange.log:
+                    exchange.log.close()
         if self.isServer and self.connection:
             self.connection.stopListening()
-        elif self.server:
-            # must find out how to disconnet a client
-            pass
+        for link in self.links.values():
+            link.stop()
     
     def register(self, key, handler, exchange='events'):
 #        self.logger.debug("Registration called on %s.%s" % (exchange, key))
         try:
             self.exchanges[exchange].addQueue(key, handler)
         except KeyError:
-            self.exchanges[exchange] = PseudoExchange(exchange)
+            self._addExchange(exchange)
             self.exchanges[exchange].addQueue(key, handler)
             
-        if not self.isServer:
-            if self.connected:
-                self.server.callRemote('register', key, self.clientObj, exchange)
-            else:
-                self.registrationQueue.append((key, exchange))
+        link = self._linkFor(exchange)
+        if link:
+            link.register(key, exchange)
                 
     def deregister(self, handler):
         for exchange in self.exchanges.values():
@@ -113,48 +221,96 @@ matching rules; this is done with the matchKey method.
     def fireEvent(self, key, exchange='events', **kwargs):
         """ If I'm the server I fire to all my handlers, many
 of which will be remote. If I'm a client I call fireEvent on the
-server. """
+server. Returns a deferred that fires when the server has accepted
+the event, or fails if it could not be fired. """
 #        self.logger.debug("Fire event on %s.%s" % (exchange, key))
         if 'sender_guid' not in kwargs.keys():
             kwargs.update({'sender_guid' : self.kernel.guid})
-        if self.isServer:
-            try:
-                exchange = self.exchanges[exchange]
-                exchange.fireEvent(key, kwargs)
-            except KeyError:
-                # no registration for this exchange. hey ho.
-                pass
-        else:
-            if self.connected:
-                try:
-                    self.server.callRemote('fireEvent', key, exchange, pickle.dumps(kwargs))
-                except pb.DeadReferenceError:
-                    self.connected=False
-                    self.logger.error("Message server has gone!")
-                    self.eventFiringQueue.append((key, exchange, kwargs))
-            else:
-                self.eventFiringQueue.append((key, exchange, kwargs))
+        message = PseudoMessage(kwargs)
+        if self._linkFor(exchange):
+            # pickle before local handlers see the dict, in case
+            # they change it
+            message.getPickle()
+        d = self._publish(key, exchange, message)
+        if d == None:
+            return self._whenSent()
+        return d
+
+    def _whenSent(self):
+        """ Return a deferred that fires once an event fired on an 
+exchange owned by this server has been passed to the connections of all
+the clients to which it is to be sent. """
+        if not self.isServer or not self.rootObj:
+            return succeed(None)
+        queues = self.rootObj.subscribers.values()
+        return DeferredList([q.whenDrained() for q in queues])
+
+    def _publish(self, key, exchange, message):
+        """ Fire a message originating at this node or, on a server, at 
+one of its clients. If this server owns the exchange it is simply fired;
+if not, it is fired on local handlers and sent on to the owner, or for 
+an echoed exchange only sent on. Returns a deferred firing when the owner
+has accepted the message, or None. """
+        link = self._linkFor(exchange)
+        if not link:
+            return self._fireMessage(key, exchange, message)
+        echo = exchange in self.echoed
+        if not echo:
+            self._fireMessage(key, exchange, message)
+        return link.fire(key, exchange, message, echo)
 
     def getRegisteredExchanges(self):
         return self.exchanges.keys()
 
-    def eventReceived(self, msg, exchange, key, ctag=''):
-        """ Forward event received from server to locally registered
-nodes. """
-        msg = pickle.loads(msg)
+    def _fireMessage(self, key, exchange, message):
+        """ Fire the PseudoMessage on all matching queues of the named
+exchange. Returns a deferred if the exchange is durable, firing when
+the message is logged. """
         try:
             exchange = self.exchanges[exchange]
-            exchange.fireEvent(key, msg)
         except KeyError:
-            # no registration for this exchange. hey ho.
-            pass
+            if exchange not in self.durable:
+                # no registration for this exchange. hey ho.
+                return None
+            exchange = self._addExchange(exchange)
+        return exchange.fireEvent(key, message)
+
+    def _addExchange(self, name):
+        """ Create exchange name, with its log if it is durable. """
+        log = None
+        if name in self.durable:
+            log = DurableLog(os.path.join(self.logdir, name), **self.logOptions)
+        exchange = PseudoExchange(name, log)
+        self.exchanges[name] = exchange
+        return exchange
+
+    def _owner(self, exchange):
+        """ Return the address of the server that owns exchange. A stable
+hash is used so that every node agrees. """
+        return self.servers[(zlib.crc32(exchange) & 0xffffffff) % len(self.servers)]
 
+    def _linkFor(self, exchange):
+        """ Return the link through which events on exchange are fired
+and subscribed to, or None if this server owns it. """
+        if not self.isServer:
+            return self.links[self.address]
+        owner = self._owner(exchange)
+        if owner == self.address:
+            return None
+        return self.links[owner]
+
+    def _splitAddress(self, address):
+        host, port = address.split(':')
+        try:
+            return host, int(port)
+        except ValueError:
+            raise ConfigurationError("Cannot connect pseudomq to port: %s" % port)
 
     def _startServer(self):
         """ Connect a server PB interface to whatever port
 is specified in the config. """
-        rootObj = PseudoMQServer(self)
-        svr = pb.PBServerFactory(rootObj)
+        self.rootObj = PseudoMQServer(self)
+        svr = pb.PBServerFactory(self.rootObj)
         try:
             self.connection = reactor.listenTCP(self.port, 
                                                 svr, 
@@ -164,9 +320,150 @@ is specified in the config. """
         except Exception:
             self.logger.exception("Error initialising PseudoMQ")
 
-    def _startClient(self):
-        """ Get a connection to a PseudoMQ server node. """
+class PseudoMQLink(object):
+    """ A connection from this node to a PseudoMQ server, over which it 
+registers for and fires events on the exchanges that the server carries
+for it: all of them for a client; those owned by the far server for a 
+server in a federation.
+
+On connecting, all subscriptions are registered with the server in a 
+single call and then events fired while not connected are sent, in order 
+and without waiting for each to be acknowledged. Should the connection be 
+lost the link reconnects with exponential backoff, re-registering and 
+re-sending un-acknowledged events in the same way. """
+
+    #: first delay, in seconds, before reconnecting to the server; 
+    #: doubled on each failure
+    RECONNECT_BASE = 0.5
+    #: longest delay between attempts to reconnect
+    RECONNECT_MAX = 30.0
+
+    def __init__(self, pseudomq, address):
+        self.pseudomq = pseudomq
+        self.logger = pseudomq.logger
+        self.address = address
+        self.host, self.port = pseudomq._splitAddress(address)
         self.clientObj = PseudoMQClient(self)
+        self.connected = False
+        self.running = False
+        self.server = None
+        # events waiting to be fired and those fired but not yet
+        # acknowledged, each as [key, exchange, message, deferred, echo]
+        self.eventFiringQueue = []
+        self.unacked = []
+        self.failures = 0
+        self.reconnectCall = None
+        # last offset received for each (exchange, key) subscription on 
+        # a durable exchange and the id of the log they are offsets in
+        self.offsets = {}
+        self.logIds = {}
+
+    def start(self):
+        self.running = True
+        self._connect()
+
+    def stop(self):
+        self.running = False
+        if self.reconnectCall and self.reconnectCall.active():
+            self.reconnectCall.cancel()
+        self.reconnectCall = None
+        if self.server:
+            self.server.broker.transport.loseConnection()
+
+    def register(self, key, exchange):
+        """ Register for events on exchange matching key. If not 
+connected, the registration is made with all the others on 
+connecting. """
+        if self.connected:
+            pmq = self.pseudomq
+            self.server.callRemote('register', key, self.clientObj, 
+                                   exchange, pmq.batchWindow,
+                                   pmq.maxQueued, pmq.overflow,
+                                   self._fromOffset(key, exchange))
+
+    def _fromOffset(self, key, exchange):
+        """ Return the (log id, offset) from which the subscription to key
+on exchange is to be replayed, or None. """
+        try:
+            return self.logIds[exchange], self.offsets[(exchange, key)]
+        except KeyError:
+            return None
+
+    def fire(self, key, exchange, message, echo=False):
+        """ Fire the PseudoMessage on the server. Unless echo is set it
+has been delivered to local handlers, so the server is asked not to 
+send it back. Returns a deferred that fires with the acknowledgement. """
+        d = Deferred()
+        self._fireRemote([key, exchange, message, d, echo])
+        return d
+
+    def _fireRemote(self, entry):
+        """ Send the event in entry to the server. If the connection is 
+lost before the server acknowledges the event it is queued to be fired 
+again. """
+        key, exchange, message, d, echo = entry
+        if self.connected:
+            if echo:
+                origin = None
+            else:
+                origin = self.clientObj
+            try:
+                ad = self.server.callRemote('fireEvent', key, exchange, 
+                                            message.getPickle(), origin)
+                self.unacked.append(entry)
+                ad.addCallbacks(self._fireAcked, self._fireError,
+                                callbackArgs=(entry,), errbackArgs=(entry,))
+                return
+            except pb.DeadReferenceError:
+                self.logger.error("Message server has gone!")
+                self._serverLost(self.server)
+        self.eventFiringQueue.append(entry)
+        
+    def _fireAcked(self, rv, entry):
+        self.unacked.remove(entry)
+        entry[3].callback(rv)
+
+    def _fireError(self, err, entry):
+        if err.check(pb.PBConnectionLost, pb.DeadReferenceError):
+            # _serverLost has queued the event to be fired again
+            return
+        self.unacked.remove(entry)
+        entry[3].errback(err)
+
+    def eventReceived(self, msg, exchange, key, ctag=''):
+        """ Forward event received from server to locally registered
+nodes. The message is only un-pickled if there are handlers for it. """
+        message = PseudoMessage(pickled=msg)
+        if type(ctag) == types.TupleType:
+            message.offset = ctag
+            self._durableEventReceived(key, exchange, message)
+        else:
+            self.pseudomq._fireMessage(key, exchange, message)
+
+    def _durableEventReceived(self, key, exchange, message):
+        """ Deliver an event from a durable exchange to the queues of 
+each subscription matching key that has not yet had it. Offsets are 
+kept for each subscription as replays, made for each, may overlap. If 
+the event is from a different log to the last, the offsets held for the 
+exchange are of a log that has been lost so are dropped. """
+        logId, offset = message.offset
+        if self.logIds.get(exchange) != logId:
+            for subscription in self.offsets.keys():
+                if subscription[0] == exchange:
+                    del(self.offsets[subscription])
+            self.logIds[exchange] = logId
+        try:
+            ex = self.pseudomq.exchanges[exchange]
+        except KeyError:
+            return
+        for pattern in ex.index.match(key):
+            subscription = (exchange, pattern)
+            if offset > self.offsets.get(subscription, -1):
+                self.offsets[subscription] = offset
+                ex.queues[pattern].fireEvent(key, exchange, message)
+
+    def _connect(self):
+        self.reconnectCall = None
         factory = pb.PBClientFactory()
         try:
             reactor.connectTCP(self.host, self.port, factory)
@@ -177,59 +474,152 @@ is specified in the config. """
             raise PluginError("Could not connect to PseudoMQ server: %s" % str(ex))
         
     def _clientConnect(self, svr):
-        """ Called when root object from PseudoMQ server obtained. """
+        """ Called when root object from PseudoMQ server obtained. 
+All subscriptions are registered in one call, then events waiting to be
+fired are sent in order. PB delivers calls on the connection in order, so
+there is no need to wait for each to be acknowledged. """
+        if not self.running:
+            svr.broker.transport.loseConnection()
+            return
         self.server = svr
-        self._safeQueuePurge()
-    
-    def _safeQueuePurge(self, *args):
-        """ Registrations made prior to the server being
-connected are flushed out one at a time (to preserve order). Then,
-events remaining to be fired are flushed out one at a time. Then 
-we consider ourselves connected. """
-        if self.registrationQueue:
-            key,exchange = self.registrationQueue.pop()
-            d = self.server.callRemote('register', key, 
-                                   self.clientObj, exchange)
-            d.addCallback(self._safeQueuePurge)
-        elif self.eventFiringQueue:
-            key, exchange, msg = self.eventFiringQueue.pop()
-            d = self.server.callRemote('fireEvent', key, 
-                                   exchange, pickle.dumps(msg))        
-            d.addCallback(self._safeQueuePurge)
-        else:
-            self.connected = True
+        self.failures = 0
+        svr.notifyOnDisconnect(self._serverLost)
+        subscriptions = self._subscriptions()
+        if subscriptions:
+            pmq = self.pseudomq
+            svr.callRemote('registerMany', self.clientObj, subscriptions,
+                           pmq.batchWindow, pmq.maxQueued, pmq.overflow)
+        self.connected = True
+        self.logger.debug("Connected to PseudoMQ server %s; %d subscriptions, %d events queued" \
+                          % (self.address, len(subscriptions), len(self.eventFiringQueue)))
+        queued, self.eventFiringQueue = self.eventFiringQueue, []
+        for entry in queued:
+            self._fireRemote(entry)
+
+    def _subscriptions(self):
+        """ Return a list of (key, exchange, fromOffset) for all the keys 
+with handlers on exchanges carried by this link. """
+        subscriptions = []
+        for name, exchange in self.pseudomq.exchanges.items():
+            if self.pseudomq._linkFor(name) is not self:
+                continue
+            for key in exchange.queues.keys():
+                subscriptions.append((key, name, self._fromOffset(key, name)))
+        return subscriptions
+
+    def _serverLost(self, svr):
+        """ The connection to the server has gone. Events not 
+acknowledged are put back at the head of the queue to fire, in order, 
+and a reconnect is scheduled. """
+        if svr is not self.server:
+            return
+        self.server = None
+        self.connected = False
+        self.eventFiringQueue[0:0] = self.unacked
+        self.unacked = []
+        if self.running:
+            self.logger.error("Lost connection to PseudoMQ server %s" % self.address)
+            self._scheduleReconnect()
             
     def _clientConnectError(self, err):
         """ Error connecting the client to the server """
-        raise PluginError("Could not connect to PseudoMQ server: %s" % str(err))
+        self.logger.error("Could not connect to PseudoMQ server %s: %s" \
+                          % (self.address, err.getErrorMessage()))
+        self.failures += 1
+        if self.running:
+            self._scheduleReconnect()
+    
+    def _scheduleReconnect(self):
+        if self.reconnectCall:
+            return
+        delay = min(PseudoMQLink.RECONNECT_MAX, 
+                    PseudoMQLink.RECONNECT_BASE * 2**self.failures)
+        self.reconnectCall = reactor.callLater(delay, self._connect)
     
 class PseudoMQServer(pb.Root):
     def __init__(self, pseudomq):
         self.pseudomq = pseudomq
+        # SubscriberQueues through which events are sent to clients, 
+        # keyed on the client reference
+        self.subscribers = {}
         
-    def remote_register(self, key, handler, exchange='events'):
-        self.pseudomq.register(key, handler, exchange)
+    def remote_register(self, key, handler, exchange='events', batchWindow=0,
+                        maxQueued=1000, overflow='dropoldest', fromOffset=None):
+        """ Register the client handler for events on exchange matching
+key. If the exchange is durable and fromOffset, (log id, offset), is 
+given, logged events after that offset that match key are sent first; 
+all of them if the log id is not that of the current log. Note that the replay
+is subject to the limit of maxQueued events held for the client. """
+        for ref, queue in self.subscribers.items():
+            if queue.dead:
+                del(self.subscribers[ref])
+        try:
+            queue = self.subscribers[handler]
+        except KeyError:
+            queue = SubscriberQueue(handler, batchWindow, maxQueued=maxQueued,
+                                    overflow=overflow, name="pseudomq client")
+            self.subscribers[handler] = queue
+        self.pseudomq.register(key, queue, exchange)
+        log = self.pseudomq.exchanges[exchange].log
+        if log and fromOffset != None:
+            logId, offset = fromOffset
+            if logId != log.logId:
+                # the client's offset is in a log since lost, so all of
+                # this one is new to it
+                offset = -1
+            pattern = TopicTrie()
+            pattern.add(key)
+            for offset, k, data in log.read(offset):
+                if pattern.match(k):
+                    queue.add(data, exchange, k, (log.logId, offset))
     
+    def remote_registerMany(self, handler, subscriptions, batchWindow=0,
+                            maxQueued=1000, overflow='dropoldest'):
+        """ Register handler for each of a list of (key, exchange, 
+fromOffset) subscriptions. """
+        for key, exchange, fromOffset in subscriptions:
+            self.remote_register(key, handler, exchange, batchWindow, 
+                                 maxQueued, overflow, fromOffset)
+
     def remote_deregister(self, handler):
+        if self.subscribers.has_key(handler):
+            handler = self.subscribers.pop(handler)
         self.pseudomq.deregister(handler)
     
-    def remote_fireEvent(self, key, exchange='events', msg=''):
-        kwargs = pickle.loads(msg)
-        self.pseudomq.fireEvent(key, exchange, **kwargs)
+    def remote_fireEvent(self, key, exchange='events', msg='', origin=None):
+        """ The pickled message is passed on as received, with 
+sender_guid already set by the client. If origin is given it is the 
+client that fired the event, having delivered it to its own handlers, so 
+it is not sent the event. For a durable exchange the result is a deferred
+that fires once the event is logged. """
+        message = PseudoMessage(pickled=msg)
+        if origin != None:
+            message.origin = self.subscribers.get(origin)
+        return self.pseudomq._publish(key, exchange, message)
     
-class PseudoMQClient(pb.Referenceable):
-    def __init__(self, pseudomq):
-        self.pseudomq = pseudomq
+class PseudoMQClient(EventReceiver):
+    def __init__(self, link):
+        self.link = link
         
     def remote_eventReceived(self, msg, exchange='', key='', ctag=''):
-        self.pseudomq.eventReceived(msg, exchange, key, ctag)
+        self.link.eventReceived(msg, exchange, key, ctag)
         
 class PseudoExchange(object):
     """ Model an exchange in a super simplistic way. Allow registration
-of listeners to queues and firing of events. """
-    def __init__(self, name):
+of listeners to queues and firing of events. 
+
+Queue keys are indexed in a TopicTrie, kept up to date as queues are added
+and removed, so that finding the queues for an event does not require
+every key to be tested against it. 
+
+If a DurableLog is given the exchange is durable: every event is logged
+and given an offset, (log id, offset in the log), and is only delivered 
+once it is on disk. """
+    def __init__(self, name, log=None):
         self.name = name
+        self.log = log
         self.queues = {}
+        self.index = TopicTrie()
         
     def addQueue(self, key, handler):
         try:
@@ -237,19 +627,37 @@ of listeners to queues and firing of events. """
         except KeyError:
             self.queues[key] = PseudoQueue(key)
             self.queues[key].addHandler(handler)
+            self.index.add(key)
     
     def deregister(self, handler):
         """ De-register handler from all queues to which it
-is registered. """
-        for queue in self.queues.values():
+is registered. Queues left with no handlers are removed. """
+        for key, queue in self.queues.items():
             queue.removeHandler(handler)
+            if not queue.handlers:
+                del(self.queues[key])
+                self.index.remove(key)
             
     def fireEvent(self, key, msg):
         """ Fire event to all queues whose routing key matches the 
-message key according to AMQP pattern matching rules. """
-        keys = self.queues.keys()
-        matchKeys = [k for k in keys if self.matchKey(k, key)]
-        for k in matchKeys:
+message key according to AMQP pattern matching rules. Msg is a dict
+or a PseudoMessage. """
+        if not isinstance(msg, PseudoMessage):
+            msg = PseudoMessage(msg)
+        if self.log:
+            offset, d = self.log.append(key, msg.getPickle())
+            msg.offset = (self.log.logId, offset)
+            return d.addCallback(self._logged, key, msg)
+        self._deliver(key, msg)
+        return None
+
+    def _logged(self, offset, key, msg):
+        """ The message is on disk so may now be delivered. """
+        self._deliver(key, msg)
+        return offset
+
+    def _deliver(self, key, msg):
+        for k in self.index.match(key):
             self.queues[k].fireEvent(key, self.name, msg)
 
     def matchKey(self, pattern, key):
@@ -261,62 +669,99 @@ Permitted wildcards are:
         - # : matches zero or more tokens
         - * : matches a single token
 """
-        patternTokens = pattern.split('.')
-        keyTokens = key.split('.')
-        return self._matchKey(patternTokens, keyTokens)
+        trie = TopicTrie()
+        trie.add(pattern)
+        return bool(trie.match(key))
+
+class TopicTrieNode(object):
+    """ Node in a TopicTrie. """
+    __slots__ = ['children', 'patterns', 'isHash']
+    def __init__(self, isHash=False):
+        self.children = {}
+        self.patterns = []
+        self.isHash = isHash
+
+class TopicTrie(object):
+    """ Index of topic patterns, as used for queue keys, in which each
+pattern is stored as a path of its '.' delimited tokens. A key is matched
+by walking the trie token by token, following at each node the child for 
+that token and any '*' child; a '#' node may consume any number of tokens
+so remains active once reached. The cost of a match therefore depends on 
+the length of the key and not on the number of patterns stored. """
+    def __init__(self):
+        self.root = TopicTrieNode()
     
-    def _matchKey(self, pt, kt):
-        """ Recursive matching method. """
-        if pt==[] and kt==[]:
-            return True
-        elif pt==[]:
-            # there's no more pattern but there remain keytokens 
-            # un-matched.
-            return False
-        
-        if pt[0] == '#':
-            # peek at next pattern value and scroll forward in
-            # key tokens until found
-            if len(pt) > 1:
-                peek = pt[1]
-            else:
-                # we're at the last element in pattern and it's a
-                # hash so whatever is remaining in the key tokens,
-                # it's OK - we have a match
-                return True
-            
-            # find the first match of the next token in key space,
-            # then match on the rest of the key tokens. If no match,
-            # seek another match on the peeked token (this allows for 
-            # a.#.b.c to match a.x.x.b.x.x.b.c
-            startPos = 0
-            while True:
-                try:
-                    targetPos = kt[startPos:].index(peek)
-                    match = self._matchKey(pt[1:], kt[startPos+targetPos:])
-                    if match:
-                        return True
-                    elif startPos+targetPos+1 == len(kt):
-                        # no more places to try match
-                        return False
-                    else:
-                        startPos += targetPos+1
-                except ValueError:
-                    # the key tokens do not contain the next token
-                    # in the pattern
-                    return False
-            
-        elif pt[0] == '*':
-            if not kt:
-                return False
-            else:
-                return self._matchKey(pt[1:], kt[1:])
+    def add(self, pattern):
+        node = self.root
+        for token in pattern.split('.'):
+            try:
+                node = node.children[token]
+            except KeyError:
+                child = TopicTrieNode(token == '#')
+                node.children[token] = child
+                node = child
+        if pattern not in node.patterns:
+            node.patterns.append(pattern)
+    
+    def remove(self, pattern):
+        """ Remove pattern, pruning any branch left empty. """
+        path = [self.root]
+        tokens = pattern.split('.')
+        for token in tokens:
+            try:
+                path.append(path[-1].children[token])
+            except KeyError:
+                return
+        try:
+            path[-1].patterns.remove(pattern)
+        except ValueError:
+            return
+        while len(path) > 1:
+            node = path.pop()
+            if node.patterns or node.children:
+                break
+            del(path[-1].children[tokens[len(path)-1]])
 
-        elif (pt and kt) and (pt[0] == kt[0]):
-            return self._matchKey(pt[1:], kt[1:])
-        
-        else:
-            return False
+    def match(self, key):
+        """ Return the list of patterns that match key. """
+        active = self._closure([self.root])
+        for token in key.split('.'):
+            nodes = []
+            for node in active:
+                if node.isHash:
+                    nodes.append(node)
+                try:
+                    nodes.append(node.children[token])
+                except KeyError:
+                    pass
+                try:
+                    nodes.append(node.children['*'])
+                except KeyError:
+                    pass
+            if not nodes:
+                return []
+            active = self._closure(nodes)
+        matches = []
+        for node in active:
+            matches.extend(node.patterns)
+        return matches
+    
+    def _closure(self, nodes):
+        """ Add to nodes any '#' children, which match zero tokens, 
+removing duplicates. """
+        seen = {}
+        closed = []
+        while nodes:
+            node = nodes.pop()
+            if seen.has_key(id(node)):
+                continue
+            seen[id(node)] = True
+            closed.append(node)
+            try:
+                nodes.append(node.children['#'])
+            except KeyError:
+                pass
+        return closed
     
 class PseudoQueue(object):
     def __init__(self, key):
@@ -335,21 +780,300 @@ class PseudoQueue(object):
             pass
     
     def fireEvent(self, key, exchange, message):
-        msgPickle = pickle.dumps(message)
+        """ Message is a PseudoMessage; local handlers receive the dict, 
+remote handlers the pickle. The ctag is the message offset if it has 
+one. """
         deadHandlers = []
+        ctag = message.offset
+        if ctag == None:
+            ctag = ''
         for h in self.handlers:
+            if h is message.origin:
+                continue
             if isinstance(h, AbstractEventHandler):
                 try:
-                    h.eventReceived(message, exchange, key, '')
+                    h.eventReceived(message.getMessage(), exchange, key, ctag)
                 except:
                     deadHandlers.append(h)
             else:
                 try:
-                    h.callRemote('eventReceived', msgPickle, exchange, key, '')
+                    if isinstance(h, SubscriberQueue):
+                        h.add(message.getPickle(), exchange, key, ctag)
+                    else:
+                        h.callRemote('eventReceived', message.getPickle(), exchange, key, ctag)
                 except pb.DeadReferenceError:
                     deadHandlers.append(h)
                     
         for h in deadHandlers:
             self.handlers.remove(h)
         
-        
\ No newline at end of file
+        
+
+class PseudoMessage(object):
+    """ An event message as it passes through PseudoMQ, held as a dict, 
+as its pickle or both. Each form is made from the other only when first 
+asked for, and then kept, so that a message is pickled at most once
+however many queues it is delivered to, and a pickle received from 
+elsewhere is forwarded as-is and only un-pickled if a local handler needs
+the dict. """
+    def __init__(self, message=None, pickled=None):
+        self.message = message
+        self.pickled = pickled
+        # offset in the log of a durable exchange
+        self.offset = None
+        # handler not to be sent the message as it came from there
+        self.origin = None
+        
+    def getMessage(self):
+        if self.message == None:
+            self.message = pickle.loads(self.pickled)
+        return self.message
+    
+    def getPickle(self):
+        if self.pickled == None:
+            self.pickled = pickle.dumps(self.message, pickle.HIGHEST_PROTOCOL)
+        return self.pickled
+
+class DurableLog(object):
+    """ Segmented, append-only log of the events fired on a durable 
+exchange, kept in its own directory. Each event is given an offset, one
+greater than that of the event before, and is written as a record of
+
+    offset, key length, message length (struct format '>QII'), key, message
+
+where the message is the event pickle. Records are appended to the current
+segment file, named for the offset of its first record, until it exceeds 
+segmentSize bytes when a new segment is started; only the most recent 
+maxSegments segments are kept.
+
+Writes are made durable in batches: the log is flushed, then fsync'd in
+a thread, syncInterval seconds after the first un-synced append, or as 
+soon as syncBatch appends are waiting. Only one fsync runs at a time, so
+the deferred returned by append for each event fires with its offset, in 
+order, once it is on disk. Records not yet on disk are not read.
+
+The log has an id, kept in the file 'logid' in its directory, made anew
+whenever the log is started without segments. Offsets are only 
+meaningful with the id: should the directory be lost the offsets of a new
+log start again from zero under a different id.
+
+On opening an existing log the last segment is scanned to find the next
+offset; a partial record left by a crash is truncated.
+"""
+    HEADER = '>QII'
+    HEADER_SIZE = struct.calcsize(HEADER)
+
+    def __init__(self, directory, segmentSize=4*1024*1024, maxSegments=8,
+                 syncInterval=0.05, syncBatch=100):
+        self.directory = directory
+        self.segmentSize = segmentSize
+        self.maxSegments = maxSegments
+        self.syncInterval = syncInterval
+        self.syncBatch = syncBatch
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.segments = self._listSegments()
+        self.logId = self._loadLogId()
+        self.nextOffset = 0
+        self.file = None
+        if self.segments:
+            self.nextOffset = self._recover(self.segments[-1])
+            self.file = open(self._segmentPath(self.segments[-1]), 'ab')
+        # records with lower offsets are on disk
+        self.syncedOffset = self.nextOffset
+        # (offset, deferred) of records awaiting fsync
+        self.unsynced = []
+        # files of segments rolled over but not yet fsync'd
+        self.retired = []
+        self.syncCall = None
+        self.syncing = False
+        self.syncAgain = False
+        # runs the fsync; may be replaced to run it in the reactor thread
+        self.inThread = deferToThread
+        
+    def _segmentPath(self, firstOffset):
+        return os.path.join(self.directory, "%020d.log" % firstOffset)
+    
+    def _listSegments(self):
+        segments = []
+        for f in os.listdir(self.directory):
+            if f.endswith('.log'):
+                try:
+                    segments.append(int(f[:-4]))
+                except ValueError:
+                    pass
+        segments.sort()
+        return segments
+
+    def _loadLogId(self):
+        """ Return the id of the log, making and saving a new one if the
+log has no segments or no id. """
+        path = os.path.join(self.directory, 'logid')
+        if self.segments and os.path.isfile(path):
+            f = open(path, 'r')
+            try:
+                logId = f.read().strip()
+            finally:
+                f.close()
+            if logId:
+                return logId
+        logId = binascii.hexlify(os.urandom(8))
+        f = open(path, 'w')
+        try:
+            f.write(logId)
+            f.flush()
+            os.fsync(f.fileno())
+        finally:
+            f.close()
+        return logId
+    
+    def _recover(self, firstOffset):
+        """ Return the offset following the last complete record in the
+segment, truncating the file after that record. """
+        path = self._segmentPath(firstOffset)
+        nextOffset = firstOffset
+        good = 0
+        f = open(path, 'rb')
+        try:
+            for offset, key, data, end in self._records(f):
+                nextOffset = offset+1
+                good = end
+        finally:
+            f.close()
+        if good < os.path.getsize(path):
+            f = open(path, 'r+b')
+            f.truncate(good)
+            f.close()
+        return nextOffset
+    
+    def _records(self, f):
+        """ Generate (offset, key, data, endPosition) for each complete
+record in file f. """
+        pos = 0
+        while True:
+            header = f.read(DurableLog.HEADER_SIZE)
+            if len(header) < DurableLog.HEADER_SIZE:
+                return
+            offset, keyLen, dataLen = struct.unpack(DurableLog.HEADER, header)
+            body = f.read(keyLen+dataLen)
+            if len(body) < keyLen+dataLen:
+                return
+            pos += DurableLog.HEADER_SIZE+keyLen+dataLen
+            yield offset, body[:keyLen], body[keyLen:], pos
+
+    def append(self, key, data):
+        """ Append the event with routing key and pickled message data. 
+Returns (offset, deferred), the deferred firing when the record is on 
+disk. """
+        if self.file == None or self.file.tell() >= self.segmentSize:
+            self._newSegment()
+        offset = self.nextOffset
+        self.nextOffset += 1
+        self.file.write(struct.pack(DurableLog.HEADER, offset, len(key), len(data)))
+        self.file.write(key)
+        self.file.write(data)
+        d = Deferred()
+        self.unsynced.append((offset, d))
+        if len(self.unsynced) >= self.syncBatch:
+            self.sync()
+        elif not self.syncCall:
+            self.syncCall = reactor.callLater(self.syncInterval, self.sync)
+        return offset, d
+    
+    def sync(self):
+        """ Flush the log and fsync it in a thread, then fire the 
+deferreds of all records written. If an fsync is already running 
+another follows it. """
+        if self.syncCall and self.syncCall.active():
+            self.syncCall.cancel()
+        self.syncCall = None
+        if self.syncing:
+            self.syncAgain = True
+            return
+        if not self.unsynced and not self.retired:
+            return
+        files = self.retired
+        if self.file:
+            self.file.flush()
+            files = files + [self.file]
+        filenos = [f.fileno() for f in files]
+        self.retired = []
+        unsynced, self.unsynced = self.unsynced, []
+        self.syncing = True
+        d = self.inThread(self._fsync, filenos)
+        d.addBoth(self._synced, unsynced, files)
+
+    def _fsync(self, filenos):
+        for fileno in filenos:
+            os.fsync(fileno)
+
+    def _synced(self, rv, unsynced, files):
+        self.syncing = False
+        # a segment retired while the fsync ran is synced again by the
+        # next, so is left open until then
+        for f in files:
+            if f is not self.file and f not in self.retired:
+                f.close()
+        if unsynced and not isinstance(rv, Failure):
+            self.syncedOffset = unsynced[-1][0] + 1
+        for offset, d in unsynced:
+            if isinstance(rv, Failure):
+                d.errback(rv)
+            else:
+                d.callback(offset)
+        if self.syncAgain:
+            self.syncAgain = False
+            self.sync()
+    
+    def _newSegment(self):
+        if self.file:
+            self.file.flush()
+            self.retired.append(self.file)
+        self.segments.append(self.nextOffset)
+        self.file = open(self._segmentPath(self.nextOffset), 'ab')
+        while len(self.segments) > self.maxSegments:
+            os.remove(self._segmentPath(self.segments.pop(0)))
+        if self.retired:
+            self.sync()
+
+    def read(self, fromOffset):
+        """ Generate (offset, key, data) for each record on disk with an 
+offset greater than fromOffset, in order. """
+        if self.file:
+            self.file.flush()
+        syncedOffset = self.syncedOffset
+        # skip segments that end before fromOffset
+        segments = self.segments[:]
+        while len(segments) > 1 and segments[1] <= fromOffset+1:
+            segments.pop(0)
+        for firstOffset in segments:
+            f = open(self._segmentPath(firstOffset), 'rb')
+            try:
+                for offset, key, data, end in self._records(f):
+                    if offset >= syncedOffset:
+                        return
+                    if offset > fromOffset:
+                        yield offset, key, data
+            finally:
+                f.close()
+
+    def close(self):
+        """ Close the log, waiting for it to be synced; this blocks so is
+only for use as the reactor stops. """
+        if self.syncCall and self.syncCall.active():
+            self.syncCall.cancel()
+        self.syncCall = None
+        files = self.retired
+        self.retired = []
+        if self.file:
+            self.file.flush()
+            files = files + [self.file]
+            self.file = None
+        self._fsync([f.fileno() for f in files])
+        for f in files:
+            f.close()
+        unsynced, self.unsynced = self.unsynced, []
+        if unsynced:
+            self.syncedOffset = unsynced[-1][0] + 1
+        for offset, d in unsynced:
+            d.callback(offset)
@@ -0,0 +1,164 @@
+# $Id$
+#
+# Copyright (c) 2007-2008 ReThought Limited and Peloton Contributors
+# All Rights Reserved
+# See LICENSE for details
+""" Blocking AMQP client I/O moved off the reactor thread, for use by
+the AMQP event bus plugins. Nothing here depends on a particular AMQP
+library. """
+
+from peloton.exceptions import MessagingError
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred
+import threading
+import Queue
+import time
+
+def _takeBatch(q, batchSize):
+    """ Block until there is something in q then return a list of all
+that is waiting, up to batchSize items, and whether the None that marks
+the end of q was reached. """
+    batch = [q.get()]
+    try:
+        while len(batch) < batchSize and batch[-1] is not None:
+            batch.append(q.get_nowait())
+    except Queue.Empty:
+        pass
+    if batch[-1] is None:
+        batch.pop()
+        return batch, True
+    return batch, False
+
+class MultiplexedConsumer(object):
+    """ Receives the messages for every consumer on a connection through
+a single queue, the inbox, read by a single thread. The AMQP client puts
+messages into the inbox as they arrive; the reader takes all that are
+waiting, up to batchSize, and passes them as a list to deliver in the
+reactor thread, where they may be dispatched by consumer tag.
+
+This replaces a thread, and a call into the reactor, per consumer. """
+    def __init__(self, deliver, batchSize=100):
+        self.deliver = deliver
+        self.batchSize = batchSize
+        self.inbox = Queue.Queue()
+        self.thread = None
+        self.callFromThread = reactor.callFromThread
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def stop(self):
+        """ The reader stops once it has passed on all messages already
+in the inbox. """
+        self.inbox.put(None)
+
+    def _run(self):
+        stopped = False
+        while not stopped:
+            batch, stopped = _takeBatch(self.inbox, self.batchSize)
+            if batch:
+                self.callFromThread(self.deliver, batch)
+
+class BatchPublisher(object):
+    """ Publishes messages from a thread of its own so that a slow broker
+does not hold up the reactor.
+
+publish, called in the reactor thread, queues a message and returns a
+deferred. The publisher thread takes all messages waiting, up to
+batchSize, and writes each with the blocking publishFunction. If a
+commitFunction is given it is then called, e.g. to commit a transaction,
+so that the deferreds only fire once the broker has confirmed the batch.
+Should writing or committing fail, the deferreds of the batch errback
+with MessagingError.
+
+No more than maxQueued messages may be waiting or being written; beyond
+that publish raises MessagingError. The time from publish to confirmation is
+recorded for each exchange. """
+    def __init__(self, publishFunction, commitFunction=None,
+                 batchSize=100, maxQueued=10000):
+        self.publishFunction = publishFunction
+        self.commitFunction = commitFunction
+        self.batchSize = batchSize
+        self.maxQueued = maxQueued
+        self.outbox = Queue.Queue()
+        self.pending = 0
+        self.dropped = 0
+        # key is exchange, value is [count, total latency, max latency]
+        self.latency = {}
+        self.thread = None
+        self.callFromThread = reactor.callFromThread
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def stop(self):
+        """ The publisher stops once it has written all messages already
+queued. """
+        self.outbox.put(None)
+
+    def publish(self, exchange, key, body):
+        """ Queue the message, returning a deferred that fires once it is
+published. MessagingError is raised if maxQueued messages are already 
+waiting. """
+        if self.pending >= self.maxQueued:
+            self.dropped += 1
+            raise MessagingError("Publish queue full (%d messages)" \
+                                 % self.pending)
+        self.pending += 1
+        d = Deferred()
+        self.outbox.put((exchange, key, body, d, time.time()))
+        return d
+
+    def _run(self):
+        stopped = False
+        while not stopped:
+            batch, stopped = _takeBatch(self.outbox, self.batchSize)
+            if not batch:
+                continue
+            err = None
+            try:
+                for exchange, key, body, _, _ in batch:
+                    self.publishFunction(exchange, key, body)
+                if self.commitFunction:
+                    self.commitFunction()
+            except Exception, ex:
+                err = ex
+            self.callFromThread(self._published, batch, err)
+
+    def _published(self, batch, err):
+        """ Called in the reactor thread with a batch that has been
+written or has failed. """
+        self.pending -= len(batch)
+        now = time.time()
+        for exchange, key, body, d, queuedAt in batch:
+            if err:
+                d.errback(MessagingError("Could not publish to %s/%s: %s" \
+                                         % (exchange, key, str(err))))
+                continue
+            elapsed = now - queuedAt
+            try:
+                stats = self.latency[exchange]
+            except KeyError:
+                stats = self.latency[exchange] = [0, 0.0, 0.0]
+            stats[0] += 1
+            stats[1] += elapsed
+            stats[2] = max(stats[2], elapsed)
+            d.callback(None)
+
+    def getStats(self):
+        """ Return a dictionary of publisher statistics: the number of
+messages pending, the number dropped because too many were pending and,
+for each exchange, the count, mean and maximum of publish latencies in
+seconds. """
+        exchanges = {}
+        for exchange, (count, total, worst) in self.latency.items():
+            exchanges[exchange] = {'published' : count,
+                                   'meanLatency' : total / count,
+                                   'maxLatency' : worst}
+        return {'pending' : self.pending,
+                'dropped' : self.dropped,
+                'exchanges' : exchanges}
@@ -0,0 +1,208 @@
+# $Id$
+#
+# Copyright (c) 2007-2008 ReThought Limited and Peloton Contributors
+# All Rights Reserved
+# See LICENSE for details
+from unittest import TestCase
+from peloton.plugins.support.amqpio import MultiplexedConsumer
+from peloton.plugins.support.amqpio import BatchPublisher
+from peloton.exceptions import MessagingError
+from peloton.plugins.pseudomq import TopicTrie
+from peloton.events import logFireFailure
+from peloton.events import AbstractEventHandler
+from peloton.utils.config import PelotonSettings
+import cPickle as pickle
+import threading
+try:
+    from peloton.plugins.amqpQpid import AMQPEventBus
+except ImportError:
+    # QPID is not installed; the plugin cannot be tested
+    AMQPEventBus = None
+
+class Content(object):
+    def __init__(self, body):
+        self.body = body
+
+class Message(object):
+    """ Looks like a message delivered by QPID. """
+    def __init__(self, ctag, exchange, key, body):
+        self.fields = (ctag, 0, False, exchange, key)
+        self.content = Content(body)
+
+class StandInBroker(object):
+    """ A broker in this process with topic exchanges, delivering to
+consumers from its own thread into a client inbox as QPID would. """
+    def __init__(self, inbox):
+        self.inbox = inbox
+        self.bindings = {}
+        self.commits = 0
+
+    def consume(self, ctag, exchange, pattern):
+        trie = self.bindings.setdefault(exchange, {})
+        trie[ctag] = TopicTrie()
+        trie[ctag].add(pattern)
+
+    def basicPublish(self, exchange, key, body):
+        for ctag, trie in self.bindings.get(exchange, {}).items():
+            if trie.match(key):
+                self.inbox.put(Message(ctag, exchange, key, body))
+
+    def commit(self):
+        self.commits += 1
+
+    def publish(self, messages):
+        """ Deliver (exchange, key, body) messages from another thread. """
+        def _deliver():
+            for exchange, key, body in messages:
+                self.basicPublish(exchange, key, body)
+        t = threading.Thread(target=_deliver)
+        t.start()
+        t.join()
+
+class Test_MultiplexedConsumer(TestCase):
+    def setUp(self):
+        self.batches = []
+        self.consumer = MultiplexedConsumer(self.batches.append, batchSize=3)
+        self.consumer.callFromThread = lambda f, *args: f(*args)
+        self.broker = StandInBroker(self.consumer.inbox)
+
+    def test_dispatch(self):
+        """ Messages for all consumers arrive through one thread in
+batches, in order, and the thread ends on stop. """
+        self.broker.consume('c1', 'events', 'a.#')
+        self.broker.consume('c2', 'events', 'a.b')
+        self.broker.consume('c3', 'logging', '#')
+        self.broker.publish([('events', 'a.b', 1), ('events', 'a.c', 2),
+                             ('logging', 'x', 3), ('events', 'b', 4)])
+        self.consumer.stop()
+        self.consumer.start()
+        self.consumer.thread.join(5)
+        self.assertFalse(self.consumer.thread.isAlive())
+        self.assertEquals([len(b) for b in self.batches], [3, 1])
+        received = {}
+        for batch in self.batches:
+            for msg in batch:
+                received.setdefault(msg.fields[0], []).append(msg.content.body)
+        self.assertEquals(received, {'c1' : [1, 2], 'c2' : [1], 'c3' : [3]})
+
+class Test_BatchPublisher(TestCase):
+    def setUp(self):
+        self.broker = StandInBroker(None)
+        self.publisher = BatchPublisher(self.broker.basicPublish, 
+                                        self.broker.commit, 
+                                        batchSize=2, maxQueued=4)
+        self.publisher.callFromThread = lambda f, *args: f(*args)
+        self.inbox = []
+        self.broker.inbox = self
+        self.broker.consume('c1', 'events', '#')
+
+    def put(self, msg):
+        self.inbox.append(msg.content.body)
+
+    def _run(self):
+        self.publisher.stop()
+        self.publisher.start()
+        self.publisher.thread.join(5)
+        self.assertFalse(self.publisher.thread.isAlive())
+
+    def test_publish(self):
+        """ Events are published in order in committed batches, each 
+deferred firing on commit; beyond maxQueued publish raises. """
+        confirmed = []
+        for i in range(4):
+            d = self.publisher.publish('events', 'a.b', i)
+            d.addCallbacks(confirmed.append, confirmed.append)
+        self.assertRaises(MessagingError, self.publisher.publish, 
+                          'events', 'a.b', 4)
+        self.assertEquals(confirmed, [])
+        self._run()
+        self.assertEquals(self.inbox, [0, 1, 2, 3])
+        self.assertEquals(self.broker.commits, 2)
+        self.assertEquals(confirmed, [None]*4)
+        stats = self.publisher.getStats()
+        self.assertEquals(stats['pending'], 0)
+        self.assertEquals(stats['dropped'], 1)
+        self.assertEquals(stats['exchanges']['events']['published'], 4)
+
+    def test_publishError(self):
+        def commit():
+            raise IOError("broker gone")
+        self.publisher.commitFunction = commit
+        failed = []
+        self.publisher.publish('events', 'a.b', 1).addErrback(failed.append)
+        self._run()
+        self.assertTrue(failed[0].check(MessagingError))
+        self.assertEquals(self.publisher.getStats()['pending'], 0)
+
+    def test_logFireFailure(self):
+        """ A failure to publish is logged and not left in the deferred. """
+        class Logger(object):
+            def __init__(self):
+                self.errors = []
+            def error(self, msg):
+                self.errors.append(msg)
+        def commit():
+            raise IOError("broker gone")
+        self.publisher.commitFunction = commit
+        logger = Logger()
+        results = []
+        d = self.publisher.publish('events', 'a.b', 1)
+        logFireFailure(d, logger, 'a.b', 'events').addBoth(results.append)
+        self._run()
+        self.assertEquals(results, [None])
+        self.assertEquals(len(logger.errors), 1)
+        self.assertTrue(logger.errors[0].startswith("Could not fire event a.b on events"))
+
+class Handler(AbstractEventHandler):
+    def __init__(self):
+        self.received = []
+
+    def eventReceived(self, msg, exchange='', key='', ctag=''):
+        self.received.append((key, msg['i']))
+
+class Logger(object):
+    def __init__(self):
+        self.errors = []
+
+    def error(self, msg):
+        self.errors.append(msg)
+
+    def debug(self, msg):
+        pass
+
+if AMQPEventBus:
+    class Test_AMQPDispatch(TestCase):
+        def setUp(self):
+            self.logger = Logger()
+            self.bus = AMQPEventBus(None, 'eventbus', PelotonSettings(), 
+                                    self.logger)
+            self.bus.domain = 'dom'
+            self.bus.handlersByCtag = {}
+            self.consumer = MultiplexedConsumer(self.bus._processQueue, 
+                                                batchSize=2)
+            self.consumer.callFromThread = lambda f, *args: f(*args)
+            self.broker = StandInBroker(self.consumer.inbox)
+
+        def test_byCtag(self):
+            """ Messages reach the handlers of their own consumer tag; 
+those for a tag unknown or cancelled are dropped and the consumer carries
+on. """
+            h1 = Handler()
+            h2 = Handler()
+            self.bus.handlersByCtag = {'c1' : [h1], 'c2' : [h2], 'c3' : []}
+            self.broker.consume('c1', 'events', 'dom.a.#')
+            self.broker.consume('c2', 'events', 'dom.x.#')
+            self.broker.consume('c3', 'events', 'dom.*.b')
+            self.broker.consume('c4', 'events', 'dom.#')
+            self.broker.publish([(
+                'events', key, pickle.dumps({'i' : i})) for i, key in 
+                enumerate(['dom.a.b', 'dom.x.y', 'dom.a.c', 'dom.x.b'])])
+            # c3 is cancelled while its messages wait in the inbox
+            del(self.bus.handlersByCtag['c3'])
+            self.consumer.stop()
+            self.consumer.start()
+            self.consumer.thread.join(5)
+            self.assertFalse(self.consumer.thread.isAlive())
+            self.assertEquals(h1.received, [('a.b', 0), ('a.c', 2)])
+            self.assertEquals(h2.received, [('x.y', 1), ('x.b', 3)])
+            self.assertEquals(self.logger.errors, [])
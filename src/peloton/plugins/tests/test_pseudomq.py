@@ -5,6 +5,21 @@
 # See LICENSE for details
 from unittest import TestCase
 from peloton.plugins.pseudomq import PseudoExchange
+from peloton.plugins.pseudomq import TopicTrie
+from peloton.plugins.pseudomq import PseudoMessage
+from peloton.plugins.pseudomq import DurableLog
+from peloton.plugins.pseudomq import PseudoMQServer
+from peloton.plugins.pseudomq import PseudoMQ
+from peloton.utils.config import PelotonSettings
+from peloton.events import AbstractEventHandler
+from twisted.internet.defer import succeed
+from twisted.internet.defer import Deferred
+from twisted.internet.defer import maybeDeferred
+from twisted.spread import pb
+import peloton.utils.logging as logging
+import tempfile
+import shutil
+import os
 
 class Test_PseudoMQ(TestCase):
     def setUp(self):
@@ -63,3 +78,476 @@ token). """
         self.assertTrue(ex.matchKey("*.stock.#", "usd.stock"))
         self.assertTrue(ex.matchKey("*.stock.#", "eur.stock.db"))
         self.assertFalse(ex.matchKey("*.stock.#", "stock.nasdaq"))
+
+    def test_topicTrie(self):
+        """ The trie returns every matching pattern and is updated 
+incrementally. """
+        trie = TopicTrie()
+        patterns = ["a.b.c", "a.*.c", "a.#", "#", "a.b.#.c", "b.#", "a.b"]
+        for p in patterns:
+            trie.add(p)
+        m = trie.match("a.b.c")
+        m.sort()
+        self.assertEquals(m, ["#", "a.#", "a.*.c", "a.b.#.c", "a.b.c"])
+        trie.remove("a.#")
+        trie.remove("#")
+        trie.remove("not.there")
+        m = trie.match("a.b.c")
+        m.sort()
+        self.assertEquals(m, ["a.*.c", "a.b.#.c", "a.b.c"])
+        self.assertEquals(trie.match("a.b"), ["a.b"])
+        for p in patterns:
+            trie.remove(p)
+        self.assertEquals(trie.root.children, {})
+
+    def test_exchangeRouting(self):
+        """ Events reach only handlers on matching queues; queues are
+dropped when their last handler de-registers. """
+        class Handler(AbstractEventHandler):
+            def __init__(self):
+                self.keys = []
+            def eventReceived(self, msg, exchange='', key='', ctag=''):
+                self.keys.append(key)
+        ex = PseudoExchange('test')
+        h1 = Handler()
+        h2 = Handler()
+        ex.addQueue("psc.#", h1)
+        ex.addQueue("psc.*.init", h2)
+        ex.fireEvent("psc.x.init", {})
+        ex.fireEvent("psc.presence", {})
+        self.assertEquals(h1.keys, ["psc.x.init", "psc.presence"])
+        self.assertEquals(h2.keys, ["psc.x.init"])
+        ex.deregister(h1)
+        self.assertFalse(ex.queues.has_key("psc.#"))
+        ex.fireEvent("psc.y.init", {})
+        self.assertEquals(len(h1.keys), 2)
+        self.assertEquals(h2.keys, ["psc.x.init", "psc.y.init"])
+
+    def test_serializeOnce(self):
+        """ A message is pickled at most once for all remote subscribers
+and a pickle received is forwarded untouched. """
+        class RemoteHandler(object):
+            def __init__(self):
+                self.received = []
+            def callRemote(self, name, msg, exchange, key, ctag):
+                self.received.append(msg)
+        ex = PseudoExchange('test')
+        handlers = [RemoteHandler() for i in range(3)]
+        ex.addQueue("a.#", handlers[0])
+        ex.addQueue("a.b", handlers[1])
+        ex.addQueue("*.b", handlers[2])
+        ex.fireEvent("a.b", {'x' : 1})
+        pickles = [h.received[0] for h in handlers]
+        self.assertTrue(pickles[0] is pickles[1] is pickles[2])
+        self.assertEquals(PseudoMessage(pickled=pickles[0]).getMessage(), {'x' : 1})
+        
+        msg = PseudoMessage(pickled=pickles[0])
+        ex.fireEvent("a.b", msg)
+        self.assertTrue(handlers[0].received[1] is pickles[0])
+        self.assertEquals(msg.message, None)
+
+def openLog(directory, **kwargs):
+    """ Open a DurableLog that syncs at once, in this thread. """
+    log = DurableLog(directory, **kwargs)
+    log.inThread = maybeDeferred
+    return log
+
+class Test_DurableLog(TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+        
+    def test_appendAndRead(self):
+        # records are 24 bytes, so two per segment
+        log = openLog(self.dir, segmentSize=40, maxSegments=2)
+        acked = []
+        for i in range(6):
+            offset, d = log.append('k.%d' % i, 'data%d' % i)
+            self.assertEquals(offset, i)
+            d.addCallback(acked.append)
+        # rolling to a new segment syncs the old; the last is pending
+        self.assertEquals(acked, range(4))
+        log.sync()
+        self.assertEquals(acked, range(6))
+        self.assertEquals([r[0] for r in log.read(2)], [3, 4, 5])
+        self.assertEquals(list(log.read(4)), [(5, 'k.5', 'data5')])
+        # segments rolled and the oldest discarded
+        self.assertEquals(len([f for f in os.listdir(self.dir) if f.endswith('.log')]), 2)
+        self.assertEquals([r[0] for r in log.read(-1)], [2, 3, 4, 5])
+        log.close()
+        
+    def test_recovery(self):
+        """ Offsets continue after re-opening; a partial record is 
+discarded. """
+        log = openLog(self.dir)
+        for i in range(3):
+            log.append('k', 'data%d' % i)
+        log.close()
+        logId = log.logId
+        seg = os.path.join(self.dir, '%020d.log' % 0)
+        f = open(seg, 'ab')
+        f.write('partial')
+        f.close()
+        log = openLog(self.dir)
+        self.assertEquals(log.logId, logId)
+        offset, d = log.append('k', 'data3')
+        self.assertEquals(offset, 3)
+        # not read until on disk
+        self.assertEquals(len(list(log.read(-1))), 3)
+        log.sync()
+        self.assertEquals([r[2] for r in log.read(-1)], 
+                          ['data0', 'data1', 'data2', 'data3'])
+        log.close()
+        # a log started afresh has a new id
+        shutil.rmtree(self.dir)
+        log = openLog(self.dir)
+        self.assertNotEquals(log.logId, logId)
+        self.assertEquals(log.append('k', 'data')[0], 0)
+        log.close()
+
+    def test_rollDuringSync(self):
+        """ A segment retired while an fsync runs is synced by the next
+and every record is acknowledged. """
+        log = DurableLog(self.dir, segmentSize=10, syncBatch=1)
+        fsyncs = []
+        def inThread(f, *args):
+            d = Deferred()
+            fsyncs.append((d, f, args))
+            return d
+        log.inThread = inThread
+        acked = []
+        for i in range(3):
+            offset, d = log.append('k', 'data%d' % i)
+            d.addCallbacks(acked.append, acked.append)
+        self.assertEquals(len(fsyncs), 1)
+        while fsyncs:
+            d, f, args = fsyncs.pop(0)
+            d.callback(f(*args))
+        self.assertEquals(acked, [0, 1, 2])
+        self.assertEquals(log.retired, [])
+        log.close()
+
+    def test_replay(self):
+        """ Events on a durable exchange carry their offset as ctag and
+may be replayed to a client registering from an offset. """
+        class FakeMQ(object):
+            def __init__(self, ex):
+                self.exchanges = {ex.name : ex}
+            def register(self, key, handler, exchange):
+                self.exchanges[exchange].addQueue(key, handler)
+        class FakeClient(object):
+            def __init__(self):
+                self.received = []
+            def callRemote(self, name, msg, exchange, key, ctag):
+                self.received.append((key, ctag))
+                return succeed(None)
+        log = openLog(self.dir)
+        ex = PseudoExchange('durable', log)
+        for i in range(4):
+            ex.fireEvent(['a.x', 'b.x'][i % 2], {'i' : i})
+        log.sync()
+        server = PseudoMQServer(FakeMQ(ex))
+        client = FakeClient()
+        server.remote_register('a.*', client, 'durable', 
+                               fromOffset=(log.logId, 0))
+        self.assertEquals(client.received, [('a.x', (log.logId, 2))])
+        # events are delivered once on disk
+        ex.fireEvent('a.y', {'i' : 4})
+        self.assertEquals(len(client.received), 1)
+        log.sync()
+        self.assertEquals(client.received[-1], ('a.y', (log.logId, 4)))
+        # an offset in another log replays the whole of this one
+        other = FakeClient()
+        server.remote_register('a.*', other, 'durable', 
+                               fromOffset=('lost', 10))
+        self.assertEquals([r[1][1] for r in other.received], [0, 2, 4])
+        log.close()
+
+class FakeKernel(object):
+    guid = 'client'
+    def __init__(self, isServer=False):
+        self.isServer = isServer
+    def hasFlag(self, flag):
+        return self.isServer
+
+class FakeServer(object):
+    """ Records calls made on the server and holds the reply to each. """
+    def __init__(self):
+        self.calls = []
+    def callRemote(self, name, *args):
+        d = Deferred()
+        self.calls.append((name, args, d))
+        return d
+    def notifyOnDisconnect(self, callback):
+        self.disconnect = callback
+
+class Test_PseudoMQClient(TestCase):
+    def setUp(self):
+        self.mq = PseudoMQ(FakeKernel(), 'eventbus',
+                           PelotonSettings(host='127.0.0.1:1'), 
+                           logging.getLogger())
+        self.mq.initialise()
+        self.link = self.mq.links['127.0.0.1:1']
+        self.link._connect = lambda: None
+        self.mq.start()
+        self.acks = []
+
+    def tearDown(self):
+        self.link.running = False
+        if self.link.reconnectCall:
+            self.link.reconnectCall.cancel()
+
+    def _fire(self, i):
+        self.mq.fireEvent('a.b', 'events', i=i).addCallback(self.acks.append)
+
+    def test_reconnect(self):
+        """ Subscriptions are registered in one call and queued events 
+sent in order without waiting for acknowledgement; un-acknowledged events 
+are re-sent after a reconnect. """
+        self.mq.register('a.#', AbstractEventHandler(), 'events')
+        self.mq.register('c.d', AbstractEventHandler(), 'logging')
+        for i in range(3):
+            self._fire(i)
+
+        svr = FakeServer()
+        self.link._clientConnect(svr)
+        names = [c[0] for c in svr.calls]
+        self.assertEquals(names, ['registerMany'] + ['fireEvent']*3)
+        subs = svr.calls[0][1][1]
+        subs.sort()
+        self.assertEquals(subs, [('a.#', 'events', None), 
+                                 ('c.d', 'logging', None)])
+        fired = [PseudoMessage(pickled=c[1][2]).getMessage()['i'] 
+                 for c in svr.calls[1:]]
+        self.assertEquals(fired, [0, 1, 2])
+        
+        svr.calls[1][2].callback(None)
+        self.assertEquals(len(self.acks), 1)
+        svr.disconnect(svr)
+        svr.calls[2][2].errback(pb.PBConnectionLost())
+        self.assertFalse(self.link.connected)
+        self.assertTrue(self.link.reconnectCall.active())
+
+        svr2 = FakeServer()
+        self.link._clientConnect(svr2)
+        fired = [PseudoMessage(pickled=c[1][2]).getMessage()['i'] 
+                 for c in svr2.calls[1:]]
+        self.assertEquals(fired, [1, 2])
+        for c in svr2.calls[1:]:
+            c[2].callback(None)
+        self.assertEquals(len(self.acks), 3)
+
+    def test_fireError(self):
+        """ An error from the server is passed back in the deferred. """
+        svr = FakeServer()
+        self.link._clientConnect(svr)
+        failed = []
+        self.mq.fireEvent('a.b', 'events', i=1).addErrback(failed.append)
+        svr.calls[0][2].errback(Exception("refused"))
+        self.assertEquals(len(failed), 1)
+        self.assertEquals(failed[0].getErrorMessage(), "refused")
+
+    def test_localDelivery(self):
+        """ Local handlers get an event as it is fired; the server is 
+told not to echo it back. Durable exchanges are echoed. """
+        class Handler(AbstractEventHandler):
+            def __init__(self):
+                self.received = []
+            def eventReceived(self, msg, exchange='', key='', ctag=''):
+                self.received.append(msg['i'])
+        self.mq.echoed = ['domain_control']
+        h = Handler()
+        self.mq.register('a.#', h, 'events')
+        self.mq.register('a.#', h, 'domain_control')
+        self._fire(1)
+        self.mq.fireEvent('a.b', 'domain_control', i=2)
+        self.assertEquals(h.received, [1])
+
+        svr = FakeServer()
+        self.link._clientConnect(svr)
+        self.assertEquals(svr.calls[1][1][3], self.link.clientObj)
+        self.assertEquals(svr.calls[2][1][3], None)
+
+    def test_noEchoToOrigin(self):
+        """ The server does not send an event back to the client that 
+fired it. """
+        class FakeClient(object):
+            def __init__(self):
+                self.received = []
+            def callRemote(self, name, msg, exchange, key, ctag):
+                self.received.append(key)
+                return succeed(None)
+        mq = PseudoMQ(FakeKernel(True), 'eventbus',
+                      PelotonSettings(host='127.0.0.1:0'), 
+                      logging.getLogger())
+        mq.initialise()
+        server = PseudoMQServer(mq)
+        a, b = FakeClient(), FakeClient()
+        server.remote_register('x.#', a)
+        server.remote_register('x.#', b)
+        msg = PseudoMessage({'i' : 1}).getPickle()
+        server.remote_fireEvent('x.y', 'events', msg, a)
+        server.remote_fireEvent('x.z', 'events', msg)
+        self.assertEquals(a.received, ['x.z'])
+        self.assertEquals(b.received, ['x.y', 'x.z'])
+
+class Bridge(object):
+    """ Stands in for the PB connection from a server to the client of
+a link, passing events straight through. """
+    def __init__(self, link):
+        self.link = link
+    def callRemote(self, name, *args):
+        getattr(self.link.clientObj, 'remote_%s' % name)(*args)
+        return succeed(None)
+
+class Test_DurableClient(TestCase):
+    """ A client of a durable exchange, served through a Bridge. """
+    def setUp(self):
+        self.dirs = [tempfile.mkdtemp(), tempfile.mkdtemp()]
+        self.client = PseudoMQ(FakeKernel(), 'eventbus',
+                               PelotonSettings(host='127.0.0.1:1',
+                                               durable=['d']), 
+                               logging.getLogger())
+        self.client.initialise()
+        self.link = self.client.links['127.0.0.1:1']
+        self.received = []
+        class Handler(AbstractEventHandler):
+            def eventReceived(h, msg, exchange='', key='', ctag=''):
+                self.received.append(msg['i'])
+        self.handler = Handler()
+
+    def tearDown(self):
+        for d in self.dirs:
+            shutil.rmtree(d)
+
+    def _startServer(self, logdir):
+        mq = PseudoMQ(FakeKernel(True), 'eventbus',
+                      PelotonSettings(host='127.0.0.1:0', durable=['d'],
+                                      logdir=logdir),
+                      logging.getLogger())
+        mq.initialise()
+        ex = mq._addExchange('d')
+        ex.log.inThread = maybeDeferred
+        return mq, PseudoMQServer(mq)
+
+    def _fire(self, mq, *keys):
+        for key, i in keys:
+            mq.fireEvent(key, 'd', i=i)
+        mq.exchanges['d'].log.sync()
+
+    def test_restartWithEmptyLog(self):
+        """ Events from a server restarted without its log are not 
+taken as already seen. """
+        self.client.register('a.#', self.handler, 'd')
+        mq, server = self._startServer(self.dirs[0])
+        bridge = Bridge(self.link)
+        server.remote_registerMany(bridge, self.link._subscriptions())
+        self._fire(mq, ('a.x', 0), ('a.x', 1), ('a.x', 2))
+        self.assertEquals(self.received, [0, 1, 2])
+        mq.exchanges['d'].log.close()
+
+        mq, server = self._startServer(self.dirs[1])
+        server.remote_registerMany(bridge, self.link._subscriptions())
+        self._fire(mq, ('a.x', 3), ('a.x', 4))
+        self.assertEquals(self.received, [0, 1, 2, 3, 4])
+        mq.exchanges['d'].log.close()
+
+    def test_replayPerSubscription(self):
+        """ Replays for each subscription are not lost to the offsets of
+the others. """
+        self.client.register('a.#', self.handler, 'd')
+        self.client.register('b.#', self.handler, 'd')
+        mq, server = self._startServer(self.dirs[0])
+        self._fire(mq, ('a.x', 0), ('b.x', 1), ('a.x', 2), ('b.x', 3))
+        logId = mq.exchanges['d'].log.logId
+        server.remote_registerMany(Bridge(self.link), 
+                                   [('a.#', 'd', (logId, -1)),
+                                    ('b.#', 'd', (logId, -1))])
+        self.received.sort()
+        self.assertEquals(self.received, [0, 1, 2, 3])
+        subscriptions = self.link._subscriptions()
+        subscriptions.sort()
+        self.assertEquals(subscriptions, [('a.#', 'd', (logId, 2)),
+                                          ('b.#', 'd', (logId, 3))])
+        mq.exchanges['d'].log.close()
+
+    def test_whenSent(self):
+        """ An event on an exchange the server owns is acknowledged 
+once it has been sent to the clients, not when queued. """
+        class SlowClient(object):
+            def __init__(self):
+                self.calls = []
+            def callRemote(self, name, *args):
+                d = Deferred()
+                self.calls.append(d)
+                return d
+        mq, server = self._startServer(self.dirs[0])
+        mq.rootObj = server
+        client = SlowClient()
+        server.remote_register('a.#', client)
+        queue = server.subscribers[client]
+        for i in range(queue.maxInFlight):
+            mq.fireEvent('a.b', 'events', i=i)
+        acked = []
+        mq.fireEvent('a.b', 'events', i=-1).addCallback(acked.append)
+        self.assertEquals(acked, [])
+        client.calls[0].callback(None)
+        self.assertEquals(len(acked), 1)
+
+class Test_Federation(TestCase):
+    def setUp(self):
+        self.mq = PseudoMQ(FakeKernel(True), 'eventbus',
+                           PelotonSettings(host='127.0.0.1:1',
+                                   servers=['127.0.0.1:2', '127.0.0.1:1']),
+                           logging.getLogger())
+        self.mq.initialise()
+        self.link = self.mq.links['127.0.0.1:2']
+        # find an exchange owned by each server
+        self.owned = {}
+        i = 0
+        while len(self.owned) < 2:
+            name = 'x%d' % i
+            self.owned.setdefault(self.mq._owner(name), name)
+            i += 1
+
+    def test_ownership(self):
+        """ Exchanges are shared out between servers, the same way on 
+every node. """
+        self.assertEquals(self.mq.links.keys(), ['127.0.0.1:2'])
+        self.assertEquals(self.mq.servers, ['127.0.0.1:1', '127.0.0.1:2'])
+        mine = self.owned['127.0.0.1:1']
+        theirs = self.owned['127.0.0.1:2']
+        self.assertEquals(self.mq._linkFor(mine), None)
+        self.assertEquals(self.mq._linkFor(theirs), self.link)
+
+    def test_bridge(self):
+        """ Registrations and events on exchanges owned by the other 
+server go over the link to it; events are also delivered here. """
+        class Handler(AbstractEventHandler):
+            def __init__(self):
+                self.received = []
+            def eventReceived(self, msg, exchange='', key='', ctag=''):
+                self.received.append(exchange)
+        mine = self.owned['127.0.0.1:1']
+        theirs = self.owned['127.0.0.1:2']
+        h = Handler()
+        self.mq.register('a.#', h, mine)
+        self.mq.register('a.#', h, theirs)
+        self.mq.fireEvent('a.b', mine)
+        self.mq.fireEvent('a.b', theirs)
+        self.assertEquals(h.received, [mine, theirs])
+
+        self.link.running = True
+        svr = FakeServer()
+        self.link._clientConnect(svr)
+        self.assertEquals([c[0] for c in svr.calls], 
+                          ['registerMany', 'fireEvent'])
+        self.assertEquals(svr.calls[0][1][1], [('a.#', theirs, None)])
+        self.assertEquals(svr.calls[1][1][:2], ('a.b', theirs))
+        self.assertEquals(svr.calls[1][1][3], self.link.clientObj)
+        # an event from the owner is delivered here
+        msg = PseudoMessage({}).getPickle()
+        self.link.clientObj.remote_eventReceived(msg, theirs, 'a.c')
+        self.assertEquals(h.received, [mine, theirs, theirs])
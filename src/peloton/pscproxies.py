@@ -9,26 +9,71 @@ from twisted.internet import reactor
 from twisted.internet.error import ConnectionRefusedError
 from twisted.internet.error import ConnectionDone
 from twisted.internet.defer import Deferred
+from twisted.python.failure import Failure
 from peloton.exceptions import PelotonConnectionError
 from peloton.exceptions import PelotonError
 from peloton.exceptions import DeadProxyError
 from peloton.exceptions import NoWorkersError
+from peloton.exceptions import WorkerBusyError
+from peloton.utils.structs import RoundRobinList
+from peloton.events import AbstractEventHandler
 
 from types import StringType
+import time
 
 class PSCProxy(object):        
     """ Base class for PSC proxies through which the routing
 table can exchange messages with PSCs. A proxy is required because
 the PSC may be the local process, a PSC in the domain or a PSC in
 another domain on the grid.
+
+Each proxy keeps an exponentially weighted moving average of the time 
+taken by successful calls (latency, in seconds; None until a call has 
+completed), a count of calls outstanding and a count of the calls that 
+have failed since the last success (callFailures), for use by routing 
+policies. Only failures to reach the PSC or a worker on it count 
+(UNAVAILABLE); these are not sampled for latency: a peer that fails fast 
+would otherwise look like a fast peer. An error raised by the service 
+itself is a completed call, timed and counted as a success.
 """
+    #: weight given to each new latency sample in the moving average
+    LATENCY_DECAY = 0.3
+    #: errors that show the PSC or its workers to be unavailable
+    UNAVAILABLE = (PelotonConnectionError, DeadProxyError, NoWorkersError,
+                   WorkerBusyError, pb.DeadReferenceError, 
+                   pb.PBConnectionLost, ConnectionRefusedError, 
+                   ConnectionDone)
+
     def __init__(self, kernel, profile):
         self.profile = profile
         self.kernel = kernel
         self.logger = kernel.logger
         self.ACCEPTING_REQUESTS = True
         self.RUNNING = True
+        self.latency = None
+        self.outstanding = 0
+        self.callFailures = 0
         
+    def _trackCall(self, d):
+        """ Account for the call whose result will arrive on deferred d
+in the latency average and outstanding count. Returns d. """
+        self.outstanding += 1
+        d.addBoth(self._callTracked, time.time())
+        return d
+
+    def _callTracked(self, rv, started):
+        self.outstanding -= 1
+        if isinstance(rv, Failure) and rv.check(*PSCProxy.UNAVAILABLE):
+            self.callFailures += 1
+        else:
+            self.callFailures = 0
+            sample = time.time() - started
+            if self.latency == None:
+                self.latency = sample
+            else:
+                self.latency += PSCProxy.LATENCY_DECAY * (sample - self.latency)
+        return rv
+
     def call(self, service, method, *args, **kwargs):
         """ Request the serice method be called on this 
 PSC. """
@@ -58,6 +103,8 @@ will be raised.
 """
         rd = Deferred()
         rd._peloton_loopcount = 0 # used in _call
+        rd._peloton_busy = [] # workers that rejected this call as busy
+        self._trackCall(rd)
         self._call(rd, service, method, args, kwargs)
         return rd
     
@@ -65,8 +112,11 @@ will be raised.
         while True:
             try:
     #            p = self.kernel.workerStore[service].getRandomWorker()
-                p = self.kernel.workerStore[service].getNextWorker()
+                workers = self.kernel.workerStore[service]
+                p = workers.getNextWorker(rd._peloton_busy)
                 d = p.callRemote('call',method, *args, **kwargs)
+                workers.callStarted(p)
+                d.addBoth(self.__callDone, workers, p)
                 d.addCallback(rd.callback)
                 d.addErrback(self.__callError, rd, p, service, method, args, kwargs)
                 break
@@ -87,7 +137,25 @@ will be raised.
                     rd._peloton_loopcount+=1
                     reactor.callLater(0.01, self._call, rd, service, method, args, kwargs)
                 break
+
+            except WorkerBusyError, ex:
+                # every worker has turned this call away. Back off briefly
+                # then offer it to all of them again, giving up after 3 
+                # seconds as above.
+                rd._peloton_busy = []
+                if rd._peloton_loopcount >= 300:
+                    rd.errback(ex)
+                else:
+                    rd._peloton_loopcount+=1
+                    reactor.callLater(0.01, self._call, rd, service, method, args, kwargs)
+                break
    
+    def __callDone(self, rv, workers, p):
+        """ Decrement the outstanding call count on the worker, passing
+through the result or error. """
+        workers.callFinished(p)
+        return rv
+
     def __callError(self, err, rd, p, service, method, args, kwargs):
         """ A twisted error occured when making the remote call. This is going
 to be one of:
@@ -102,6 +170,8 @@ to be one of:
       in future the old worker may well finish the job so this error will not
       be raised. This condition is signified by err.value being a ConnectionDone
       instance.
+    - The worker was saturated and turned the call away without starting it
+      (WorkerBusyError). The call is re-issued to another worker.
 """
         if isinstance(err.value, pb.PBConnectionLost) or \
              isinstance(err.value, ConnectionDone):
@@ -110,6 +180,9 @@ to be one of:
                 self._call(rd, service, method, args, kwargs)
             else:
                 rd.errback(NoWorkersError("No workers for service %s" % service))
+        elif err.check(WorkerBusyError):
+            rd._peloton_busy.append(p)
+            self._call(rd, service, method, args, kwargs)
         else:
             rd.errback(err)
         
@@ -117,14 +190,56 @@ class TwistedPSCProxy(PSCProxy):
     """ Proxy for a PSC that is running on the same domain as this 
 node and accepts Twisted PB RPC. This is the prefered proxy to use
 if a node supports it and if it is suitably located (i.e. same 
-domain)."""
+domain).
+
+A small pool of PB connections (peerConnections, default 2) is kept
+to the peer and calls are spread over them round robin. Connections are 
+made on demand. Should all of them be lost, or a connect fail, the proxy 
+keeps accepting requests, parking them in requestCache, and retries with 
+exponential backoff. Each retry is a single 'half-open' connection; only 
+once that succeeds is the rest of the pool re-opened. A parked request 
+that is not sent within peerRequestTimeout seconds (default 10) fails 
+with a DeadProxyError.
+
+Calls made within relayBatchWindow seconds of each other (default 0, 
+i.e. within the same pass of the reactor) are coalesced, up to 
+relayBatchSize (default 50) at a time, into a single relayCalls message 
+to the peer. Each caller's deferred is fired individually from the vector 
+of results. Setting relayBatchSize to 1 sends every call on its own.
+"""
+    #: first reconnect delay in seconds; doubled on each failure
+    BACKOFF_BASE = 0.5
+    #: longest delay between reconnect attempts, in seconds
+    BACKOFF_MAX = 30.0
+
     def __init__(self, kernel, profile):
         PSCProxy.__init__(self, kernel, profile)
-        self.peer = None
-        self.remoteRef = None
-        self.CONNECTING = False
-        self.ACCEPTING_REQUESTS = True
+        settings = kernel.settings
+        if settings.has_key('peerConnections'):
+            self.poolSize = max(1, int(settings.peerConnections))
+        else:
+            self.poolSize = 2
+        if settings.has_key('peerRequestTimeout'):
+            self.parkTimeout = float(settings.peerRequestTimeout)
+        else:
+            self.parkTimeout = 10.0
+        if settings.has_key('relayBatchSize'):
+            self.batchSize = max(1, int(settings.relayBatchSize))
+        else:
+            self.batchSize = 50
+        if settings.has_key('relayBatchWindow'):
+            self.batchWindow = float(settings.relayBatchWindow)
+        else:
+            self.batchWindow = 0
+        self.batch = []
+        self.batchCall = None
+        self.connections = RoundRobinList()
+        self.connecting = 0
+        self.failures = 0
+        self.reconnectCall = None
         self.requestCache = []
+        # schedules batches, parked request timeouts and reconnects
+        self.clock = reactor
         
         # deferreds that need calling back when the connection
         # is made
@@ -134,51 +249,97 @@ domain)."""
         if not self.ACCEPTING_REQUESTS:
             raise DeadProxyError("Cannot accept requests.")
         d = Deferred()
-        if self.remoteRef == None:
-            self.requestCache.append([d, service, method, args, kwargs])
-            sud = Deferred()
-            sud.addCallback(self.flushRequests)
-            sud.addErrback(self.flushRequestsErr)
-            self.startupListeners.append(sud)
-            if not self.CONNECTING:
-                self.__connect()
+        if not self.connections:
+            self.__park(d, service, method, args, kwargs)
         else:
-            try:
-                self.__call(d, service, method, args, kwargs)
-            except pb.DeadReferenceError:
-                self.ACCEPTING_REQUESTS = False
-                raise DeadProxyError("Dead reference to remote PSC")
-        return d
+            self.__call(d, service, method, args, kwargs)
+        return self._trackCall(d)
     
     def __call(self, d, service, method, args, kwargs):
-        cd = self.remoteRef.callRemote('relayCall', service, method, *args, **kwargs)
-        cd.addCallback(d.callback)
-        cd.addErrback(self.__callError, d, service, method)
+        """ Add the request to the batch for the peer, sending the batch
+now if it is full. """
+        self.batch.append([d, service, method, args, kwargs])
+        if len(self.batch) >= self.batchSize:
+            self.__sendBatch()
+        elif not self.batchCall:
+            self.batchCall = self.clock.callLater(self.batchWindow, self.__sendBatch)
+
+    def __sendBatch(self):
+        if self.batchCall and self.batchCall.active():
+            self.batchCall.cancel()
+        self.batchCall = None
+        batch, self.batch = self.batch, []
+        if not batch:
+            return
+        while self.connections:
+            ref = self.connections.rrnext()
+            try:
+                if len(batch) == 1:
+                    d, service, method, args, kwargs = batch[0]
+                    cd = ref.callRemote('relayCall', service, method, *args, **kwargs)
+                    cd.addCallback(d.callback)
+                    cd.addErrback(self.__callError, d)
+                else:
+                    calls = [req[1:] for req in batch]
+                    cd = ref.callRemote('relayCalls', calls)
+                    cd.addCallback(self.__batchResult, batch)
+                    cd.addErrback(self.__batchError, batch)
+            except pb.DeadReferenceError:
+                self.__dropConnection(ref)
+                continue
+            return
+        for req in batch:
+            self.__park(*req)
+
+    def __batchResult(self, results, batch):
+        """ Fire each caller's deferred with its result from the vector 
+returned by relayCalls. """
+        for req, (ok, value) in zip(batch, results):
+            if ok:
+                req[0].callback(value)
+            else:
+                req[0].errback(value)
+
+    def __batchError(self, err, batch):
+        for req in batch:
+            self.__callError(err, req[0])
     
-    def __callError(self, err, d, service, method):
-#        self.logger.error("** Call error calling %s.%s: %s" % (service, method, err.parents[-1]))
-        if err.parents[-1] == 'twisted.spread.pb.PBConnectionDone' or \
-           err.parents[-1] == 'twisted.spread.pb.PBConnectionLost':
-#            self.logger.error("CALL ERROR %s CALLING %s.%s" % (err.parents[-1], service, method))
-            d.errback(DeadProxyError("Peer closed connection"))
+    def __callError(self, err, d):
+        if err.check(pb.PBConnectionLost, ConnectionDone):
+            # the request may be re-issued; a fresh connection will be
+            # made to service it.
+            d.errback(PelotonConnectionError("Peer closed connection"))
         else:
             d.errback(err)
     
+    def __park(self, d, service, method, args, kwargs):
+        """ Hold a request until a connection is available. """
+        req = [d, None, service, method, args, kwargs]
+        req[1] = self.clock.callLater(self.parkTimeout, self.__parkExpired, req)
+        self.requestCache.append(req)
+        self.__connect()
+    
+    def __parkExpired(self, req):
+        try:
+            self.requestCache.remove(req)
+        except ValueError:
+            return
+        req[0].errback(DeadProxyError("Timed out waiting for connection to peer"))
+    
     def getInterface(self, name):
         d = Deferred()
-        if self.remoteRef == None:
+        if not self.connections:
             sud = Deferred()
             self.startupListeners.append(sud)
             sud.addCallback(self._getInterface,d, name)
             sud.addErrback(self._getInterfaceErr, d)
-            if not self.CONNECTING:
-                self.__connect()
+            self.__connect()
         else:
             self._getInterface(0, d, name)
         return d
     
     def _getInterface(self, _, d, name):
-        dd = self.remoteRef.callRemote("getInterface", name)
+        dd = self.connections.rrnext().callRemote("getInterface", name)
         dd.addCallback(d.callback)
         dd.addErrback(d.errback)
           
@@ -187,62 +348,236 @@ domain)."""
         
     def __connect(self):
         """ Connections to peers are made on demand so that only
-links that are actively used get made. This is the start of the
-connect sequence."""
-        self.CONNECTING = True
-#        self.logger.debug("CONNECT TO REMOTE PSC")
+links that are actively used get made. If no connection exists and
+none is being attempted, make one now unless a backoff is pending."""
+        if self.connections or self.connecting or \
+           self.reconnectCall or not self.RUNNING:
+            return
+        self.__openConnection()
+
+    def __openConnection(self):
+        """ This is the start of the connect sequence. """
+        self.connecting += 1
+        cd = self._getRootObject()
+        cd.addCallback(self.__peerConnect)
+        cd.addErrback(self.__connectError, "Error connecting to peer")
+    
+    def _getRootObject(self):
+        """ Open a PB connection to the peer and return a deferred for
+its root object. """
         factory = pb.PBClientFactory()
         reactor.connectTCP(self.profile['ipaddress'], 
                            self.profile['port'], 
                            factory)
-        cd = factory.getRootObject()
-        cd.addCallback(self.__peerConnect)
-        cd.addErrback(self.__connectError, "Error connecting to peer")
-    
+        return factory.getRootObject()
+
     def __peerConnect(self, peer):
-        self.peer = peer
         pd = peer.callRemote('registerPSC', self.kernel.guid)
-        pd.addCallback(self.__refReceived)
+        pd.addCallback(self.__refReceived, peer)
         pd.addErrback(self.__connectError, "Error receiving remote reference")
         
-    def __refReceived(self, ref):
-        self.remoteRef = ref
-        self.CONNECTING = False
+    def __refReceived(self, ref, peer):
+        self.connecting -= 1
+        if not self.RUNNING:
+            peer.broker.transport.loseConnection()
+            return
+        self.failures = 0
+        self.connections.append(ref)
+        peer.notifyOnDisconnect(self.__connectionLost)
+        self.__fillPool()
+        self.flushRequests()
         while self.startupListeners:
             self.startupListeners.pop().callback(True)
 
     def __connectError(self, err, msg):
-        self.ACCEPTING_REQUESTS = False
-        self.CONNECTING = False
-        self.logger.error("TwistedPSCProxy: %s" % msg)
+        self.connecting -= 1
+        if not self.RUNNING:
+            return
+        self.failures += 1
+        self.logger.error("TwistedPSCProxy: %s (%s)" % (msg, err.getErrorMessage()))
         while self.startupListeners:
             self.startupListeners.pop().errback(err)
+        if not self.connections and not self.connecting:
+            self.__scheduleReconnect()
+
+    def __scheduleReconnect(self):
+        """ Probe the peer again after a delay that doubles with each
+consecutive failure. """
+        if self.reconnectCall or not self.requestCache:
+            # nobody waiting; the next request will connect on demand.
+            return
+        delay = min(TwistedPSCProxy.BACKOFF_MAX, 
+                    TwistedPSCProxy.BACKOFF_BASE * 2**(self.failures-1))
+        self.reconnectCall = self.clock.callLater(delay, self.__probe)
+
+    def __probe(self):
+        self.reconnectCall = None
+        self.__connect()
+
+    def __fillPool(self):
+        """ Open connections until the pool is full. """
+        while len(self.connections) + self.connecting < self.poolSize:
+            self.__openConnection()
+
+    def __connectionLost(self, peer):
+        for ref in self.connections[:]:
+            if ref.broker is peer.broker:
+                self.__dropConnection(ref)
+
+    def __dropConnection(self, ref):
+        try:
+            self.connections.remove(ref)
+        except ValueError:
+            pass
+        if not self.connections and self.requestCache:
+            self.__connect()
             
-    def flushRequests(self, _):
+    def flushRequests(self, _=None):
         self.logger.debug("Flushing %d requests" % len(self.requestCache))
-        while self.requestCache:
+        while self.requestCache and self.connections:
             req = self.requestCache.pop(0)
-            d = req[0]
-            request = req[1:]
-            self.__call(d, *request)
+            req[1].cancel()
+            self.__call(req[0], *req[2:])
         
     def flushRequestsErr(self, err):
-        """ Called if there was a failure connecting to PSC. """
+        """ Fail all parked requests. """
         while self.requestCache:
             req = self.requestCache.pop(0)
-            d = req[0]
-            d.errback(DeadProxyError("Peer not present before connect (%s)" % err.getErrorMessage()))
+            req[1].cancel()
+            req[0].errback(DeadProxyError("Peer not available (%s)" % err))
 
     def stop(self):
         if self.RUNNING:
             self.ACCEPTING_REQUESTS = False
             PSCProxy.stop(self)
-            self.peer = self.remoteRef = None
+            if self.reconnectCall:
+                self.reconnectCall.cancel()
+                self.reconnectCall = None
+            if self.batchCall and self.batchCall.active():
+                self.batchCall.cancel()
+            self.batchCall = None
+            while self.batch:
+                self.batch.pop(0)[0].errback(DeadProxyError("Proxy stopped"))
+            self.flushRequestsErr("proxy stopped")
+            for ref in self.connections:
+                ref.broker.transport.loseConnection()
+            self.connections = RoundRobinList()
           
+class BusReplyChannel(AbstractEventHandler):
+    """ The single channel on which replies to RPC requests sent over
+the message bus by this node arrive: key psc.<guid>.rpcreply on the 
+domain_control exchange. Each request is given a correlation ID against
+which the deferred awaiting its reply is held; replies are matched on this
+ID so that any number of requests may be outstanding, and answered in
+any order. 
+
+One channel is kept per node; obtain it with getBusReplyChannel(kernel).
+"""
+    def __init__(self, kernel):
+        AbstractEventHandler.__init__(self)
+        self.logger = kernel.logger
+        self.replyKey = 'psc.%s.rpcreply' % kernel.guid
+        self.guid = kernel.guid
+        self.counter = 0
+        # correlation ID -> [deferred, timeout DelayedCall]
+        self.pending = {}
+        kernel.dispatcher.register(self.replyKey, self, 'domain_control')
+
+    def expect(self, d, timeout):
+        """ Hold deferred d against a new correlation ID which is returned.
+If no reply is received within timeout seconds d fails with a 
+DeadProxyError. """
+        self.counter += 1
+        corrId = "%s.%d" % (self.guid, self.counter)
+        self.pending[corrId] = [d, reactor.callLater(timeout, self.cancel, corrId, 
+                         DeadProxyError("No reply to bus RPC request in %ss" % timeout))]
+        return corrId
+    
+    def cancel(self, corrId, err):
+        """ Stop waiting for the reply to corrId and fail its deferred with
+err. """
+        try:
+            d, timeout = self.pending.pop(corrId)
+        except KeyError:
+            return
+        if timeout.active():
+            timeout.cancel()
+        d.errback(err)
+        
+    def eventReceived(self, msg, exchange='', key='', ctag=''):
+        try:
+            d, timeout = self.pending.pop(msg['corrId'])
+        except KeyError:
+            # reply arrived after we'd given up waiting
+            self.logger.debug("Unexpected bus RPC reply: %s" % msg['corrId'])
+            return
+        if timeout.active():
+            timeout.cancel()
+        if msg['ok']:
+            d.callback(msg['result'])
+        else:
+            err = msg['error']
+            if not isinstance(err, Exception):
+                err = PelotonError(str(err))
+            d.errback(err)
+
+def getBusReplyChannel(kernel):
+    """ Return the bus RPC reply channel for this kernel, creating and 
+registering it if need be. It is held as kernel.busReplyChannel. """
+    if kernel.busReplyChannel == None:
+        kernel.busReplyChannel = BusReplyChannel(kernel)
+    return kernel.busReplyChannel
+
 class MessageBusPSCProxy(PSCProxy):
     """ Proxy for a PSC that is able only to accept RPC calls over
-the message bus for whatever reason. """
-    pass
+the message bus for whatever reason, for example because it cannot be 
+reached directly by PB.
+
+Requests are fired on the domain_control exchange with key psc.<guid>.rpc,
+guid being that of the target PSC, where they are picked up by its
+PelotonBusAdapter. Each carries a correlation ID and the key of this node's
+BusReplyChannel on which the result is to be returned. Calls are pipelined:
+there is no limit to the number outstanding. A call that is not answered
+within busRequestTimeout seconds (default 30) fails with DeadProxyError.
+"""
+    def __init__(self, kernel, profile):
+        PSCProxy.__init__(self, kernel, profile)
+        self.dispatcher = kernel.dispatcher
+        self.requestKey = 'psc.%s.rpc' % profile['guid']
+        self.replyChannel = getBusReplyChannel(kernel)
+        if kernel.settings.has_key('busRequestTimeout'):
+            self.timeout = float(kernel.settings.busRequestTimeout)
+        else:
+            self.timeout = 30.0
+        # correlation IDs of calls awaiting reply
+        self.outstandingIds = {}
+        
+    def call(self, service, method, *args, **kwargs):
+        if not self.ACCEPTING_REQUESTS:
+            raise DeadProxyError("Cannot accept requests.")
+        d = Deferred()
+        corrId = self.replyChannel.expect(d, self.timeout)
+        self.outstandingIds[corrId] = True
+        d.addBoth(self.__replied, corrId)
+        self.dispatcher.fireEvent(self.requestKey, 'domain_control',
+                                  corrId=corrId,
+                                  replyTo=self.replyChannel.replyKey,
+                                  service=service,
+                                  method=method,
+                                  args=args,
+                                  kwargs=kwargs)
+        return self._trackCall(d)
+    
+    def __replied(self, rv, corrId):
+        del(self.outstandingIds[corrId])
+        return rv
+    
+    def stop(self):
+        if self.RUNNING:
+            self.ACCEPTING_REQUESTS = False
+            PSCProxy.stop(self)
+            for corrId in self.outstandingIds.keys():
+                self.replyChannel.cancel(corrId, DeadProxyError("Proxy stopped"))
 
 
 # mapping of proxy to specific RPC mechanisms
@@ -3,12 +3,12 @@
 # Copyright (c) 2007-2008 ReThought Limited and Peloton Contributors
 # All Rights Reserved
 # See LICENSE for details
-from twisted.spread import pb
 from twisted.internet import reactor
 from peloton.utils.config import locateService
 from peloton.utils.config import findTemplateTargetsFor
 from peloton.utils.config import PelotonSettings
 import peloton.utils.logging as logging
+from peloton.events import EventReceiver
 
 class PelotonService(object):
     """ Base class for all services. Public methods all have names prefixed
@@ -150,7 +150,8 @@ Can be used to setup database pools etc. Overide in actual services. """
 Can be used to cleanup database pools etc. Overide in actual services. """
         pass
     
-    def register(self, key, method, exchange='events', inThread=True):
+    def register(self, key, method, exchange='events', inThread=True, 
+                 batchWindow=0, maxQueued=1000, overflow='dropoldest'):
         """ Registers method (which must have signature msg, exchange,
 key, ctag) to be the target for events on exchange with key matching the 
 specified pattern. By default inThread is True which means the event
@@ -158,9 +159,18 @@ handler will be called in a thread. If set False the event will be handled
 in the main event loop so care must be taken not to perform long-running
 operations in handlers that operate in this manner.
 
+If batchWindow is greater than zero the PSC collects events for up to
+that many seconds and sends them to this worker together; the method
+is still called once per event. Use this for busy keys.
+
+The PSC holds at most maxQueued events waiting to be sent to this worker.
+Should more arrive, overflow determines whether the oldest (dropoldest) or
+newest (dropnewest) are discarded, or the worker's subscription dropped
+(disconnect).
+
 The handler class is returned by this method; keeping a reference to it
 enables the service to de-register the handler subsequently."""
-        class ServiceMethodHandler(pb.Referenceable):
+        class ServiceMethodHandler(EventReceiver):
             def __init__(self, handler, inThread=True):
                 self.handler = handler
                 self.inThread = inThread
@@ -172,7 +182,8 @@ enables the service to de-register the handler subsequently."""
                     self.handler(msg, exchange, key, ctag)
 
         handler = ServiceMethodHandler(method, inThread)
-        reactor.callFromThread(self.dispatcher.register, key, handler, exchange)
+        reactor.callFromThread(self.dispatcher.register, key, handler, 
+                               exchange, batchWindow, maxQueued, overflow)
         return handler
             
     def deregister(self, handler):
@@ -25,4 +25,21 @@ def transform(transformKey, *transformList):
     return setKey("transform.%s"%transformKey, list(transformList))
         
 def mimeType(target, mimeType):
-    return setKey("mimetype.%s" % target, mimeType)
\ No newline at end of file
+    return setKey("mimetype.%s" % target, mimeType)
+
+def asynchronous(f):
+    """ Mark a public method as asynchronous: rather than being run in a 
+thread it is called directly in the worker's event loop and must not block. 
+It may return a Deferred, which is passed back to the PSC when it fires. """
+    return setKey("asynchronous", True)(f)
+
+def threadedTransform(f):
+    """ Mark a public method as having output transforms that must not be
+run in the PSC event loop. Chains that include a template or serialise the
+whole result are run in a thread anyway; this is for any others. """
+    return setKey("threadedTransform", True)(f)
+
+def transformInWorker(f):
+    """ Mark a public method as having its output transformed in the worker
+that runs it, so that the PSC only passes on the result. """
+    return setKey("transformInWorker", True)(f)
@@ -0,0 +1,118 @@
+# $Id$
+#
+# Copyright (c) 2007-2008 ReThought Limited and Peloton Contributors
+# All Rights Reserved
+# See LICENSE for details
+""" Test RPC between PSCs over the message bus, using a PseudoMQ server
+in this process as the bus. """
+
+from unittest import TestCase
+from twisted.internet.defer import Deferred
+from twisted.internet.defer import fail
+from peloton.adapters.bus import PelotonBusAdapter
+from peloton.pscproxies import MessageBusPSCProxy
+from peloton.plugins.pseudomq import PseudoMQ
+from peloton.utils.config import PelotonSettings
+from peloton.exceptions import DeadProxyError
+from peloton.exceptions import ServiceError
+import peloton.utils.logging as logging
+
+class FakeLocalProxy(object):
+    """ Stands in for the local PSC; calls are held until answered by the
+test. """
+    def __init__(self):
+        self.calls = []
+
+    def call(self, service, method, *args, **kwargs):
+        if method == 'fail':
+            return fail(ServiceError("failed %s" % str(args)))
+        d = Deferred()
+        self.calls.append((d, args))
+        return d
+
+class FakeRoutingTable(object):
+    def __init__(self):
+        self.localProxy = FakeLocalProxy()
+
+    def removeHandlerForService(self, *args, **kwargs):
+        pass
+
+class NodeDispatcher(object):
+    """ Dispatcher for one node onto the shared bus. """
+    def __init__(self, guid, bus):
+        self.guid = guid
+        self.bus = bus
+
+    def register(self, key, handler, exchange='events'):
+        self.bus.register(key, handler, exchange)
+
+    def deregister(self, handler):
+        self.bus.deregister(handler)
+
+    def fireEvent(self, key, exchange='events', **kwargs):
+        kwargs['sender_guid'] = self.guid
+        self.bus.fireEvent(key, exchange, **kwargs)
+
+class FakeKernel(object):
+    def __init__(self, guid, bus):
+        self.guid = guid
+        self.logger = logging.getLogger()
+        self.settings = PelotonSettings()
+        self.profile = PelotonSettings(guid=guid)
+        self.dispatcher = NodeDispatcher(guid, bus)
+        self.routingTable = FakeRoutingTable()
+        self.busReplyChannel = None
+
+    def hasFlag(self, flag):
+        return flag == 'mqserver'
+
+class Test_BusRPC(TestCase):
+    def setUp(self):
+        busKernel = FakeKernel('bus', None)
+        self.bus = PseudoMQ(busKernel, 'eventbus',
+                            PelotonSettings(host='127.0.0.1:0'), busKernel.logger)
+        self.bus.initialise()
+        self.client = FakeKernel('client', self.bus)
+        self.server = FakeKernel('server', self.bus)
+        self.adapter = PelotonBusAdapter(self.server)
+        self.adapter.start()
+        self.proxy = MessageBusPSCProxy(self.client, self.server.profile)
+        self.results = []
+
+    def tearDown(self):
+        self.proxy.stop()
+        self.adapter.stop()
+        self.bus.stop()
+
+    def _call(self, *args):
+        d = self.proxy.call('svc', 'method', *args)
+        d.addBoth(self.results.append)
+        return d
+
+    def test_pipelinedCalls(self):
+        """ Several calls are outstanding at once and are answered
+in whatever order the server completes them. """
+        for i in range(3):
+            self._call(i)
+        calls = self.server.routingTable.localProxy.calls
+        self.assertEquals(len(calls), 3)
+        self.assertEquals(self.proxy.outstanding, 3)
+        calls.reverse()
+        for d, args in calls:
+            d.callback(args[0]*10)
+        self.assertEquals(self.results, [20, 10, 0])
+        self.assertEquals(self.proxy.outstanding, 0)
+
+    def test_errorReturned(self):
+        self.proxy.call('svc', 'fail', 1).addErrback(self.results.append)
+        self.assertEquals(len(self.results), 1)
+        self.assertTrue(self.results[0].check(ServiceError))
+
+    def test_stopFailsOutstanding(self):
+        self._call(1)
+        self.proxy.stop()
+        self.assertTrue(self.results[0].check(DeadProxyError))
+        self.assertRaises(DeadProxyError, self.proxy.call, 'svc', 'method')
+        # a late reply is ignored
+        self.server.routingTable.localProxy.calls[0][0].callback(1)
+        self.assertEquals(len(self.results), 1)
@@ -0,0 +1,220 @@
+# $Id$
+#
+# Copyright (c) 2007-2008 ReThought Limited and Peloton Contributors
+# All Rights Reserved
+# See LICENSE for details
+""" Test batched, flow controlled delivery of events to remote handlers
+and the reporting of events the bus failed to publish. """
+
+from unittest import TestCase
+from twisted.spread.pb import DeadReferenceError
+from twisted.internet.defer import Deferred
+from twisted.internet.defer import succeed
+from twisted.internet.defer import fail
+from peloton.events import RemoteEventHandler
+from peloton.events import EventReceiver
+from peloton.events import SubscriberQueue
+from peloton.events import getSubscriberStats
+from peloton.events import EventDispatcher
+from peloton.kernel import PelotonKernel
+from peloton.utils.config import PelotonSettings
+from peloton.exceptions import ConfigurationError
+from peloton.exceptions import MessagingError
+
+class FakeRemoteRef(object):
+    """ Delivers callRemote straight to a local EventReceiver. If stalled,
+the deferreds returned are held, unfired, in pending. """
+    def __init__(self, receiver):
+        self.receiver = receiver
+        self.calls = []
+        self.dead = False
+        self.stalled = False
+        self.pending = []
+
+    def callRemote(self, name, *args):
+        if self.dead:
+            raise DeadReferenceError("gone")
+        self.calls.append(name)
+        getattr(self.receiver, 'remote_%s' % name)(*args)
+        if self.stalled:
+            d = Deferred()
+            self.pending.append(d)
+            return d
+        return succeed(None)
+
+class Receiver(EventReceiver):
+    def __init__(self):
+        self.events = []
+
+    def remote_eventReceived(self, msg, exchange, key, ctag):
+        self.events.append((msg, key))
+
+class Test_RemoteEventDelivery(TestCase):
+    def setUp(self):
+        self.receiver = Receiver()
+        self.ref = FakeRemoteRef(self.receiver)
+
+    def test_unbatched(self):
+        h = RemoteEventHandler(self.ref)
+        h.eventReceived(1, 'events', 'a')
+        h.eventReceived(2, 'events', 'b')
+        self.assertEquals(self.ref.calls, ['eventReceived', 'eventReceived'])
+        self.assertEquals(self.receiver.events, [(1, 'a'), (2, 'b')])
+
+    def test_batched(self):
+        """ Events are held until the batch fills or is flushed, then
+unpacked in order on the receiving side. """
+        h = RemoteEventHandler(self.ref, batchWindow=10, batchSize=3)
+        for i in range(4):
+            h.eventReceived(i, 'events', 'k%d' % i)
+        self.assertEquals(self.ref.calls, ['eventsReceived'])
+        self.assertEquals(self.receiver.events, 
+                          [(0, 'k0'), (1, 'k1'), (2, 'k2')])
+        h.queue.flush()
+        self.assertEquals(self.ref.calls, ['eventsReceived', 'eventsReceived'])
+        self.assertEquals(self.receiver.events[-1], (3, 'k3'))
+        self.assertEquals(h.queue.flushCall, None)
+
+    def test_deadSubscriber(self):
+        h = RemoteEventHandler(self.ref, batchWindow=10)
+        h.eventReceived(1, 'events', 'a')
+        self.ref.dead = True
+        h.queue.flush()
+        self.assertRaises(DeadReferenceError, h.eventReceived, 2, 'events', 'a')
+
+    def _stalledQueue(self, overflow):
+        self.ref.stalled = True
+        q = SubscriberQueue(self.ref, maxQueued=2, overflow=overflow)
+        q.maxInFlight = 1
+        for i in range(4):
+            q.add(i)
+        return q
+
+    def test_dropOldest(self):
+        q = self._stalledQueue('dropoldest')
+        self.assertEquals(q.inFlight, 1)
+        self.assertEquals([e[0] for e in q.events], [2, 3])
+        self.assertEquals(q.dropped, 1)
+        # acknowledging the message in flight releases the next
+        self.ref.pending.pop(0).callback(None)
+        self.assertEquals([e[0] for e in self.receiver.events], [0, 2])
+        self.assertEquals(q.getStats()['queued'], 1)
+
+    def test_dropNewest(self):
+        q = self._stalledQueue('dropnewest')
+        self.assertEquals([e[0] for e in q.events], [1, 2])
+        self.assertEquals(q.dropped, 1)
+
+    def test_disconnect(self):
+        self.ref.stalled = True
+        q = SubscriberQueue(self.ref, maxQueued=1, overflow='disconnect')
+        q.maxInFlight = 1
+        q.add(0)
+        q.add(1)
+        self.assertRaises(DeadReferenceError, q.add, 2)
+        self.assertTrue(q.dead)
+        self.assertEquals(list(q.events), [])
+        self.assertRaises(ConfigurationError, SubscriberQueue, self.ref, 
+                          overflow='explode')
+
+    def test_stats(self):
+        q = SubscriberQueue(self.ref, name='test.stats')
+        q.add(0)
+        stats = [st for st in getSubscriberStats() if st['name'] == 'test.stats']
+        self.assertEquals(len(stats), 1)
+        self.assertEquals(stats[0]['sent'], 1)
+
+class FakeLogger(object):
+    def __init__(self):
+        self.errors = []
+
+    def error(self, msg):
+        self.errors.append(msg)
+
+    def debug(self, msg):
+        pass
+
+class FakeBus(object):
+    """ An event bus that fails to publish on the exchange 'down'. """
+    def __init__(self):
+        self.fired = []
+
+    def register(self, key, handler, exchange):
+        pass
+
+    def deregister(self, handler):
+        pass
+
+    def getRegisteredExchanges(self):
+        return []
+
+    def fireEvent(self, key, exchange='events', **kwargs):
+        self.fired.append((key, exchange, kwargs))
+        if exchange == 'down':
+            return fail(MessagingError("bus down"))
+        return succeed(None)
+
+class BusKernel(object):
+    def __init__(self):
+        self.logger = FakeLogger()
+        self.plugins = {'eventbus' : FakeBus()}
+
+class Test_FireFailure(TestCase):
+    def setUp(self):
+        self.kernel = BusKernel()
+        self.dispatcher = EventDispatcher(self.kernel)
+
+    def test_preInit(self):
+        self.dispatcher.fireEvent('a.b', 'events', i=1)
+        self.dispatcher.joinExternalBus()
+        self.assertEquals(self.kernel.plugins['eventbus'].fired, 
+                          [('a.b', 'events', {'i' : 1})])
+
+    def test_logged(self):
+        """ A failure is logged for those not waiting on the event. """
+        self.dispatcher.joinExternalBus()
+        results = []
+        self.dispatcher.fireEvent('a.b', 'down').addBoth(results.append)
+        self.assertEquals(results, [None])
+        self.assertEquals(len(self.kernel.logger.errors), 1)
+        self.assertTrue(self.kernel.logger.errors[0].startswith(
+                        "Could not fire event a.b on down"))
+
+    def test_confirmed(self):
+        """ A failure is passed back to those that wait on the event. """
+        self.dispatcher.joinExternalBus()
+        results = []
+        d = self.dispatcher.fireConfirmedEvent('a.b', 'down')
+        d.addErrback(results.append)
+        self.assertTrue(results[0].check(MessagingError))
+        self.assertEquals(self.kernel.logger.errors, [])
+
+class Kernel(PelotonKernel):
+    def _trapExit(self):
+        pass
+
+    def closedown(self, x=0):
+        self.closed = x
+
+class FakeTimeout(object):
+    def __init__(self):
+        self.cancelled = False
+
+    def active(self):
+        return not self.cancelled
+
+    def cancel(self):
+        self.cancelled = True
+
+class Test_DisconnectAcknowledged(TestCase):
+    def test_failed(self):
+        """ Closedown goes on at once, the failure logged, should the 
+domain not be notified. """
+        kernel = Kernel(PelotonSettings())
+        kernel.logger = FakeLogger()
+        timeout = FakeTimeout()
+        fail(MessagingError("bus down")).addBoth(
+            kernel._disconnectAcknowledged, timeout)
+        self.assertTrue(timeout.cancelled)
+        self.assertEquals(kernel.closed, 1)
+        self.assertEquals(len(kernel.logger.errors), 1)
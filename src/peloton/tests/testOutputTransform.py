@@ -0,0 +1,142 @@
+# $Id$
+#
+# Copyright (c) 2007-2008 ReThought Limited and Peloton Contributors
+# All Rights Reserved
+# See LICENSE for details
+""" Test where the output of service methods is transformed """
+
+from unittest import TestCase
+from twisted.internet.defer import succeed
+from twisted.internet.defer import Deferred
+from twisted.internet.defer import DeferredSemaphore
+from peloton.coreio import OutputTransform
+from peloton.coreio import PelotonRequestInterface
+from peloton.coreio import TRANSFORM_TARGET_KEY
+from peloton.mapping import ServiceLibrary
+from peloton.utils.config import PelotonSettings
+from peloton.exceptions import ServiceConfigurationError
+
+class FakeProxy(object):
+    def __init__(self):
+        self.calls = []
+
+    def call(self, service, method, *args, **kwargs):
+        self.calls.append((method, args, kwargs))
+        return succeed({'a' : 1})
+
+class FakeRoutingTable(object):
+    def __init__(self):
+        self.proxy = FakeProxy()
+
+    def getPscProxyForService(self, service):
+        return self.proxy
+
+def makeProfile(publishedName, methodProperties):
+    """ Return a profile as received by ServiceLibrary.setProfile for the
+list of (method name, properties). """
+    methods = PelotonSettings()
+    for name, properties in methodProperties:
+        methods[name] = PelotonSettings(properties=str(properties))
+    return PelotonSettings(publishedName=publishedName,
+                           resourceRoot='/tmp/%s' % publishedName,
+                           methods=methods)
+
+class FakeKernel(object):
+    def __init__(self):
+        self.profile = PelotonSettings()
+        self.settings = PelotonSettings()
+        self.routingTable = FakeRoutingTable()
+        self.transformLimiter = DeferredSemaphore(2)
+        self.serviceLibrary = ServiceLibrary()
+        self.serviceLibrary.setProfile(makeProfile('Svc',
+                [('cheap', {'transform.txt' : ['upperKeys', 'string']}),
+                 ('expensive', {'transform.txt' : ['upperKeys', 'string'],
+                                'threadedTransform' : True}),
+                 ('inWorker', {'transform.html' : ['defaultHTMLTransform'],
+                               'transformInWorker' : True})]))
+
+class Test_OutputTransform(TestCase):
+    def setUp(self):
+        self.kernel = FakeKernel()
+        self.ri = PelotonRequestInterface(self.kernel)
+        self.results = []
+
+    def test_isExpensive(self):
+        txform = OutputTransform({}, {'transform.html' : ['defaultHTMLTransform'],
+                                      'transform.txt' : ['string']})
+        self.assertTrue(txform.isExpensive('html'))
+        self.assertFalse(txform.isExpensive('txt'))
+        txform = OutputTransform({}, {'transform.txt' : ['string'],
+                                      'threadedTransform' : True})
+        self.assertTrue(txform.isExpensive('txt'))
+
+    def test_cheapInEventLoop(self):
+        """ A cheap chain is run at once in the PSC. """
+        self.ri.public_call('', 'txt', 'Svc', 'cheap', (), {}).addCallback(self.results.append)
+        self.assertEquals(self.results, ["{'A': 1}"])
+        self.assertEquals(self.kernel.routingTable.proxy.calls, [('cheap', (), {})])
+
+    def test_transformInWorker(self):
+        """ The worker is asked to transform the result, which the PSC
+passes on as it is. """
+        self.ri.public_call('', 'html', 'Svc', 'inWorker', (1,), {'b' : 2}) \
+            .addCallback(self.results.append)
+        self.assertEquals(self.results, [{'a' : 1}])
+        self.assertEquals(self.kernel.routingTable.proxy.calls,
+                          [('inWorker', (1,), {'b' : 2, TRANSFORM_TARGET_KEY : 'html'})])
+        # not for raw output
+        self.ri.public_call('', 'raw', 'Svc', 'inWorker', (), {})
+        self.assertEquals(self.kernel.routingTable.proxy.calls[-1], ('inWorker', (), {}))
+
+    def test_threaded(self):
+        """ Expensive chains are run in threads, no more than the 
+kernel's transform limiter allows at once. """
+        threads = []
+        def inThread(f, *args):
+            # hold the thread until the test releases it
+            d = Deferred()
+            threads.append((d, f, args))
+            return d
+        self.ri.inThread = inThread
+        for i in range(3):
+            self.ri.public_call('', 'txt', 'Svc', 'expensive', (), {}) \
+                .addCallback(self.results.append)
+        self.assertEquals(len(threads), 2)
+        self.assertEquals(self.results, [])
+        # as each thread completes the next waiting transform starts
+        while threads:
+            d, f, args = threads.pop(0)
+            d.callback(f(*args))
+        self.assertEquals(self.results, ["{'A': 1}"] * 3)
+        self.assertEquals(self.kernel.transformLimiter.tokens, 2)
+        # the limiter is the kernel's, shared by other interfaces
+        other = PelotonRequestInterface(self.kernel)
+        other.inThread = inThread
+        self.ri.public_call('', 'txt', 'Svc', 'expensive', (), {})
+        other.public_call('', 'txt', 'Svc', 'expensive', (), {})
+        self.ri.public_call('', 'txt', 'Svc', 'expensive', (), {})
+        self.assertEquals(len(threads), 2)
+
+class Test_ChainCompilation(TestCase):
+    def test_sharedChains(self):
+        """ Chains are compiled on registration and shared between
+services unless they depend on the service instance. """
+        library = ServiceLibrary()
+        properties = {'transform.txt' : ['upperKeys', 'string'],
+                      'transform.html' : ['template("~/a.html.genshi")']}
+        library.setProfile(makeProfile('One', [('m', properties)]))
+        library.setProfile(makeProfile('Two', [('m', properties)]))
+        _, one = library.getProfile('One')
+        _, two = library.getProfile('Two')
+        self.assertTrue(one['m'].transformChains['txt'] is 
+                        two['m'].transformChains['txt'])
+        self.assertFalse(one['m'].transformChains['html'] is 
+                         two['m'].transformChains['html'])
+
+    def test_registrationError(self):
+        """ A chain that cannot be compiled is reported when the profile 
+is set, which is then not stored. """
+        library = ServiceLibrary()
+        profile = makeProfile('Bad', [('m', {'transform.txt' : ['noSuchTransform']})])
+        self.assertRaises(ServiceConfigurationError, library.setProfile, profile)
+        self.assertRaises(KeyError, library.getProfile, 'Bad')
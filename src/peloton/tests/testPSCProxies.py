@@ -0,0 +1,313 @@
+# $Id$
+#
+# Copyright (c) 2007-2008 ReThought Limited and Peloton Contributors
+# All Rights Reserved
+# See LICENSE for details
+""" Test the connection handling of the proxy to a peer PSC over PB and
+the relay of batches of calls to the peer. """
+
+from unittest import TestCase
+from twisted.internet.defer import Deferred
+from twisted.internet.defer import succeed
+from twisted.internet.defer import fail
+from twisted.spread.pb import PBConnectionLost
+from twisted.internet.task import Clock
+from twisted.python.failure import Failure
+from twisted.internet.error import ConnectionRefusedError
+from peloton.pscproxies import TwistedPSCProxy
+from peloton.adapters.pb import PelotonInternodeAdapter
+from peloton.utils.config import PelotonSettings
+from peloton.exceptions import DeadProxyError
+from peloton.exceptions import PelotonConnectionError
+from peloton.exceptions import ServiceError
+
+class FakeLogger(object):
+    def __init__(self):
+        self.errors = []
+
+    def error(self, msg):
+        self.errors.append(msg)
+
+    def debug(self, msg):
+        pass
+
+class FakeKernel(object):
+    def __init__(self, **settings):
+        self.settings = PelotonSettings(settings)
+        self.profile = PelotonSettings()
+        self.logger = FakeLogger()
+        self.guid = 'local'
+        self.routingTable = FakeRoutingTable()
+
+class FakeLocalProxy(object):
+    """ Runs calls on the peer: echo returns its arguments and fail 
+raises a ServiceError. """
+    def call(self, service, method, *args, **kwargs):
+        if method == 'fail':
+            return fail(ServiceError("Failed with %s" % str(args)))
+        return succeed((method, args))
+
+class FakeRoutingTable(object):
+    def __init__(self):
+        self.localProxy = FakeLocalProxy()
+
+class FakeBroker(object):
+    pass
+
+class FakeRef(object):
+    """ The reference to the peer's PSC interface returned by
+registerPSC. Calls are relayed to the peer's handler. """
+    def __init__(self, root):
+        self.root = root
+        self.broker = root.broker
+
+    def callRemote(self, name, *args, **kwargs):
+        return getattr(self.root.peer, 'remote_%s' % name)(*args, **kwargs)
+
+class FakeRoot(object):
+    """ The root object of a peer obtained on connecting. """
+    def __init__(self, peer):
+        self.peer = peer
+        self.broker = FakeBroker()
+        self.disconnectCallbacks = []
+
+    def callRemote(self, name, *args):
+        assert name == 'registerPSC'
+        return succeed(FakeRef(self))
+
+    def notifyOnDisconnect(self, callback):
+        self.disconnectCallbacks.append(callback)
+
+    def disconnect(self):
+        for callback in self.disconnectCallbacks:
+            callback(self)
+
+class FakePeer(object):
+    """ A peer PSC whose connections are made or refused by the test.
+Each attempt to connect is held in attempts until then. """
+    def __init__(self):
+        self.attempts = []
+        self.calls = []
+
+    def connect(self):
+        d = Deferred()
+        self.attempts.append(d)
+        return d
+
+    def accept(self):
+        root = FakeRoot(self)
+        self.attempts.pop(0).callback(root)
+        return root
+
+    def refuse(self):
+        self.attempts.pop(0).errback(Failure(ConnectionRefusedError()))
+
+    def remote_relayCall(self, service, method, *args, **kwargs):
+        self.calls.append((service, method, args))
+        return succeed((method, args))
+
+    def remote_relayCalls(self, calls):
+        results = []
+        for service, method, args, kwargs in calls:
+            self.calls.append((service, method, args))
+            results.append((True, (method, args)))
+        return succeed(results)
+
+class Test_TwistedPSCProxy(TestCase):
+    def setUp(self):
+        self.peer = FakePeer()
+        self.proxy = self.makeProxy()
+        self.results = []
+        self.errors = []
+
+    def makeProxy(self, **settings):
+        proxy = TwistedPSCProxy(FakeKernel(**settings),
+                                {'ipaddress' : 'peer', 'port' : 9100})
+        proxy.clock = Clock()
+        proxy._getRootObject = self.peer.connect
+        return proxy
+
+    def call(self, *args):
+        d = self.proxy.call('Svc', 'echo', *args)
+        d.addCallbacks(self.results.append, self.errors.append)
+
+    def test_connectOnDemand(self):
+        """ A request is parked until connected, then the rest of the
+pool is opened. """
+        self.assertEquals(self.peer.attempts, [])
+        self.call(1)
+        self.assertEquals(len(self.peer.attempts), 1)
+        self.assertEquals(len(self.proxy.requestCache), 1)
+        self.peer.accept()
+        self.assertEquals(self.proxy.requestCache, [])
+        # the pool (of 2) is filled once the first connection is made
+        self.assertEquals(len(self.peer.attempts), 1)
+        self.proxy.clock.advance(0)
+        self.assertEquals(self.results, [('echo', (1,))])
+        self.peer.accept()
+        self.assertEquals(len(self.proxy.connections), 2)
+
+    def test_backoff(self):
+        """ Failed connects are retried after doubling delays, one
+half-open connection at a time, until the request times out. """
+        self.call(1)
+        clock = self.proxy.clock
+        delays = []
+        for i in range(4):
+            self.peer.refuse()
+            self.assertEquals(self.peer.attempts, [])
+            delay = self.proxy.reconnectCall.getTime() - clock.seconds()
+            delays.append(delay)
+            clock.advance(delay)
+            self.assertEquals(len(self.peer.attempts), 1)
+        self.assertEquals(delays, [0.5, 1.0, 2.0, 4.0])
+        self.assertEquals(self.errors, [])
+        # the next probe is due after the request's timeout of 10s
+        self.peer.refuse()
+        clock.advance(self.proxy.parkTimeout - clock.seconds())
+        self.assertEquals(len(self.errors), 1)
+        self.assert_(self.errors[0].check(DeadProxyError))
+        self.assertEquals(self.proxy.requestCache, [])
+
+    def test_backoffLimit(self):
+        proxy = self.makeProxy(peerRequestTimeout=1000)
+        proxy.call('Svc', 'echo').addErrback(lambda f: None)
+        clock = proxy.clock
+        for i in range(10):
+            self.peer.refuse()
+            clock.advance(proxy.reconnectCall.getTime() - clock.seconds())
+        self.peer.refuse()
+        self.assertEquals(proxy.reconnectCall.getTime() - clock.seconds(),
+                          TwistedPSCProxy.BACKOFF_MAX)
+        proxy.stop()
+
+    def test_halfOpenProbe(self):
+        """ Once a probe succeeds the pool is refilled, the backoff is
+reset and parked requests are sent. """
+        self.proxy.poolSize = 3
+        self.call(1)
+        self.peer.refuse()
+        self.proxy.clock.advance(0.5)
+        self.assertEquals(len(self.peer.attempts), 1)
+        self.call(2)
+        self.assertEquals(len(self.peer.attempts), 1)
+        self.peer.accept()
+        self.assertEquals(self.proxy.failures, 0)
+        self.assertEquals(len(self.peer.attempts), 2)
+        self.proxy.clock.advance(0)
+        self.assertEquals(sorted(self.results), [('echo', (1,)), ('echo', (2,))])
+        self.assertEquals(self.errors, [])
+
+    def test_parkTimeout(self):
+        """ A request parked beyond peerRequestTimeout fails with
+DeadProxyError; one sent in time is unaffected. """
+        proxy = self.proxy = self.makeProxy(peerRequestTimeout=2)
+        self.call(1)
+        proxy.clock.advance(1)
+        self.call(2)
+        proxy.clock.advance(1)
+        self.assertEquals(len(self.errors), 1)
+        self.assert_(self.errors[0].check(DeadProxyError))
+        self.assertEquals(len(proxy.requestCache), 1)
+        self.peer.accept()
+        proxy.clock.advance(0)
+        self.assertEquals(self.results, [('echo', (2,))])
+        proxy.clock.advance(10)
+        self.assertEquals(len(self.errors), 1)
+
+    def test_connectionLost(self):
+        """ With the pool lost requests are parked again and a new
+connection made. """
+        self.call(1)
+        root = self.peer.accept()
+        self.proxy.clock.advance(0)
+        self.peer.accept().disconnect()
+        root.disconnect()
+        self.assertEquals(len(self.proxy.connections), 0)
+        self.call(2)
+        self.assertEquals(len(self.proxy.requestCache), 1)
+        self.assertEquals(len(self.peer.attempts), 1)
+        self.peer.accept()
+        self.proxy.clock.advance(0)
+        self.assertEquals(len(self.results), 2)
+
+    def test_stop(self):
+        self.call(1)
+        self.peer.refuse()
+        self.proxy.stop()
+        self.assertEquals(self.proxy.reconnectCall, None)
+        self.assertEquals(len(self.errors), 1)
+        self.assert_(self.errors[0].check(DeadProxyError))
+        self.assertRaises(DeadProxyError, self.proxy.call, 'Svc', 'echo')
+
+class RelayingPeer(FakePeer):
+    """ A peer that runs relayed calls through the internode adapter of
+a PSC of its own. """
+    def __init__(self):
+        FakePeer.__init__(self)
+        self.adapter = PelotonInternodeAdapter(FakeKernel(), 'local')
+        self.lost = False
+
+    def remote_relayCall(self, service, method, *args, **kwargs):
+        return self.adapter.remote_relayCall(service, method, *args, **kwargs)
+
+    def remote_relayCalls(self, calls):
+        self.calls.append(len(calls))
+        if self.lost:
+            return fail(PBConnectionLost("lost"))
+        return self.adapter.remote_relayCalls(calls)
+
+class Test_BatchRelay(TestCase):
+    def setUp(self):
+        self.peer = RelayingPeer()
+        self.proxy = TwistedPSCProxy(FakeKernel(),
+                                     {'ipaddress' : 'peer', 'port' : 9100})
+        self.proxy.clock = Clock()
+        self.proxy._getRootObject = self.peer.connect
+        self.results = {}
+        # connect, leaving the rest of the pool unopened
+        self.proxy.call('Svc', 'echo', 0)
+        self.peer.accept()
+        self.proxy.clock.advance(0)
+
+    def call(self, method, *args):
+        d = self.proxy.call('Svc', method, *args)
+        d.addBoth(self.done, args[0])
+
+    def done(self, result, n):
+        self.results[n] = result
+
+    def test_partialFailure(self):
+        """ A call that fails in a batch fails only its own caller. """
+        self.call('echo', 1)
+        self.call('fail', 2)
+        self.call('echo', 3)
+        self.proxy.clock.advance(0)
+        self.assertEquals(self.peer.calls, [3])
+        self.assertEquals(self.results[1], ('echo', (1,)))
+        self.assertEquals(self.results[3], ('echo', (3,)))
+        self.assert_(self.results[2].check(ServiceError))
+        self.assertEquals(self.results[2].getErrorMessage(), 
+                          "Failed with (2,)")
+        self.assertEquals(self.proxy.outstanding, 0)
+
+    def test_batchError(self):
+        """ Should the batch as a whole fail, every caller is told. """
+        self.peer.lost = True
+        self.call('echo', 1)
+        self.call('echo', 2)
+        self.proxy.clock.advance(0)
+        self.assertEquals(len(self.results), 2)
+        for err in self.results.values():
+            self.assert_(err.check(PelotonConnectionError))
+
+    def test_batchSize(self):
+        """ Batches are sent as soon as relayBatchSize calls are held. """
+        self.proxy.batchSize = 2
+        for i in range(5):
+            self.call('echo', i)
+        self.assertEquals(self.peer.calls, [2, 2])
+        self.proxy.clock.advance(0)
+        # the last is sent on its own
+        self.assertEquals(self.peer.calls, [2, 2])
+        self.assertEquals(len(self.results), 5)
@@ -0,0 +1,180 @@
+# $Id$
+#
+# Copyright (c) 2007-2008 ReThought Limited and Peloton Contributors
+# All Rights Reserved
+# See LICENSE for details
+""" Test the routing policies by which a PSC is chosen for a call. """
+
+import random
+from unittest import TestCase
+from twisted.internet.defer import Deferred
+from peloton.mapping import RandomRoutingPolicy
+from peloton.mapping import LatencyRoutingPolicy
+from peloton.pscproxies import PSCProxy
+from peloton.pscproxies import LocalPSCProxy
+from peloton.utils.structs import WeightedSet
+from peloton.utils.config import PelotonSettings
+from peloton.exceptions import PelotonConnectionError
+from peloton.exceptions import ServiceError
+
+class FakeKernel(object):
+    logger = None
+
+class FakeRoutingTable(object):
+    def __init__(self):
+        self.pscByGUID = {}
+
+    def addProxy(self, guid, latency=None, outstanding=0, failures=0,
+                 local=False):
+        if local:
+            proxy = LocalPSCProxy(FakeKernel(), {'guid' : guid})
+        else:
+            proxy = PSCProxy(FakeKernel(), {'guid' : guid})
+        proxy.latency = latency
+        proxy.outstanding = outstanding
+        proxy.callFailures = failures
+        self.pscByGUID[guid] = proxy
+        return proxy
+
+class ScriptedHandlers(object):
+    """ Stands in for the WeightedSet of handlers, drawing the given
+GUIDs in turn. """
+    def __init__(self, *guids):
+        self.guids = list(guids)
+
+    def __len__(self):
+        return len(self.guids)
+
+    def choice(self):
+        guid = self.guids.pop(0)
+        self.guids.append(guid)
+        return guid
+
+def handlersFor(*guids):
+    handlers = WeightedSet()
+    for guid in guids:
+        handlers.add(guid)
+    return handlers
+
+class Test_RandomRoutingPolicy(TestCase):
+    def setUp(self):
+        random.seed(1)
+        self.table = FakeRoutingTable()
+        self.policy = RandomRoutingPolicy(self.table, PelotonSettings())
+
+    def test_single(self):
+        a = self.table.addProxy('a')
+        self.table.addProxy('b')
+        self.assertEquals(self.policy.choose(handlersFor('a')), a)
+
+    def test_weighted(self):
+        a = self.table.addProxy('a')
+        b = self.table.addProxy('b')
+        handlers = WeightedSet()
+        handlers.add('a', 3)
+        handlers.add('b', 1)
+        counts = {a : 0, b : 0}
+        for i in xrange(4000):
+            counts[self.policy.choose(handlers)] += 1
+        self.assert_(2700 < counts[a] < 3300)
+        self.assertEquals(counts[a] + counts[b], 4000)
+
+class Test_LatencyRoutingPolicy(TestCase):
+    def setUp(self):
+        random.seed(1)
+        self.table = FakeRoutingTable()
+        self.policy = LatencyRoutingPolicy(self.table, PelotonSettings())
+
+    def choose(self, a, b):
+        """ Return the GUID chosen from a and b, checking that the
+order in which they are drawn makes no difference. """
+        first = self.policy.choose(ScriptedHandlers(a, b)).profile['guid']
+        second = self.policy.choose(ScriptedHandlers(b, a)).profile['guid']
+        self.assertEquals(first, second)
+        return first
+
+    def test_sameHandler(self):
+        a = self.table.addProxy('a', latency=0.5)
+        self.table.addProxy('b', latency=0.01)
+        self.assertEquals(self.policy.choose(handlersFor('a')), a)
+
+    def test_faster(self):
+        self.table.addProxy('a', latency=0.01)
+        self.table.addProxy('b', latency=0.5)
+        self.assertEquals(self.choose('a', 'b'), 'a')
+
+    def test_outstanding(self):
+        a = self.table.addProxy('a', latency=0.1, outstanding=5)
+        b = self.table.addProxy('b', latency=0.2)
+        self.assert_(self.policy.cost(a) > self.policy.cost(b))
+        self.assertEquals(self.choose('a', 'b'), 'b')
+
+    def test_priorLatency(self):
+        self.table.addProxy('a', latency=0.1)
+        self.table.addProxy('b', latency=0.3)
+        new = self.table.addProxy('c')
+        self.assertAlmostEquals(self.policy.cost(new), 0.2)
+        new.outstanding = 2
+        self.assertAlmostEquals(self.policy.cost(new), 0.6)
+        # with nothing known the default is assumed
+        table = FakeRoutingTable()
+        policy = LatencyRoutingPolicy(table, PelotonSettings())
+        new = table.addProxy('a')
+        self.assertEquals(policy.cost(new),
+                          LatencyRoutingPolicy.DEFAULT_LATENCY)
+
+    def test_hungNewPeer(self):
+        """ A new peer that hangs on its first calls must not keep
+winning on account of having no latency. """
+        self.table.addProxy('a', latency=0.1, outstanding=1)
+        self.table.addProxy('b', outstanding=10)
+        self.assertEquals(self.choose('a', 'b'), 'a')
+
+    def test_failures(self):
+        self.table.addProxy('a', latency=0.2)
+        self.table.addProxy('b', latency=0.05, failures=5)
+        self.assertEquals(self.choose('a', 'b'), 'a')
+
+    def test_localBias(self):
+        local = self.table.addProxy('a', latency=0.15, local=True)
+        self.table.addProxy('b', latency=0.1)
+        self.assertEquals(self.choose('a', 'b'), 'a')
+        settings = PelotonSettings()
+        settings['routingLocalBias'] = 1.0
+        policy = LatencyRoutingPolicy(self.table, settings)
+        self.assertAlmostEquals(policy.cost(local), 0.15)
+
+class Test_ProxyTracking(TestCase):
+    def test_latencyAndFailures(self):
+        proxy = PSCProxy(FakeKernel(), {'guid' : 'a'})
+        d = proxy._trackCall(Deferred())
+        self.assertEquals(proxy.outstanding, 1)
+        d.callback(None)
+        self.assertEquals(proxy.outstanding, 0)
+        self.assertEquals(proxy.callFailures, 0)
+        self.assertNotEquals(proxy.latency, None)
+        latency = proxy.latency
+
+        for i in xrange(2):
+            d = proxy._trackCall(Deferred())
+            d.errback(PelotonConnectionError("failed"))
+            d.addErrback(lambda f: None)
+        self.assertEquals(proxy.outstanding, 0)
+        self.assertEquals(proxy.callFailures, 2)
+        self.assertEquals(proxy.latency, latency)
+
+        d = proxy._trackCall(Deferred())
+        d.callback(None)
+        self.assertEquals(proxy.callFailures, 0)
+
+    def test_serviceError(self):
+        """ A service that raises is not held against its PSC. """
+        proxy = PSCProxy(FakeKernel(), {'guid' : 'a'})
+        proxy.callFailures = 2
+        for err in [ServiceError("failed"), ValueError("bad")]:
+            d = proxy._trackCall(Deferred())
+            d.errback(err)
+            d.addErrback(lambda f: None)
+            self.assertEquals(proxy.callFailures, 0)
+        self.assertEquals(proxy.outstanding, 0)
+        self.assertNotEquals(proxy.latency, None)
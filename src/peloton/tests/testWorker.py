@@ -0,0 +1,192 @@
+# $Id$
+#
+# Copyright (c) 2007-2008 ReThought Limited and Peloton Contributors
+# All Rights Reserved
+# See LICENSE for details
+""" Test the limits on calls running in a worker and the re-issue by the
+PSC of calls that a busy worker turns away. """
+
+from unittest import TestCase
+from twisted.internet.defer import Deferred
+from twisted.internet.defer import maybeDeferred
+from twisted.spread import pb
+from peloton.worker import PelotonWorker
+from peloton.kernel import ServiceWorkerGroup
+from peloton.pscproxies import LocalPSCProxy
+from peloton.exceptions import WorkerBusyError
+from peloton.exceptions import ServiceError
+from peloton.svcdeco import asynchronous
+
+class Worker(PelotonWorker):
+    """ A worker that leaves sys.exit alone and holds each call 'running
+in a thread' until the test releases it. """
+    def __init__(self, maxConcurrency, maxQueued):
+        PelotonWorker.__init__(self, 'localhost', 0, 'token')
+        self.maxConcurrency = maxConcurrency
+        self.maxQueued = maxQueued
+        self._PelotonWorker__service = Service()
+        self.threads = []
+        self.inThread = self.runInThread
+
+    def _trapExit(self):
+        pass
+
+    def runInThread(self, f, *args, **kwargs):
+        d = Deferred()
+        self.threads.append((d, f, args, kwargs))
+        return d
+
+    def release(self):
+        """ Complete the oldest running call. """
+        d, f, args, kwargs = self.threads.pop(0)
+        d.callback(f(*args, **kwargs))
+
+class Service(object):
+    """ echo runs in a thread; the asynchronous methods run in the event
+loop, later completing when the test fires the deferred it returns. """
+    def __init__(self):
+        self.pending = []
+
+    def public_echo(self, v):
+        return v
+
+    @asynchronous
+    def public_now(self, v):
+        return v
+
+    @asynchronous
+    def public_later(self):
+        d = Deferred()
+        self.pending.append(d)
+        return d
+
+class WorkerRef(object):
+    """ Stands in for the PB reference to a worker: errors raised by
+the worker are returned as failures, as they would be over PB. """
+    def __init__(self, worker):
+        self.worker = worker
+        self.calls = 0
+
+    def callRemote(self, name, *args, **kwargs):
+        self.calls += 1
+        return maybeDeferred(getattr(self.worker, name), *args, **kwargs)
+
+class FakeDispatcher(object):
+    def registerInternal(self, key, handler):
+        pass
+
+    def fireInternalEvent(self, key, **kwargs):
+        pass
+
+class FakeKernel(object):
+    def __init__(self):
+        self.logger = None
+        self.dispatcher = FakeDispatcher()
+        self.workerStore = {}
+
+class Test_WorkerLimits(TestCase):
+    def setUp(self):
+        self.worker = Worker(2, 1)
+        self.results = []
+
+    def call(self, v):
+        self.worker.call('echo', v).addCallback(self.results.append)
+
+    def test_queueing(self):
+        for i in range(3):
+            self.call(i)
+        self.assertEquals(len(self.worker.threads), 2)
+        self.assertEquals(len(self.worker.callQueue), 1)
+        self.worker.release()
+        # the queued call takes the place of the completed one
+        self.assertEquals(self.results, [0])
+        self.assertEquals(len(self.worker.threads), 2)
+        self.assertEquals(self.worker.callQueue, [])
+        self.worker.release()
+        self.worker.release()
+        self.assertEquals(self.results, [0, 1, 2])
+        self.assertEquals(self.worker.executing, 0)
+
+    def test_rejection(self):
+        for i in range(3):
+            self.call(i)
+        self.assertRaises(WorkerBusyError, self.worker.call, 'echo', 3)
+        self.assertEquals(len(self.worker.callQueue), 1)
+        # the rejection is an expected error to PB
+        self.assert_(issubclass(WorkerBusyError, pb.Error))
+
+    def test_noLimit(self):
+        self.worker.maxConcurrency = 0
+        for i in range(5):
+            self.call(i)
+        self.assertEquals(len(self.worker.threads), 5)
+
+class Test_Asynchronous(TestCase):
+    def setUp(self):
+        self.worker = Worker(1, 0)
+        self.service = self.worker._PelotonWorker__service
+        self.results = []
+        self.errors = []
+
+    def call(self, method, *args):
+        d = self.worker.call(method, *args)
+        d.addCallbacks(self.results.append, self.errors.append)
+
+    def test_plainValue(self):
+        """ A plain return value is passed back at once, without a 
+thread. """
+        self.call('now', 5)
+        self.assertEquals(self.results, [5])
+        self.assertEquals(self.worker.threads, [])
+        self.assertEquals(self.worker.executing, 0)
+
+    def test_deferred(self):
+        """ Asynchronous calls are not held to the limits on threaded 
+calls, and their results and errors are passed back when they fire. """
+        self.call('echo', 1)
+        self.assertRaises(WorkerBusyError, self.worker.call, 'echo', 2)
+        self.call('later')
+        self.call('later')
+        self.assertEquals(len(self.service.pending), 2)
+        self.assertEquals(len(self.worker.threads), 1)
+        self.assertEquals(self.worker.callQueue, [])
+        self.service.pending.pop(0).callback('done')
+        self.service.pending.pop(0).errback(ServiceError("failed"))
+        self.assertEquals(self.results, ['done'])
+        self.assertEquals(len(self.errors), 1)
+        self.assert_(self.errors[0].check(ServiceError))
+        self.assertEquals(self.worker.executing, 1)
+
+class Test_BusyRetry(TestCase):
+    def setUp(self):
+        self.kernel = FakeKernel()
+        self.group = ServiceWorkerGroup(self.kernel, 'Svc', 'Svc')
+        self.kernel.workerStore['Svc'] = self.group
+        self.busy = Worker(1, 0)
+        self.idle = Worker(1, 0)
+        self.busyRef = WorkerRef(self.busy)
+        self.idleRef = WorkerRef(self.idle)
+        self.group.addWorker(self.busyRef)
+        self.group.addWorker(self.idleRef)
+        self.proxy = LocalPSCProxy(self.kernel, {})
+
+    def tearDown(self):
+        self.group.loopTimer.stop()
+
+    def test_nextWorker(self):
+        """ A call turned away by a busy worker is re-issued to the
+next worker. """
+        # occupy the busy worker outside of the group's accounting; being
+        # first in the group it is offered the call first
+        self.busy.call('echo', 'running')
+        results = []
+        self.proxy.call('Svc', 'echo', 'x').addCallback(results.append)
+        self.assertEquals(self.busyRef.calls, 1)
+        self.assertEquals(self.idleRef.calls, 1)
+        self.assertEquals(len(self.busy.threads), 1)
+        self.assertEquals(len(self.idle.threads), 1)
+        self.idle.release()
+        self.assertEquals(results, ['x'])
+        self.assertEquals(self.proxy.outstanding, 0)
+        self.assertEquals(self.group.workers.getLoad(self.busyRef), 0)
+        self.assertEquals(self.group.workers.getLoad(self.idleRef), 0)
@@ -0,0 +1,185 @@
+# $Id$
+#
+# Copyright (c) 2007-2008 ReThought Limited and Peloton Contributors
+# All Rights Reserved
+# See LICENSE for details
+""" Test the zygote from which workers are forked and the spare workers
+held in reserve by a service worker group. """
+
+import os
+import sys
+import subprocess
+from cStringIO import StringIO
+from unittest import TestCase
+from peloton import zygote
+from peloton.kernel import PelotonKernel
+from peloton.kernel import ServiceWorkerGroup
+from peloton.utils.config import PelotonSettings
+from twisted.spread.pb import DeadReferenceError
+from twisted.internet.defer import succeed
+
+class Test_Zygote(TestCase):
+    def setUp(self):
+        self.spawned = []
+        self.spawn = zygote.spawn
+        zygote.spawn = lambda *args: self.spawned.append(args)
+
+    def tearDown(self):
+        zygote.spawn = self.spawn
+
+    def test_serve(self):
+        commands = StringIO("SPAWN abc\n\nnonsense\nSPAWN def\nSTOP x\n")
+        zygote.serve(commands, 'localhost', 9100)
+        self.assertEquals(self.spawned, [('localhost', 9100, 'abc'),
+                                         ('localhost', 9100, 'def')])
+
+    def test_noReactor(self):
+        """ The modules the zygote loads must not install the reactor,
+which would otherwise be shared by every child. """
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join([p for p in sys.path if p])
+        script = "import sys; import peloton.zygote; " \
+                 "print sys.modules.has_key('twisted.internet.reactor')"
+        p = subprocess.Popen([sys.executable, '-c', script], env=env,
+                             stdout=subprocess.PIPE)
+        out = p.communicate()[0]
+        self.assertEquals(p.returncode, 0)
+        self.assertEquals(out.strip(), 'False')
+
+    def test_childSignals(self):
+        """ A worker forked from the zygote, which ignores SIGINT, has 
+the default handlers restored. """
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join([p for p in sys.path if p])
+        script = "import os, signal; import peloton.worker\n" \
+                 "class Worker(object):\n" \
+                 "    def __init__(self, *args): pass\n" \
+                 "    def start(self):\n" \
+                 "        handler = signal.getsignal(signal.SIGINT)\n" \
+                 "        return int(handler is not signal.default_int_handler)\n" \
+                 "peloton.worker.PelotonWorker = Worker\n" \
+                 "from peloton import zygote\n" \
+                 "signal.signal(signal.SIGINT, signal.SIG_IGN)\n" \
+                 "pid = zygote.spawn('localhost', 0, 'token')\n" \
+                 "print os.WEXITSTATUS(os.waitpid(pid, 0)[1])\n"
+        p = subprocess.Popen([sys.executable, '-c', script], env=env,
+                             stdout=subprocess.PIPE)
+        out = p.communicate()[0]
+        self.assertEquals(p.returncode, 0)
+        self.assertEquals(out.strip(), '0')
+
+class FakeZygote(object):
+    """ Stands in for the Popen of the zygote process. """
+    def __init__(self):
+        self.stdin = StringIO()
+        self.exitCode = None
+
+    def poll(self):
+        return self.exitCode
+
+class Kernel(PelotonKernel):
+    def _trapExit(self):
+        pass
+
+class Test_KernelZygote(TestCase):
+    def setUp(self):
+        self.kernel = Kernel(PelotonSettings())
+
+    def test_disabled(self):
+        kernel = Kernel(PelotonSettings(zygote=False))
+        kernel._startZygote()
+        self.assertEquals(kernel.zygote, None)
+
+    def test_spawn(self):
+        """ Workers are started by writing to the zygote. """
+        z = self.kernel.zygote = FakeZygote()
+        self.kernel._startWorkerProcess('tok1')
+        self.kernel._startWorkerProcess('tok2')
+        self.assertEquals(z.stdin.getvalue(), "SPAWN tok1\nSPAWN tok2\n")
+
+    def test_stop(self):
+        z = self.kernel.zygote = FakeZygote()
+        self.kernel._stopZygote()
+        self.assertEquals(self.kernel.zygote, None)
+        self.assert_(z.stdin.closed)
+
+class FakeWorker(object):
+    def __init__(self, name, dead=False):
+        self.name = name
+        self.dead = dead
+        self.calls = []
+
+    def callRemote(self, name, *args):
+        if self.dead:
+            raise DeadReferenceError("gone")
+        self.calls.append(name)
+        return succeed(None)
+
+    def __repr__(self):
+        return self.name
+
+class FakeDispatcher(object):
+    def registerInternal(self, key, handler):
+        pass
+
+    def fireInternalEvent(self, key, **kwargs):
+        pass
+
+class FakeKernel(object):
+    def __init__(self):
+        self.dispatcher = FakeDispatcher()
+        self.started = []
+
+    def startService(self, serviceName, publishedName, profile=None,
+                     spare=False):
+        self.started.append((serviceName, spare))
+
+class Test_Spares(TestCase):
+    def setUp(self):
+        self.kernel = FakeKernel()
+        self.group = ServiceWorkerGroup(self.kernel, 'Svc', 'Svc')
+        self.workers = [FakeWorker('w1'), FakeWorker('w2')]
+        for w in self.workers:
+            self.group.addWorker(w)
+        self.spare = FakeWorker('s1')
+        self.group.addSpare(self.spare)
+
+    def tearDown(self):
+        self.group.loopTimer.stop()
+
+    def test_spareIdle(self):
+        """ A spare takes no calls until promoted. """
+        for i in range(4):
+            self.assertNotEquals(self.group.getNextWorker(), self.spare)
+
+    def test_promoteSpare(self):
+        """ When an active worker dies a spare replaces it at once and
+a new spare is started. """
+        self.group.notifyDeadWorker(self.workers[0])
+        self.assertEquals(list(self.group.workers), [self.workers[1], self.spare])
+        self.assertEquals(self.group.spares, [])
+        self.assertEquals(self.spare.calls, ['activate'])
+        self.assertEquals(self.workers[0].calls, ['stop'])
+        self.assertEquals(self.kernel.started, [('Svc', True)])
+
+    def test_deadSpare(self):
+        """ A spare that dies is replaced by a new spare. """
+        self.group.notifyDeadWorker(self.spare)
+        self.assertEquals(list(self.group.workers), self.workers)
+        self.assertEquals(self.group.spares, [])
+        self.assertEquals(self.kernel.started, [('Svc', True)])
+
+    def test_noSpare(self):
+        """ Without a spare a new active worker is started. """
+        self.group.notifyDeadWorker(self.spare)
+        self.group.notifyDeadWorker(self.workers[0])
+        self.assertEquals(list(self.group.workers), [self.workers[1]])
+        self.assertEquals(self.kernel.started, [('Svc', True), ('Svc', False)])
+
+    def test_spareDiedWaiting(self):
+        """ A spare found dead on promotion is itself replaced. """
+        self.spare.dead = True
+        self.group.notifyDeadWorker(self.workers[0])
+        self.assertEquals(list(self.group.workers), [self.workers[1]])
+        self.assertEquals(self.group.spares, [])
+        self.assertEquals(len(self.kernel.started), 2)
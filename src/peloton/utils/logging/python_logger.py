@@ -9,7 +9,10 @@ import peloton.utils.logging as pul
 import logging
 import logging.handlers
 import os
+import time
+import thread
 import cPickle as pickle
+from collections import deque
 from peloton.utils import chop
 
 class NullHandler(logging.Handler):
@@ -66,10 +69,48 @@ def getLogger(name=''):
 
 class BusLogHandler(logging.Handler):
     """ A logging handler that puts log messages onto the message bus.
-    """
+
+Records are not sent as they are logged but held in a buffer of at most 
+busLogBuffer records (default 1000; the oldest are dropped beyond that) 
+and shipped every busLogInterval seconds (default 0.5) as a single event 
+on the logging exchange, with the list of records as its 'records' 
+value. Records below busLogLevel (default INFO) are ignored, as are all 
+but the first busLogRate (default 50) from any one logger in an interval;
+a record saying how many were dropped is sent in their place. 
+
+Anything logged while records are being sent, e.g. by the event bus 
+itself, is discarded so that logging cannot feed on itself. 
+
+The settings are read from the kernel settings where it has them. """
     def __init__(self, kernel):
-        logging.Handler.__init__(self)
         self.kernel = kernel
+        if hasattr(kernel, 'settings'):
+            settings = kernel.settings
+        else:
+            settings = {}
+        level = pul.INFO
+        if settings.has_key('busLogLevel'):
+            level = getattr(pul, settings['busLogLevel'])
+        logging.Handler.__init__(self, level)
+        self.interval = 0.5
+        if settings.has_key('busLogInterval'):
+            self.interval = float(settings['busLogInterval'])
+        self.rateLimit = 50
+        if settings.has_key('busLogRate'):
+            self.rateLimit = int(settings['busLogRate'])
+        self.capacity = 1000
+        if settings.has_key('busLogBuffer'):
+            self.capacity = int(settings['busLogBuffer'])
+
+        self.buffer = deque()
+        # records accepted and dropped in this interval from each logger
+        self.counts = {}
+        self.dropped = {}
+        # records lost from the front of a full buffer
+        self.overflow = 0
+        self.shipScheduled = False
+        # thread in which records are being sent, if any
+        self.sendingThread = None
         logging.getLogger().addHandler(self)
 
     def makeEvent(self, record):
@@ -90,15 +131,65 @@ class BusLogHandler(logging.Handler):
             event['message'] = record.msg
             
         return event
+
+    def makeDropEvent(self, name, count):
+        """ Return an event reporting that count records from logger
+name were dropped. """
+        return {'created' : time.time(), 'levelname' : 'WARNING', 
+                'name' : name, 'process' : os.getpid(),
+                'message' : "%d log records dropped" % count}
     
-    def send(self, event):
-        self.kernel.dispatcher.fireEvent(key="psc.logging", exchange='logging', **event)
+    def send(self, events):
+        self.kernel.dispatcher.fireEvent(key="psc.logging", exchange='logging',
+                                         records=events)
 
     def emit(self, record):
+        """ Called with the handler lock held. """
+        if self.sendingThread == thread.get_ident():
+            return
         try:
-            event = self.makeEvent(record)
-            self.send(event)
+            count = self.counts.get(record.name, 0)
+            if count >= self.rateLimit:
+                self.dropped[record.name] = self.dropped.get(record.name, 0) + 1
+                return
+            self.counts[record.name] = count + 1
+            self.buffer.append(self.makeEvent(record))
+            if len(self.buffer) > self.capacity:
+                self.buffer.popleft()
+                self.overflow += 1
+            if not self.shipScheduled:
+                self.shipScheduled = True
+                from twisted.internet import reactor
+                reactor.callFromThread(reactor.callLater, 
+                                       self.interval, self.ship)
         except Exception, ex:
             print(ex)
 
-
+    def ship(self):
+        """ Send all buffered records, with reports of any dropped, as 
+one event. Called in the reactor thread. """
+        self.acquire()
+        try:
+            events = list(self.buffer)
+            self.buffer.clear()
+            dropped = self.dropped.items()
+            if self.overflow:
+                dropped.append(('BusLogHandler', self.overflow))
+            self.counts = {}
+            self.dropped = {}
+            self.overflow = 0
+            self.shipScheduled = False
+        finally:
+            self.release()
+        for name, count in dropped:
+            events.append(self.makeDropEvent(name, count))
+        if not events:
+            return
+        self.sendingThread = thread.get_ident()
+        try:
+            try:
+                self.send(events)
+            except Exception, ex:
+                print(ex)
+        finally:
+            self.sendingThread = None
@@ -6,23 +6,46 @@
 to different forms of XML. """
 import types
 
+def groupFragments(fragments, chunkSize):
+    """ Generate strings of at least chunkSize characters, save the last,
+by joining consecutive strings from the iterable fragments. """
+    buffer = []
+    size = 0
+    for part in fragments:
+        buffer.append(part)
+        size += len(part)
+        if size >= chunkSize:
+            yield "".join(buffer)
+            buffer = []
+            size = 0
+    if buffer:
+        yield "".join(buffer)
+
+# types serialized as nested structures rather than values
+_CONTAINERS = frozenset([types.ListType, types.TupleType, types.DictType])
+
 class XMLLanguageSerializer(object):
     """ Translates into similarly structured XML or HTML given
-tags at init time."""
+tags at init time.
+
+The output is generated as a sequence of fragments, following nested lists
+and dicts with a stack of generators rather than by recursion, so that it
+can be written out in chunks as it is produced (see chunks and 
+serialize) without ever being held whole in memory."""
     def __init__(self, header, footer, listStart, listEnd, 
                  listItem, dictStart, dictEnd, dictItem, 
                  dataItemStart, dataItemEnd):
 
-        self.TR_FUNCS = {types.ListType: self._tr_list,
-                    types.TupleType: self._tr_list,
-                    types.DictType: self._tr_dict,
-                    types.StringType: self._tr_string,
+        self.TR_FUNCS = {types.StringType: self._tr_string,
                     types.UnicodeType: self._tr_unicode,
                     types.FloatType: self._tr_float,
                     types.IntType: self._tr_int,
                     types.LongType: self._tr_int,
                     types.BooleanType: self._tr_boolean,
                     types.NoneType: self._tr_none}
+        self.TR_PARTS = {types.ListType: self._parts_list,
+                    types.TupleType: self._parts_list,
+                    types.DictType: self._parts_dict}
 
         self.header = header
         self.footer = footer
@@ -34,43 +57,91 @@ tags at init time."""
         self.dictItem = dictItem
         self.dataItemStart = dataItemStart
         self.dataItemEnd = dataItemEnd
+        # the item templates split about their %(key)s and %(value)s
+        self.listItemStart, self.listItemEnd = listItem.split('%(value)s')
+        self.dictItemStart, rest = dictItem.split('%(key)s')
+        self.dictItemMid, self.dictItemEnd = rest.split('%(value)s')
     
     def write(self, obj):
         try:
-            s = self._format(obj)
-            return "%s\n%s\n%s" % (self.header, s, self.footer)
+            return "".join(self.fragments(obj))
         except KeyError, ke:
             return "Cannot serialize %s with type %s" \
                             % (str(obj), str(type(obj)))
 
-    def _format(self, obj, solo=True):
-        """ Takes object obj and translates into a JSON string. If
-obj or a component of obj is not serializable, Exception
-is raised. If solo==True the item is surrounded in dataItemstart and 
-dataItemEnd tags."""
-        s = self.TR_FUNCS[type(obj)](obj)
-        if solo and type(obj) not in \
-            [types.ListType, types.TupleType, types.DictType]:
-            return "%s%s%s" % (self.dataItemStart, s, self.dataItemEnd)
+    def fragments(self, obj):
+        """ Generate the serialization of obj, header and footer included,
+as a sequence of strings. If obj or a component of obj is not 
+serializable KeyError is raised, possibly after some of the output has
+been generated. A value at the top level is surrounded in dataItemStart 
+and dataItemEnd tags."""
+        yield "%s\n" % self.header
+        if type(obj) in _CONTAINERS:
+            stack = [self.TR_PARTS[type(obj)](obj)]
         else:
-            return s
-        
-    def _tr_list(self, o):
-        tokens =[]
+            yield "%s%s%s" % (self.dataItemStart, 
+                              self.TR_FUNCS[type(obj)](obj), 
+                              self.dataItemEnd)
+            stack = []
+        while stack:
+            # the generators yield text, or a container to be descended
+            for part in stack[-1]:
+                if type(part) in _CONTAINERS:
+                    stack.append(self.TR_PARTS[type(part)](part))
+                    break
+                yield part
+            else:
+                stack.pop()
+        yield "\n%s" % self.footer
+
+    def chunks(self, obj, chunkSize=8192):
+        """ Generate the serialization of obj in strings of at least 
+chunkSize characters, save the last. """
+        return groupFragments(self.fragments(obj), chunkSize)
+
+    def serialize(self, obj, out, chunkSize=8192):
+        """ Write the serialization of obj to the file-like object out,
+chunkSize characters or so at a time. """
+        for chunk in self.chunks(obj, chunkSize):
+            out.write(chunk)
+
+    def _parts_list(self, o):
+        """ Yield the list o, each item that is a value in one piece 
+with its tags. """
+        funcs = self.TR_FUNCS
+        start, end = self.listItemStart, self.listItemEnd
+        yield "%s\n" % self.listStart
+        separator = ""
         for i in o:
-            tokens.append(self.listItem % \
-                    {'value': self._format(i, False)})
+            if type(i) in _CONTAINERS:
+                yield "%s%s" % (separator, start)
+                yield i
+                yield end
+            else:
+                yield "%s%s%s%s" % (separator, start, funcs[type(i)](i), end)
+            separator = "\n"
+        yield "\n%s" % self.listEnd
 
-        return "%s\n%s\n%s" % (self.listStart, "\n".join(tokens), self.listEnd)
-        
-    def _tr_dict(self, o):
-        tokens=[]
+    def _parts_dict(self, o):
+        funcs = self.TR_FUNCS
+        start, mid, end = self.dictItemStart, self.dictItemMid, self.dictItemEnd
+        yield "%s\n" % self.dictStart
+        separator = ""
         for k,v in o.items():
-            key = self._format(k, False)
-            val = self._format(v, False)
-            tokens.append(self.dictItem % \
-                    {'key': key, 'value': val})
-        return "%s\n%s\n%s" % (self.dictStart, "\n".join(tokens), self.dictEnd)
+            if type(k) in _CONTAINERS:
+                yield "%s%s" % (separator, start)
+                yield k
+                key = ""
+            else:
+                key = "%s%s" % (separator, start) + funcs[type(k)](k)
+            if type(v) in _CONTAINERS:
+                yield "%s%s" % (key, mid)
+                yield v
+                yield end
+            else:
+                yield "%s%s%s%s" % (key, mid, funcs[type(v)](v), end)
+            separator = "\n"
+        yield "\n%s" % self.dictEnd
     
     def _tr_string(self, o):
         substitutions = [('/', r'\/'),
@@ -104,6 +175,23 @@ dataItemEnd tags."""
     def _tr_none(self, o):
         return u"null"
 
+class Serialization(object):
+    """ A value to be serialized, returned in place of the output by
+streaming transforms. The serializer is only run as the chunks are taken,
+e.g. by the HTTP adapter as it writes the response. Any formatter with 
+format and chunks methods, such as the XMLFormatter, may be used. """
+    def __init__(self, serializer, obj, chunkSize=8192):
+        self.serializer = serializer
+        self.obj = obj
+        self.chunkSize = chunkSize
+
+    def chunks(self):
+        return self.serializer.chunks(self.obj, self.chunkSize)
+
+    def getvalue(self):
+        """ Return the whole serialization. """
+        return self.serializer.format(self.obj)
+
 class XMLFormatter(XMLLanguageSerializer):
     """ Noddy serialiser takes Python struct and makes XML. 
 Returns tupple of (content-type, value)"""
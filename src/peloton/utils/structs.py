@@ -8,6 +8,7 @@
 """ Useful structures and classes to replace or supplement
 core Python structures.
 """
+import random
 import types
 from optparse import OptionParser
 
@@ -132,4 +133,146 @@ values, looping to the start once it hits the end. """
         """ Ensure a RoundRobinList is returned from a slice.
 Returned object has index re-set to zero."""
         slc = list.__getslice__(self, i, j)
-        return RoundRobinList(slc)
\ No newline at end of file
+        return RoundRobinList(slc)
+
+
+class LeastLoadedList(RoundRobinList):
+    """ A RoundRobinList that also keeps a load count against each item, 
+e.g. the number of requests outstanding on a worker. leastloaded() returns
+the item with the lowest count; ties are broken in round robin fashion so
+that an idle pool is still cycled through evenly. 
+
+Items must be hashable. Counts are maintained with incr() and decr()."""
+    def __init__(self, *args):
+        RoundRobinList.__init__(self, *args)
+        self.load = {}
+
+    def incr(self, item):
+        """ Increment the load on item. """
+        self.load[item] = self.load.get(item, 0) + 1
+
+    def decr(self, item):
+        """ Decrement the load on item; never goes below zero and 
+ignores items no longer in the list. """
+        if self.load.has_key(item):
+            self.load[item] = max(0, self.load[item] - 1)
+            if self.load[item] == 0 and item not in self:
+                del(self.load[item])
+
+    def getLoad(self, item):
+        return self.load.get(item, 0)
+
+    def leastloaded(self, exclude=[]):
+        """ Return the item with the least load or None if the list is
+empty. Items in exclude are not considered; if all items are excluded
+None is returned. """
+        _len = self.__len__()
+        if _len == 0:
+            return None
+        if not self.__dict__.has_key('__ix'):
+            self.__dict__['__ix']=0
+        start = self.__dict__['__ix'] % _len
+        bestIx = start
+        bestLoad = None
+        for i in xrange(_len):
+            ix = (start + i) % _len
+            if self[ix] in exclude:
+                continue
+            l = self.load.get(self[ix], 0)
+            if bestLoad == None or l < bestLoad:
+                bestIx = ix
+                bestLoad = l
+                if l == 0:
+                    break
+        if bestLoad == None:
+            return None
+        self.__dict__['__ix'] = (bestIx+1) % _len
+        return self[bestIx]
+
+    def remove(self, item):
+        """ Remove item and, if no other references to it remain,
+its load count. """
+        RoundRobinList.remove(self, item)
+        if item not in self and self.load.has_key(item):
+            del(self.load[item])
+
+    def __getslice__(self, i, j):
+        """ Ensure a LeastLoadedList is returned from a slice, carrying
+the load counts of the items in the slice. """
+        slc = LeastLoadedList(list.__getslice__(self, i, j))
+        for item in slc:
+            if self.load.has_key(item):
+                slc.load[item] = self.load[item]
+        return slc
+
+class WeightedSet(object):
+    """ A set of hashable keys, each with an integer weight, from which a
+key may be drawn at random with probability proportional to its weight.
+
+Each unit of weight is held as a ticket in a flat list and each key 
+records the positions of its tickets. A ticket is removed by moving the
+last ticket into its place, so adding or removing a unit of weight and
+drawing a key are all O(1); removing a key outright is O(weight of that
+key). """
+    def __init__(self):
+        self.tickets = []
+        self.positions = {}
+
+    def add(self, key, weight=1):
+        """ Add weight units of weight to key, adding key if new. """
+        if not self.positions.has_key(key):
+            self.positions[key] = set()
+        positions = self.positions[key]
+        for i in xrange(weight):
+            positions.add(len(self.tickets))
+            self.tickets.append(key)
+
+    def remove(self, key, weight=1):
+        """ Remove up to weight units of weight from key; if weight is None
+all are removed. The key is discarded once its weight reaches zero. Returns
+the weight removed. """
+        try:
+            positions = self.positions[key]
+        except KeyError:
+            return 0
+        n = 0
+        while positions and (weight == None or n < weight):
+            ix = positions.pop()
+            lastIx = len(self.tickets)-1
+            last = self.tickets.pop()
+            if ix != lastIx:
+                # fill the hole with the ticket from the end
+                self.tickets[ix] = last
+                lastPositions = self.positions[last]
+                lastPositions.remove(lastIx)
+                lastPositions.add(ix)
+            n += 1
+        if not positions:
+            del(self.positions[key])
+        return n
+
+    def choice(self):
+        """ Return a key drawn at random, weighted, or None if empty. """
+        if not self.tickets:
+            return None
+        return self.tickets[random.randrange(len(self.tickets))]
+
+    def weight(self, key):
+        """ Return the weight of key; zero if not present. """
+        try:
+            return len(self.positions[key])
+        except KeyError:
+            return 0
+
+    def totalWeight(self):
+        return len(self.tickets)
+
+    def keys(self):
+        return self.positions.keys()
+
+    def __contains__(self, key):
+        return self.positions.has_key(key)
+
+    def __len__(self):
+        """ The number of distinct keys. """
+        return len(self.positions)
@@ -0,0 +1,87 @@
+# $Id$
+#
+# Copyright (c) 2007-2008 ReThought Limited and Peloton Contributors
+# All Rights Reserved
+# See LICENSE for details
+""" Test the message bus log handler """
+
+from unittest import TestCase
+from peloton.utils.config import PelotonSettings
+from peloton.utils.logging.python_logger import BusLogHandler
+import logging
+
+class FakeDispatcher(object):
+    def __init__(self):
+        self.events = []
+        self.logger = None
+
+    def fireEvent(self, key, exchange, **kwargs):
+        self.events.append(kwargs['records'])
+        # logging from the send path is not sent
+        self.logger.error("sending")
+
+class FakeKernel(object):
+    def __init__(self):
+        self.dispatcher = FakeDispatcher()
+        self.settings = PelotonSettings(busLogLevel='INFO', busLogRate=3,
+                                        busLogBuffer=5)
+
+class Test_BusLogHandler(TestCase):
+    def setUp(self):
+        self.kernel = FakeKernel()
+        self.handler = BusLogHandler(self.kernel)
+        logging.getLogger().removeHandler(self.handler)
+        # ship is called by the test
+        self.handler.shipScheduled = True
+        self.loggers = {}
+        for name in ['buslog.a', 'buslog.b']:
+            logger = logging.getLogger(name)
+            logger.propagate = False
+            logger.setLevel(logging.DEBUG)
+            logger.addHandler(self.handler)
+            self.loggers[name] = logger
+        self.kernel.dispatcher.logger = self.loggers['buslog.a']
+
+    def tearDown(self):
+        for logger in self.loggers.values():
+            logger.removeHandler(self.handler)
+
+    def _messages(self, records):
+        return [(r['name'], r['message']) for r in records]
+
+    def test_batching(self):
+        """ Records are sent together; debug records are ignored. """
+        a = self.loggers['buslog.a']
+        a.debug("ignored")
+        a.info("one")
+        a.warning("two")
+        self.assertEquals(self.kernel.dispatcher.events, [])
+        self.handler.ship()
+        self.assertEquals(len(self.kernel.dispatcher.events), 1)
+        self.assertEquals(self._messages(self.kernel.dispatcher.events[0]),
+                          [('buslog.a', 'one'), ('buslog.a', 'two')])
+        # nothing new to ship, including what was logged while sending
+        self.handler.ship()
+        self.assertEquals(len(self.kernel.dispatcher.events), 1)
+
+    def test_limits(self):
+        """ Records beyond the rate limit for a logger are counted, as
+are those lost from a full buffer. """
+        a, b = self.loggers['buslog.a'], self.loggers['buslog.b']
+        for i in range(5):
+            a.info("a%d" % i)
+        for i in range(3):
+            b.info("b%d" % i)
+        self.handler.ship()
+        messages = self._messages(self.kernel.dispatcher.events[0])
+        self.assertEquals(messages,
+                          [('buslog.a', 'a1'), ('buslog.a', 'a2'),
+                           ('buslog.b', 'b0'),
+                           ('buslog.b', 'b1'), ('buslog.b', 'b2'),
+                           ('buslog.a', '2 log records dropped'),
+                           ('BusLogHandler', '1 log records dropped')])
+        # the limits apply per interval
+        a.info("again")
+        self.handler.ship()
+        self.assertEquals(self._messages(self.kernel.dispatcher.events[1]),
+                          [('buslog.a', 'again')])
@@ -8,6 +8,8 @@ from unittest import TestCase
 from peloton.utils.structs import ReadOnlyDict
 from peloton.utils.structs import FilteredOptionParser
 from peloton.utils.structs import RoundRobinList
+from peloton.utils.structs import LeastLoadedList
+from peloton.utils.structs import WeightedSet
 from types import ListType
 
 class Test_ReadOnlyDict(TestCase):
@@ -116,4 +118,111 @@ class Test_RoundRobinList(TestCase):
         self.assertEquals(newList.rrnext(), 'c')
         self.assertEquals(newList.rrnext(), 'b')
                 
-        
\ No newline at end of file
+        
+class Test_LeastLoadedList(TestCase):
+    def setUp(self):
+        self.thelist = LeastLoadedList(['a','b','c'])
+        
+    def tearDown(self):
+        pass
+    
+    def test_idleIsRoundRobin(self):
+        self.assertEquals(self.thelist.leastloaded(), 'a')
+        self.assertEquals(self.thelist.leastloaded(), 'b')
+        self.assertEquals(self.thelist.leastloaded(), 'c')
+        self.assertEquals(self.thelist.leastloaded(), 'a')
+
+    def test_leastLoaded(self):
+        self.thelist.incr('a')
+        self.thelist.incr('a')
+        self.thelist.incr('b')
+        self.assertEquals(self.thelist.leastloaded(), 'c')
+        self.thelist.incr('c')
+        self.thelist.incr('c')
+        self.assertEquals(self.thelist.leastloaded(), 'b')
+        self.thelist.decr('a')
+        self.thelist.decr('a')
+        self.assertEquals(self.thelist.leastloaded(), 'a')
+        self.assertEquals(self.thelist.getLoad('a'), 0)
+        self.thelist.decr('a')
+        self.assertEquals(self.thelist.getLoad('a'), 0)
+
+    def test_remove(self):
+        self.thelist.incr('b')
+        self.thelist.remove('b')
+        self.assertEquals(self.thelist.getLoad('b'), 0)
+        self.assertFalse(self.thelist.load.has_key('b'))
+        self.thelist.decr('b')
+        self.assertFalse(self.thelist.load.has_key('b'))
+        self.assertEquals(self.thelist.leastloaded(), 'a')
+        self.assertEquals(self.thelist.leastloaded(), 'c')
+
+    def test_exclude(self):
+        self.thelist.incr('b')
+        self.assertEquals(self.thelist.leastloaded(exclude=['a','c']), 'b')
+        self.assertEquals(self.thelist.leastloaded(exclude=['a','b','c']), None)
+
+    def test_empty(self):
+        l = LeastLoadedList()
+        self.assertEquals(l.leastloaded(), None)
+
+    def test_slicing(self):
+        self.thelist.incr('b')
+        newList = self.thelist[1:]
+        self.assertTrue(isinstance(newList, LeastLoadedList))
+        self.assertEquals(newList.getLoad('b'), 1)
+        self.assertEquals(newList.leastloaded(), 'c')
+
+class Test_WeightedSet(TestCase):
+    def setUp(self):
+        self.ws = WeightedSet()
+        self.ws.add('a', 3)
+        self.ws.add('b')
+        self.ws.add('c', 2)
+
+    def tearDown(self):
+        pass
+
+    def _checkConsistent(self):
+        """ Every ticket must be recorded against its key and vice versa. """
+        n = 0
+        for key in self.ws.keys():
+            for ix in self.ws.positions[key]:
+                self.assertEquals(self.ws.tickets[ix], key)
+                n += 1
+        self.assertEquals(n, len(self.ws.tickets))
+
+    def test_weights(self):
+        self.assertEquals(len(self.ws), 3)
+        self.assertEquals(self.ws.totalWeight(), 6)
+        self.assertEquals(self.ws.weight('a'), 3)
+        self.assertEquals(self.ws.weight('z'), 0)
+        self.assertTrue('b' in self.ws)
+        self._checkConsistent()
+
+    def test_remove(self):
+        self.assertEquals(self.ws.remove('a'), 1)
+        self.assertEquals(self.ws.weight('a'), 2)
+        self._checkConsistent()
+        self.assertEquals(self.ws.remove('b'), 1)
+        self.assertFalse('b' in self.ws)
+        self._checkConsistent()
+        self.assertEquals(self.ws.remove('b'), 0)
+        self.assertEquals(self.ws.remove('a', None), 2)
+        self.assertFalse('a' in self.ws)
+        self._checkConsistent()
+        self.assertEquals(self.ws.keys(), ['c'])
+        self.assertEquals(self.ws.choice(), 'c')
+        self.ws.remove('c', 5)
+        self.assertEquals(len(self.ws), 0)
+        self.assertEquals(self.ws.choice(), None)
+
+    def test_choice(self):
+        import random
+        random.seed(1)
+        counts = {'a':0, 'b':0, 'c':0}
+        for i in xrange(6000):
+            counts[self.ws.choice()] += 1
+        self.assertTrue(2700 < counts['a'] < 3300)
+        self.assertTrue(800 < counts['b'] < 1200)
+        self.assertTrue(1700 < counts['c'] < 2300)
@@ -7,6 +7,19 @@ from unittest import TestCase
 from peloton.utils.transforms import valueToDict
 from peloton.utils.transforms import stripKeys
 from peloton.utils.transforms import upperKeys
+from peloton.utils.transforms import TemplateCache
+from peloton.utils.transforms import templateCache
+from peloton.utils.transforms import template
+from peloton.utils.transforms import defaultXMLTransform
+from peloton.utils.transforms import jsonTransform
+from peloton.exceptions import ServiceError
+from peloton.utils.config import PelotonSettings
+import simplejson
+from peloton.utils.simplexml import Serialization
+from cStringIO import StringIO
+import tempfile
+import shutil
+import os
 from sets import Set
 
 class Test_Transforms(TestCase):
@@ -41,4 +54,143 @@ class Test_Transforms(TestCase):
         self.assertEquals(data['D'], 4)
         self.assertRaises(KeyError, data.__getitem__, 'a')
         
-            
\ No newline at end of file
+            
+class Test_TemplateCache(TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.compiled = []
+        self.cache = TemplateCache(maxSize=2, sweepInterval=0)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def _write(self, name, content):
+        path = os.path.join(self.dir, name)
+        fp = open(path, 'w')
+        fp.write(content)
+        fp.close()
+        return path
+
+    def _compile(self, path):
+        self.compiled.append(path)
+        return open(path).read()
+
+    def test_cache(self):
+        """ Templates are compiled once, dropped least recently used first
+and recompiled when their file changes. """
+        a = self._write('a', 'A')
+        b = self._write('b', 'B')
+        c = self._write('c', 'C')
+        for path in [a, b, a, c, a, b]:
+            self.cache.get(path, self._compile)
+        # b was dropped for c, then c for b
+        self.assertEquals(self.compiled, [a, b, c, b])
+        stats = self.cache.getStats()
+        self.assertEquals(stats['evictions'], 2)
+        self.assertEquals(stats['hitRate'], 2.0/6)
+
+        os.utime(a, (0, 0))
+        self.assertEquals(self.cache.get(a, self._compile), 'A')
+        self.assertEquals(self.compiled[-1], a)
+        self.assertEquals(self.cache.getStats()['invalidations'], 1)
+
+    def test_absolutePaths(self):
+        """ A file is held once however its path is written. """
+        a = self._write('a', 'A')
+        other = os.path.join(self.dir, '.', '..', 
+                             os.path.basename(self.dir), 'a')
+        self.cache.get(a, self._compile)
+        self.cache.get(other, self._compile)
+        self.assertEquals(self.compiled, [a])
+        self.assertEquals(self.cache.templates.keys(), [a])
+
+    def test_configure(self):
+        cache = TemplateCache()
+        cache.configure(PelotonSettings())
+        self.assertEquals((cache.maxSize, cache.sweepInterval), (200, 2.0))
+        cache.configure(PelotonSettings(templateCacheSize='10',
+                                        templateSweepInterval=0.5))
+        self.assertEquals((cache.maxSize, cache.sweepInterval), (10, 0.5))
+
+    def test_genshiTemplate(self):
+        """ The template transform renders from the shared cache. """
+        path = self._write('t.html.genshi', 
+                   '<p xmlns:py="http://genshi.edgewall.org/">${d}</p>')
+        transform = template({}, path)
+        self.assertEquals(transform('hello', {}), '<p>hello</p>')
+        before = templateCache.getStats()['compiles']
+        self.assertEquals(template({}, path)('again', {}), '<p>again</p>')
+        self.assertEquals(templateCache.getStats()['compiles'], before)
+
+class Test_XMLSerialization(TestCase):
+    def setUp(self):
+        self.value = {'a' : [1, 2.5, None, (True, u'x')], 
+                      'b' : {'c' : 'a "quote"'}}
+
+    def test_format(self):
+        xml = defaultXMLTransform()(self.value, {})
+        self.assertTrue(xml.startswith('<?xml version="1.0"?>\n<result>\n<dict>\n'))
+        self.assertTrue('<item id="a"><list>\n<item>1</item>\n<item>2.500000</item>' in xml)
+        self.assertTrue('<item id="c">"a \\"quote\\""</item>' in xml)
+        self.assertEquals(defaultXMLTransform()('s', {}), 
+                          '<?xml version="1.0"?>\n<result>\n<data>"s"</data>\n</result>')
+
+    def test_deep(self):
+        """ Nesting is not limited by the recursion limit. """
+        deep = []
+        for i in range(5000):
+            deep = [deep]
+        xml = defaultXMLTransform()(deep, {})
+        self.assertEquals(xml.count('<list>'), 5001)
+
+    def test_stream(self):
+        """ A streaming transform is serialized as its chunks are taken,
+to the same output. """
+        serialization = defaultXMLTransform({}, stream=True, chunkSize=16)(self.value, {})
+        self.assertTrue(isinstance(serialization, Serialization))
+        chunks = list(serialization.chunks())
+        self.assertTrue(len(chunks) > 1)
+        for chunk in chunks[:-1]:
+            self.assertTrue(len(chunk) >= 16)
+            self.assertTrue(len(chunk) < 64)
+        xml = defaultXMLTransform()(self.value, {})
+        self.assertEquals("".join(chunks), xml)
+        out = StringIO()
+        serialization.serializer.serialize(self.value, out, 16)
+        self.assertEquals(out.getvalue(), xml)
+
+class Test_JSON(TestCase):
+    def setUp(self):
+        self.values = [[], {}, 'a', None, 1.5, 
+                       [{'a' : 1, 2 : [u'x', None]}, (True, 'y')],
+                       {'a' : {'b' : [1, 2]}, 1 : 'c', None : False}]
+
+    def test_format(self):
+        for v in self.values:
+            self.assertEquals(jsonTransform()(v, {}), simplejson.dumps(v))
+            self.assertEquals(jsonTransform(compact=True)(v, {}), 
+                              simplejson.dumps(v, separators=(',', ':')))
+        self.assertRaises(ServiceError, jsonTransform(), [object()], {})
+
+    def test_cEncoder(self):
+        from peloton.utils.transforms import _cEncoder
+        class Module(object):
+            pass
+        old = Module()
+        self.assertEquals(_cEncoder(old), None)
+        old.encoder = Module()
+        self.assertEquals(_cEncoder(old), None)
+        old.encoder.c_make_encoder = len
+        self.assertEquals(_cEncoder(old), len)
+
+    def test_stream(self):
+        """ Streamed JSON is the same as that formatted whole. """
+        for v in self.values:
+            for compact in [False, True]:
+                chunks = jsonTransform({}, stream=True, chunkSize=4,
+                                       compact=compact)(v, {}).chunks()
+                self.assertEquals("".join(chunks), 
+                                  jsonTransform(compact=compact)(v, {}))
+        chunks = list(jsonTransform({}, stream=True, chunkSize=4)(range(10), {}).chunks())
+        self.assertTrue(len(chunks) > 1)
+        self.assertEquals(simplejson.loads("".join(chunks)), range(10))
@@ -12,14 +12,28 @@ Each returned method takes two arguments, the data to transform and a
 dictionary of additional data, and output 
 a single value, the transformed data. Optionally static arguments 
 may be passed in after the input data argument to control the transform
+
+Transforms that are costly to run, such as those that render templates 
+or serialise the whole of a result, are marked as expensive; chains that
+include one are run in a thread rather than in the PSC event loop.
 """
 import sys
 import os
 import types
+import time
+import threading
 from peloton.utils import logging
 from peloton.utils.simplexml import HTMLFormatter
 from peloton.utils.simplexml import XMLFormatter
+from peloton.utils.simplexml import Serialization
+from peloton.utils.simplexml import groupFragments
 from peloton.exceptions import PelotonError
+from peloton.exceptions import ServiceError
+
+def _markExpensive(fn):
+    """ Mark the transform method fn as expensive to run. """
+    fn.expensive = True
+    return fn
 
 def valueToDict(conf={}):
     """ Takes data and returns the dict {'d':data}. """
@@ -62,33 +76,112 @@ def string(conf={}):
 xmlFormatter = XMLFormatter()
 htmlFormatter = HTMLFormatter()
 
-def defaultXMLTransform(conf={}):
+def _serializingTransform(formatter, stream, chunkSize):
+    """ Return a transform serializing data with formatter. If stream is
+True the transform returns a Serialization, which is only serialized as 
+it is written out, chunkSize characters at a time; this should be the last
+transform in the chain. """
+    if stream:
+        def _fn(data, opts):
+            return Serialization(formatter, data, chunkSize)
+        return _fn
     def _fn(data, opts):
-        return xmlFormatter.format(data)
-    return _fn
+        return formatter.format(data)
+    return _markExpensive(_fn)
 
-def defaultHTMLTransform(conf={}):
-    def _fn(data, opts):
-        return htmlFormatter.format(data)
-    return _fn
+def defaultXMLTransform(conf={}, stream=False, chunkSize=8192):
+    return _serializingTransform(xmlFormatter, stream, chunkSize)
+
+def defaultHTMLTransform(conf={}, stream=False, chunkSize=8192):
+    return _serializingTransform(htmlFormatter, stream, chunkSize)
 
 import simplejson
+
+def _cEncoder(module):
+    """ Return the C accelerated encoder of a simplejson-like module, or
+None if it has none; older releases lack the attribute altogether. """
+    return getattr(getattr(module, 'encoder', None), 'c_make_encoder', None)
+
+json = simplejson
+if not _cEncoder(simplejson):
+    # simplejson was installed without its speedups; the json module
+    # of Python 2.6 and later may have them
+    try:
+        import json as _json
+        if _cEncoder(_json):
+            json = _json
+    except ImportError:
+        pass
+#: True if JSON is encoded by a C accelerated encoder
+JSON_ACCELERATED = bool(_cEncoder(json))
+
 class JSONFormatter(object):
-    def format(self,v):
-        """ Returns content-type, content. """
+    """ Serialises values as JSON through an encoder built once, when the
+formatter is created. If compact is True no whitespace is put after 
+separators.
+
+For streaming, a list or tuple value is encoded a slice of items at a 
+time, and a dict item by item, so that about chunkSize characters, or 
+one item if that is larger, are held at a time. Each slice is encoded in
+one call so as to make full use of a C accelerated encoder. """
+    def __init__(self, compact=False):
+        if compact:
+            self.encoder = json.JSONEncoder(separators=(',', ':'))
+        else:
+            self.encoder = json.JSONEncoder()
+        self.itemSeparator = self.encoder.item_separator
+
+    def format(self, v):
         try:
-            s = simplejson.dumps(v)
-        except:
-            s = u'"Unserialisable response: %s"' % str(v)
-        return s
+            return self.encoder.encode(v)
+        except (TypeError, ValueError), ex:
+            raise ServiceError("Unserialisable response: %s" % str(ex))
+
+    def fragments(self, v, chunkSize=8192):
+        """ Generate the JSON for v as a sequence of strings. A list is
+encoded in slices, sized from the items encoded so far to come to about
+chunkSize characters. """
+        encode = self.format
+        if type(v) in [types.ListType, types.TupleType]:
+            yield "["
+            separator = ""
+            ix, count = 0, 1
+            while ix < len(v):
+                s = encode(list(v[ix:ix+count]))[1:-1]
+                yield "%s%s" % (separator, s)
+                separator = self.itemSeparator
+                ix += count
+                count = max(1, chunkSize * count / max(1, len(s)))
+            yield "]"
+        elif type(v) == types.DictType:
+            yield "{"
+            separator = ""
+            for item in v.iteritems():
+                # the encoder converts keys as it would for the whole dict
+                yield "%s%s" % (separator, encode(dict([item]))[1:-1])
+                separator = self.itemSeparator
+            yield "}"
+        else:
+            yield encode(v)
+
+    def chunks(self, v, chunkSize=8192):
+        return groupFragments(self.fragments(v, chunkSize), chunkSize)
+
 jsonFormatter = JSONFormatter()
+compactJSONFormatter = JSONFormatter(compact=True)
 
-def jsonTransform(conf={}):
-    def _fn(data, opts):
-        return jsonFormatter.format(data)
-    return _fn
+def jsonTransform(conf={}, stream=False, chunkSize=8192, compact=False):
+    """ Serialise data as JSON, raising ServiceError if it cannot be. With
+compact=True whitespace is omitted; with stream=True the output is
+written out as it is produced, chunkSize characters at a time. """
+    if compact:
+        return _serializingTransform(compactJSONFormatter, stream, chunkSize)
+    return _serializingTransform(jsonFormatter, stream, chunkSize)
 
 from genshi.template import TemplateLoader
+from genshi.template import MarkupTemplate
+# used only to resolve includes; templates themselves are compiled and
+# kept by the templateCache
 templateLoader = TemplateLoader([])
 templateLoader.auto_reload = True
 
@@ -108,6 +201,142 @@ try:
 except:
     DJANGO_ENABLED = False
 
+class TemplateCache(object):
+    """ Holds compiled templates keyed on absolute path, shared by all 
+the template transforms in this process. 
+
+Rather than check a template file each time it is used, the modification
+times of all the files are checked at most once every sweepInterval 
+seconds, on the first use after the interval has passed; templates whose
+files have changed or gone are dropped, to be compiled afresh when next 
+used. At most maxSize templates are held; the least recently used is 
+dropped to make room for another. Both are set from the settings 
+templateCacheSize and templateSweepInterval by configure.
+
+May be used from many threads at once. """
+    def __init__(self, maxSize=200, sweepInterval=2.0):
+        self.maxSize = maxSize
+        self.sweepInterval = sweepInterval
+        # key is path, value is [template, mtime, last used]
+        self.templates = {}
+        self.lock = threading.Lock()
+        self.lastSweep = time.time()
+        self.uses = 0
+        self.hits = 0
+        self.compiles = 0
+        self.compileTime = 0.0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def configure(self, settings):
+        """ Take maxSize and sweepInterval from the templateCacheSize and
+templateSweepInterval keys of settings, where present. """
+        if settings.has_key('templateCacheSize'):
+            self.maxSize = int(settings['templateCacheSize'])
+        if settings.has_key('templateSweepInterval'):
+            self.sweepInterval = float(settings['templateSweepInterval'])
+
+    def get(self, path, compileFn):
+        """ Return the template for path, compiled with compileFn(path) 
+if not held. Paths are made absolute so that each file is held once
+however it is referred to. """
+        path = os.path.abspath(path)
+        self.lock.acquire()
+        try:
+            if time.time() - self.lastSweep > self.sweepInterval:
+                self._sweep()
+            self.uses += 1
+            try:
+                entry = self.templates[path]
+                entry[2] = self.uses
+                self.hits += 1
+                return entry[0]
+            except KeyError:
+                pass
+        finally:
+            self.lock.release()
+
+        # compile outside the lock; two threads may compile the same 
+        # template at once, which is harmless.
+        mtime = os.stat(path).st_mtime
+        started = time.time()
+        template = compileFn(path)
+        elapsed = time.time() - started
+
+        self.lock.acquire()
+        try:
+            self.compiles += 1
+            self.compileTime += elapsed
+            self.templates[path] = [template, mtime, self.uses]
+            while len(self.templates) > self.maxSize:
+                self._evict()
+        finally:
+            self.lock.release()
+        return template
+
+    def _evict(self):
+        """ Drop the least recently used template. Called with the lock 
+held. """
+        oldest = None
+        for path, entry in self.templates.items():
+            if oldest == None or entry[2] < self.templates[oldest][2]:
+                oldest = path
+        del(self.templates[oldest])
+        self.evictions += 1
+
+    def _sweep(self):
+        """ Drop templates whose files have changed. Called with the lock
+held. """
+        self.lastSweep = time.time()
+        for path, entry in self.templates.items():
+            try:
+                mtime = os.stat(path).st_mtime
+            except OSError:
+                mtime = None
+            if mtime != entry[1]:
+                del(self.templates[path])
+                self.invalidations += 1
+
+    def getStats(self):
+        """ Return a dictionary of cache statistics. """
+        self.lock.acquire()
+        try:
+            if self.uses:
+                hitRate = float(self.hits) / self.uses
+            else:
+                hitRate = 0.0
+            if self.compiles:
+                meanCompile = self.compileTime / self.compiles
+            else:
+                meanCompile = 0.0
+            return {'size' : len(self.templates),
+                    'uses' : self.uses,
+                    'hitRate' : hitRate,
+                    'compiles' : self.compiles,
+                    'meanCompileTime' : meanCompile,
+                    'evictions' : self.evictions,
+                    'invalidations' : self.invalidations}
+        finally:
+            self.lock.release()
+
+templateCache = TemplateCache()
+
+def _compileGenshi(path):
+    fp = open(path)
+    try:
+        return MarkupTemplate(fp, filepath=path, 
+                              filename=os.path.basename(path),
+                              loader=templateLoader)
+    finally:
+        fp.close()
+
+def _compileDjango(path):
+    fp = open(path)
+    try:
+        return Template(fp.read())
+    finally:
+        fp.close()
+
 def _expand(conf, f):
     """ If f is ~ return the full path to it. If $NAME is found, substitute
 for the published name of the service."""
@@ -143,6 +372,8 @@ path you may also use Django templating. A Django template is indicated
 by the suffix '.django', e.g::
   
   ~/templates/AirforceOne/foo.html.django
+
+Compiled templates are held in the templateCache.
 """
     _valueToDict = valueToDict()
     # expand any ~ entries
@@ -164,12 +395,10 @@ by the suffix '.django', e.g::
         if templateFile[-6:] == 'django':
             if not DJANGO_ENABLED:
                 raise PelotonError("DJANGO templates not supported: Django libraries not in path")
-            fp = open(templateFile)
-            template = Template(fp.read())
-            fp.close()
+            template = templateCache.get(templateFile, _compileDjango)
             context = Context(data)
             return template.render(context)
         else:
-            template = templateLoader.load(templateFile)
+            template = templateCache.get(templateFile, _compileGenshi)
             return template.generate(**data).render()
-    return _fn
\ No newline at end of file
+    return _markExpensive(_fn)
\ No newline at end of file
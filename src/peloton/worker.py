@@ -36,6 +36,8 @@ able to register with events on the PSC as well as pass other messages back.
 from peloton.utils import bigThreadPool
 
 from twisted.internet import reactor
+from twisted.internet.defer import Deferred
+from twisted.internet.defer import maybeDeferred
 from twisted.internet.threads import deferToThread
 try:
     from twisted.internet.error import ReactorNotRunning
@@ -47,13 +49,32 @@ from peloton.base import HandlerBase
 from peloton.exceptions import WorkerError
 from peloton.exceptions import ServiceConfigurationError
 from peloton.exceptions import ServiceError
+from peloton.exceptions import WorkerBusyError
 from peloton.utils import getClassFromString
+from peloton.utils.config import PelotonSettings # needed for eval
+from peloton.coreio import OutputTransform
+from peloton.utils.simplexml import Serialization
+from peloton.coreio import TRANSFORM_TARGET_KEY
+from peloton.utils.transforms import templateCache
 import peloton.utils.logging as logging
 import sys
 
 class PelotonWorker(HandlerBase):
     """ A Peloton Worker manages services, executes methods and returns
 results to its controling PSC. 
+
+Calls are run in threads. At most profile.launch.maxconcurrency calls
+(default 10; 0 for no limit) run at once; beyond that up to 
+profile.launch.maxqueued calls (default 50) wait their turn and any more are 
+rejected immediately with a WorkerBusyError so that the PSC may try 
+another worker.
+
+Methods decorated with peloton.svcdeco.asynchronous are instead called
+directly in the reactor; they do not count towards the concurrency limit.
+
+The results of methods decorated with peloton.svcdeco.transformInWorker 
+are put through the output transform chain here, in the same thread, for
+the target passed by the PSC with the call.
 """
     def __init__(self, pscHost, pscPort, token):
         """ The parent PSC is found at pscHost:pscPort - the host
@@ -64,7 +85,18 @@ allow for other scenarios by passing the host through at this point.
         self.pscHost = pscHost
         self.pscPort = pscPort
         self.token = token
+        self.spare = False
         self.dispatcher = WorkerEventDispatcher(self)
+        self.maxConcurrency = 10
+        self.maxQueued = 50
+        # number of calls currently running in threads and
+        # calls waiting to run
+        self.executing = 0
+        self.callQueue = []
+        # OutputTransforms of methods, as used by transformInWorker
+        self.outputTransforms = {}
+        # runs calls to service methods
+        self.inThread = deferToThread
     
     def start(self):
         """ Start this worker; returns an exit code when worker 
@@ -119,25 +151,41 @@ if not, let the PSC know we've failed and why, then initiate closedown. """
             if sd not in sys.path:
                 sys.path.append(sd)
 
+        # size the template cache as the PSC's
+        templateCache.configure(startupInfo)
         self.loadService(startupInfo['runtimeConfig'])
         try:
             self.pscReference = startupInfo['pwa']
         except Exception,ex:
             self.logger.exception('[1]')
+        # a spare worker starts its service but does not announce
+        # itself until activated by the PSC
+        self.spare = startupInfo.has_key('spare') and startupInfo['spare']
         try:
             self.startService()
-            self.dispatcher.fireEvent( 'psc.service.notification',
-                                  'domain_control',
-                                  serviceName=self.name,
-                                  publishedName=self.publishedName,
-                                  state='running',
-                                  token=self.token)
+            if not self.spare:
+                self.notifyRunning()
             self.pscReference.callRemote('serviceStartOK', self.__service.version)
         except Exception, ex:
             self.pscReference.callRemote('serviceStartFailed', str(ex))
         self.logger.info("PWP Started for service %s " % self.name)
         reactor.callLater(3, self.heartBeat)
         
+    def notifyRunning(self):
+        """ Announce to the domain that this worker is taking requests. """
+        self.dispatcher.fireEvent( 'psc.service.notification',
+                              'domain_control',
+                              serviceName=self.name,
+                              publishedName=self.publishedName,
+                              state='running',
+                              token=self.token)
+
+    def activate(self):
+        """ Called when a spare worker is promoted into the active pool. """
+        if self.spare:
+            self.spare = False
+            self.notifyRunning()
+
     def _clientConnectError(self, err):
         print("Error connecting with PSC: %s" % err.getErrorMessage())
         reactor.stop()
@@ -183,6 +231,17 @@ Raises ServiceConfigurationError if the name is invalid.
             self.__service.loadConfig(self.servicepath, runtimeConfig)
         except Exception, ex:
             raise ServiceConfigurationError("Could not find class for service %s" % self.name, ex)
+
+        try:
+            launch = self.__service.profile['launch']
+            if launch.has_key('maxconcurrency'):
+                self.maxConcurrency = int(launch['maxconcurrency'])
+            if launch.has_key('maxqueued'):
+                self.maxQueued = int(launch['maxqueued'])
+        except KeyError:
+            pass
+        except ValueError, ex:
+            raise ServiceConfigurationError("Invalid concurrency limits for service %s" % self.name, ex)
     
     def startService(self):
         """ Call serviceClass.start(): this is the method which sets up
@@ -197,20 +256,80 @@ the service might require.
     def stopService(self):
         """ Calls stop() on the managed service. """
         try:
-            self.dispatcher.fireEvent( 'psc.service.notification',
-                                  'domain_control',
-                                  serviceName=self.name,
-                                  publishedName=self.publishedName,
-                                  state='stopped',
-                                  token=self.token)
+            # spares never announced themselves as running
+            if not self.spare:
+                self.dispatcher.fireEvent( 'psc.service.notification',
+                                      'domain_control',
+                                      serviceName=self.name,
+                                      publishedName=self.publishedName,
+                                      state='stopped',
+                                      token=self.token)
             self.__service.stop()
         except Exception, ex:
             raise ServiceError("Error stopping service %s" % self.name, ex)
 
     def call(self, method, *args, **kwargs):
-        """ Call and excecute the specified method with args as provided. """
+        """ Call and excecute the specified method with args as provided. 
+If the worker is saturated the call is queued or, if the queue is also 
+full, WorkerBusyError is raised. """
+        target = kwargs.pop(TRANSFORM_TARGET_KEY, None)
         mthd = getattr(self.__service, "public_%s"%method)
-        return deferToThread(mthd, *args, **kwargs)
+        if hasattr(mthd, '_PELOTON_METHOD_PROPS') and \
+            mthd._PELOTON_METHOD_PROPS.has_key('asynchronous'):
+            d = maybeDeferred(mthd, *args, **kwargs)
+            if target:
+                d.addCallback(self._transform, method, target)
+            return d
+        if target:
+            mthd = self._transforming(mthd, method, target)
+        if self.maxConcurrency > 0 and self.executing >= self.maxConcurrency:
+            if len(self.callQueue) >= self.maxQueued:
+                raise WorkerBusyError("Worker busy: %d calls running, %d queued" \
+                                      % (self.executing, len(self.callQueue)))
+            d = Deferred()
+            self.callQueue.append((d, mthd, args, kwargs))
+            return d
+        return self._execute(mthd, args, kwargs)
+
+    def _execute(self, mthd, args, kwargs):
+        """ Run the method in a thread. """
+        self.executing += 1
+        d = self.inThread(mthd, *args, **kwargs)
+        d.addBoth(self._callComplete)
+        return d
+
+    def _transforming(self, mthd, method, target):
+        """ Return a function that calls mthd and transforms its 
+result for target. """
+        def _fn(*args, **kwargs):
+            return self._transform(mthd(*args, **kwargs), method, target)
+        return _fn
+
+    def _transform(self, value, method, target):
+        try:
+            txform = self.outputTransforms[method]
+        except KeyError:
+            profile = self.__service.profile
+            instanceInfo = {"resourceRoot" : profile["resourceRoot"],
+                            "publishedName" : profile["publishedName"]}
+            properties = eval(profile['methods'][method]['properties'])
+            txform = OutputTransform(instanceInfo, properties)
+            self.outputTransforms[method] = txform
+        value = txform.transform(target, value, 
+                                 {'publishedName' : self.publishedName})
+        # the result is returned over PB so may not be streamed
+        if isinstance(value, Serialization):
+            value = value.getvalue()
+        return value
+
+    def _callComplete(self, rv):
+        """ A call has finished: start the next queued call, if any, and
+pass through the result. """
+        self.executing -= 1
+        if self.callQueue:
+            d, mthd, args, kwargs = self.callQueue.pop(0)
+            self._execute(mthd, args, kwargs).chainDeferred(d)
+        return rv
             
 class KernelInterface(pb.Referenceable):
     """ This class mediates between the worker and the kernel; it
@@ -227,6 +346,10 @@ is the means by which the kernel makes method requests etc."""
         """ Stop this worker"""
         self.worker.closedown()
     
+    def remote_activate(self):
+        """ Promote this worker from spare to active. """
+        self.worker.activate()
+
     def remote_call(self, method, *args, **kwargs):
         """ Return the result of calling method(*args, **kwargs)
 on this service. """
@@ -236,10 +359,12 @@ class WorkerEventDispatcher(object):
     def __init__(self, worker):
         self.worker = worker
 
-    def register(self, key, handler, exchange='events'):
+    def register(self, key, handler, exchange='events', batchWindow=0,
+                 maxQueued=1000, overflow='dropoldest'):
         try:
             self.worker.pscReference.callRemote('register', 
-                key, handler, exchange)
+                key, handler, exchange, batchWindow, 
+                maxQueued=maxQueued, overflow=overflow)
         except Exception,ex:
             print(ex)
 
@@ -0,0 +1,98 @@
+# $Id$
+#
+# Copyright (c) 2007-2008 ReThought Limited and Peloton Contributors
+# All Rights Reserved
+# See LICENSE for details
+""" The zygote is a long-lived process spawned once by the PSC from which
+PWP workers are forked on demand.
+
+Starting a worker with pwp.py costs a full interpreter start plus the import
+of Twisted, Genshi, Django, simplejson and the Peloton core before the worker
+can even register with its PSC. The zygote pays this price once: it imports
+everything it can up-front, then sits reading commands from stdin. Each
+command is a single line::
+
+    SPAWN <token>
+
+on receipt of which the zygote forks; the child becomes a PelotonWorker
+exactly as if it had been started by pwp.py with that token.
+
+Note that the zygote must NOT install the Twisted reactor: a reactor
+created prior to the fork would share its waker pipe and poller with every
+child, which is precisely the 'strange state' noted in pwp.py. The peloton
+modules that import the reactor are therefore only imported in the child,
+after the fork; they are cheap compared to the libraries pre-loaded here.
+
+The zygote exits when its stdin is closed, i.e. when the PSC goes away.
+"""
+import os
+import sys
+import signal
+
+# Heavy imports that the children inherit ready-loaded; none of them
+# is used by the zygote itself and none installs the reactor. As in 
+# pwp.py, bigThreadPool must be imported before anything that imports 
+# the thread pool. twisted.internet.threads and peloton.svcdeco are 
+# imported by the worker and by services respectively.
+from peloton.utils import bigThreadPool
+import twisted.spread.pb
+import twisted.internet.defer
+import twisted.internet.threads
+import peloton.utils.logging
+import peloton.utils.config
+import peloton.utils.transforms
+import peloton.exceptions
+import peloton.svcdeco
+
+def spawn(host, port, token):
+    """ Fork a child to run a worker registering with token. Returns the
+pid of the child in the zygote; never returns in the child. """
+    pid = os.fork()
+    if pid:
+        return pid
+
+    # in the child: detach from the zygote command pipe and restore
+    # default child and interrupt handling before becoming a worker.
+    exitCode = 1
+    try:
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+        devnull = os.open(os.devnull, os.O_RDONLY)
+        os.dup2(devnull, 0)
+        os.close(devnull)
+        from peloton.worker import PelotonWorker
+        worker = PelotonWorker(host, port, token)
+        exitCode = worker.start()
+    except:
+        import traceback
+        traceback.print_exc()
+    os._exit(exitCode)
+
+def serve(commands, host, port):
+    """ Read SPAWN commands from the file commands until it closes,
+spawning a worker for each. Lines that are not commands are ignored. """
+    while True:
+        line = commands.readline()
+        if not line:
+            break
+        line = line.strip()
+        try:
+            command, arg = line.split(' ', 1)
+        except ValueError:
+            continue
+        if command == 'SPAWN':
+            spawn(host, port, arg)
+
+def main():
+    """ Read SPAWN commands from stdin until it closes. """
+    host, port = sys.argv[1:3]
+    port = int(port)
+    # children are reaped automatically
+    signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+    # the PSC deals with INT/TERM; the zygote closes when the PSC does.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    serve(sys.stdin, host, port)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -27,29 +27,37 @@ def prt(msg):
     print msg
 outputMessage = prt # method to use to output message
 
+def formatRecord(record, source):
+    """ Return the log record, one of those sent together in a 
+psc.logging event, as a line of output. """
+    created = float(record['created'])
+    t = time.localtime(created)
+    millis = int(math.modf(created)[0]*1000.0)
+    return "%s.%03d %s : %s [%s] %s" % (time.strftime('%H:%M:%S', t), millis,
+                                       source, record['levelname'],
+                                       record['name'], record['message'])
+
 def eventReceived(msg, exchange, key, ctag):
     if not profiles.has_key(msg['sender_guid']):
         tapConn.getPSCProfile(msg['sender_guid'])
         
     if key=='psc.logging' and exchange=='logging':
         # automatically detect log entries and format accordingly
-        try:
-            if profiles.has_key(msg['sender_guid']):
-                p = profiles[msg['sender_guid']]
-                host = p['hostname']
-                dix = host.find('.')
-                if dix > 0:
-                    host = host[:dix]
-                msg['__source'] = "%s:%s" % (host, p['port'])
-            else:
-                msg['__source'] = '???'
-            created = float(msg['created'])
-            t = time.localtime(created)
-            millis = int(math.modf(created)[0]*1000.0)
-            msg['time'] = "%s.%03d" % (time.strftime('%H:%M:%S', t), millis)
-            outputMessage("""%(time)s %(__source)s : %(levelname)s [%(name)s] %(message)s""" % msg)
-        except Exception, ex:
-            outputMessage("Error: " + str(ex))
+        if profiles.has_key(msg['sender_guid']):
+            p = profiles[msg['sender_guid']]
+            host = p['hostname']
+            dix = host.find('.')
+            if dix > 0:
+                host = host[:dix]
+            source = "%s:%s" % (host, p['port'])
+        else:
+            source = '???'
+        # records are sent in batches
+        for record in msg.get('records', []):
+            try:
+                outputMessage(formatRecord(record, source))
+            except Exception, ex:
+                outputMessage("Error: " + str(ex))
         
     else:
         outputMessage("\n:: %s | %s" % (exchange, key))
@@ -70,7 +78,8 @@ def setProfile(profile):
 
 def setMasterProfile(profile):
     setProfile(profile)
-    tapConn.addEventHandler(options.key, options.exchange, eventReceived)
+    tapConn.addEventHandler(options.key, options.exchange, eventReceived, 
+                            float(options.batch))
 
 def disconnected():
     global disconnectedTime
@@ -99,6 +108,11 @@ def main():
                       help="Exchange [default %default]",
                       default="logging")
     
+    parser.add_option("--batch", "-b",
+                      help="""Have the PSC batch events, sending them at most
+ this many seconds apart. 0 sends each event as it occurs [default %default]""",
+                      default="0")
+
     parser.add_option("--enableirc", "-i",
                         help="Enable IRC server output",
                         action="store_true")
@@ -9,15 +9,16 @@ code can be hooked into GUIs or console tools via handler hooks. """
 from twisted.internet import reactor
 from twisted.spread import pb
 from peloton.utils.config import PelotonSettings
+from peloton.events import EventReceiver
 
-class EventHandler(pb.Referenceable):
+class EventHandler(EventReceiver):
     def __init__(self, callback):
         self.callback = callback
         
     def remote_eventReceived(self, msg, exchange, key, ctag):
         self.callback(msg, exchange, key, ctag)
 
-class ClosedownListener(pb.Referenceable):
+class ClosedownListener(EventReceiver):
     def __init__(self, tapConnector, callback):
         self.tapConnector = tapConnector
         self.callback = callback
@@ -75,9 +76,12 @@ method to be fired at appropriate times. The events are:
             cb(*args)
     # END CALLBACK MANAGEMENT
 
-    def addEventHandler(self, key, exchange, handler):
+    def addEventHandler(self, key, exchange, handler, batchWindow=0):
+        """ Register handler for events on exchange matching key. If
+batchWindow is set the PSC will send events in batches, collecting them
+for up to that many seconds. """
         handler = EventHandler(handler)
-        self.iface.callRemote("register", key, handler, exchange)
+        self.iface.callRemote("register", key, handler, exchange, batchWindow)
         return handler
     
     def removeEventHandler(self, handler):
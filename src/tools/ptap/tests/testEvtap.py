@@ -0,0 +1,60 @@
+# $Id$
+#
+# Copyright (c) 2007-2008 ReThought Limited and Peloton Contributors
+# All Rights Reserved
+# See LICENSE for details
+""" Test the output of log records by evtap """
+
+from unittest import TestCase
+from tools.ptap import evtap
+import time
+
+class FakeTap(object):
+    def __init__(self):
+        self.requested = []
+
+    def getPSCProfile(self, guid):
+        self.requested.append(guid)
+
+class Test_Evtap(TestCase):
+    def setUp(self):
+        self.output = []
+        self.outputMessage = evtap.outputMessage
+        self.tapConn = evtap.tapConn
+        evtap.outputMessage = self.output.append
+        evtap.tapConn = FakeTap()
+        evtap.profiles.clear()
+        evtap.profiles['psc1'] = {'hostname' : 'node.example.com', 
+                                  'port' : 9100}
+
+    def tearDown(self):
+        evtap.outputMessage = self.outputMessage
+        evtap.tapConn = self.tapConn
+        evtap.profiles.clear()
+
+    def test_logBatch(self):
+        """ Each record of a batch is printed on its own line. """
+        created = time.mktime((2008, 4, 1, 12, 30, 15, 0, 0, -1)) + 0.25
+        records = [{'created' : created, 'levelname' : 'INFO',
+                    'name' : 'psc', 'message' : 'one'},
+                   {'created' : created, 'levelname' : 'WARNING',
+                    'name' : 'BusLogHandler', 
+                    'message' : '3 log records dropped'}]
+        evtap.eventReceived({'sender_guid' : 'psc1', 'records' : records},
+                            'logging', 'psc.logging', '')
+        self.assertEquals(self.output, 
+              ['12:30:15.250 node:9100 : INFO [psc] one',
+               '12:30:15.250 node:9100 : WARNING [BusLogHandler] 3 log records dropped'])
+        self.assertEquals(evtap.tapConn.requested, [])
+
+    def test_badRecord(self):
+        """ A record that cannot be formatted does not stop the rest. """
+        evtap.eventReceived({'sender_guid' : 'psc2', 
+                             'records' : [{}, {'created' : 0, 
+                                               'levelname' : 'INFO',
+                                               'name' : 'x', 
+                                               'message' : 'ok'}]},
+                            'logging', 'psc.logging', '')
+        self.assertEquals(self.output[0], "Error: 'created'")
+        self.assertTrue(self.output[1].endswith('??? : INFO [x] ok'))
+        self.assertEquals(evtap.tapConn.requested, ['psc2'])